@@ -0,0 +1,322 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import get_context
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Command line scripts of the tools (relative to REPO_ROOT), used to measure the startup time
+SCRIPTS = {'map': 'format_icpms_map_data/src/format_icpms_map_data.py',
+           'linescans': 'format_icpms_linescans/src/format_icpms_linescans.py'}
+
+# Maximum time (in seconds) a tool may need on top of the bare interpreter to start and print its usage (--help).
+# The tools are called thousands of times from batch scripts, so heavy dependencies must be imported lazily.
+STARTUP_TARGET = 0.1
+
+# Settings of the despike and gas blank subtraction benchmarked (see icpms_common.Preprocessor)
+PREPROCESSING = {'despike_window': 5, 'blank_samples': 10}
+
+# Benchmark the source tree this file belongs to, not whichever versions happen to be installed
+for source_dir in ['icpms_common/src', 'format_icpms_map_data/src', 'format_icpms_linescans/src']:
+    sys.path.insert(0, os.path.join(REPO_ROOT, source_dir))
+
+from benchmarks.synthetic import generate_batch  # noqa: E402
+from icpms_common import FLOAT32_TOLERANCE  # noqa: E402
+
+
+@contextmanager
+def timed(stages, name):
+    """
+    Adds the wall time of the enclosed block to stages[name]
+    :param stages: dict, stage name -> seconds
+    :param name: str, name of stage
+    """
+    start = time.perf_counter()
+    yield
+    stages[name] = stages.get(name, 0.0) + time.perf_counter() - start
+
+
+def peak_rss_mb():
+    """
+    Determines the peak resident set size of the current process
+    :return: float, peak RSS in MB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def bench_map(folder, dtype='float64'):
+    """
+    Runs the format_icpms_map_data pipeline on a batch folder
+    :param folder: str, folder with SMPL.csv files
+    :param dtype: str, type of the counts held in memory
+    :return: dict, stage name -> seconds
+    """
+    import format_icpms_map_data as map_tool
+    from icpms_common import Preprocessor
+
+    stages = {}
+    output = os.path.join(folder, 'output')
+    if not os.path.isdir(output):
+        os.mkdir(output)
+
+    with timed(stages, 'build_map_array'):
+        files = map_tool.find_csv_files(folder)
+        data, line_lengths, elements, _ = map_tool.build_map_array(files, dtype=dtype)
+        data = map_tool.regularize_lines(data, line_lengths)
+        x_list = map_tool.step_positions(0.015, data.shape[1])
+        y_list = map_tool.step_positions(0.015, data.shape[0])
+    with timed(stages, 'preprocess'):
+        Preprocessor(**PREPROCESSING).apply(data, axis=1)
+    with timed(stages, 'write_all_results'):
+        map_tool.write_axes(folder, x_list, y_list)
+        map_tool.write_all_results(os.path.join(output, 'alldata.csv'), data, elements, x_list, y_list)
+    with timed(stages, 'create_element_matrices'):
+        map_tool.create_element_matrices(data, elements, folder)
+    return stages
+
+
+def bench_linescans(folder, dtype='float64'):
+    """
+    Runs the format_icpms_linescans pipeline on a spotsize folder
+    :param folder: str, folder with SMPL.csv files
+    :param dtype: str, type of the counts held in memory
+    :return: dict, stage name -> seconds
+    """
+    import format_icpms_linescans as linescan_tool
+    from icpms_common import Preprocessor
+    from loguru import logger
+    logger.remove()
+
+    stages = {}
+    output = os.path.join(folder, 'output')
+    if not os.path.isdir(output):
+        os.mkdir(output)
+    files = sorted(os.path.join(folder, name) for name in os.listdir(folder) if name.endswith('.csv'))
+
+    with timed(stages, 'stack_linescans'):
+        matrices, time_points, time_label, linescans, elements, _ = linescan_tool.stack_linescans(files, dtype=dtype)
+    with timed(stages, 'preprocess'):
+        Preprocessor(**PREPROCESSING).apply(matrices, axis=-1)
+    with timed(stages, 'write_all_results'):
+        linescan_tool.write_all_results(matrices, time_points, linescans, output, elements, time_label=time_label)
+    with timed(stages, 'calculate_stats'):
+        linescan_tool.calculate_stats(matrices, linescans, output, elements)
+    return stages
+
+
+BENCHMARKS = {'map': bench_map, 'linescans': bench_linescans}
+
+
+def dtype_statistics(tool, folder, dtype):
+    """
+    Reads a batch with counts of one type and determines its statistics: the mean and standard deviation of every
+    element (map) or the statistics of calculate_stats (linescans)
+    :param tool: str, key of BENCHMARKS
+    :param folder: str, folder with SMPL.csv files
+    :param dtype: str, type of the counts held in memory
+    :return: (ndarray, int), statistics and size of the counts in memory in bytes
+    """
+    import numpy
+
+    files = sorted(os.path.join(folder, name) for name in os.listdir(folder) if name.endswith('.csv'))
+    if tool == 'map':
+        import format_icpms_map_data as map_tool
+        data = map_tool.build_map_array(files, dtype=dtype)[0]
+        statistics = [numpy.nanmean(data, axis=(0, 1), dtype=numpy.float64),
+                      numpy.nanstd(data, axis=(0, 1), dtype=numpy.float64)]
+    else:
+        import format_icpms_linescans as linescan_tool
+        data = linescan_tool.stack_linescans(files, dtype=dtype)[0]
+        stats = linescan_tool.compute_stats(data)
+        statistics = [stats.average.ravel(), stats.stddev.ravel(), stats.total_average, stats.total_stddev]
+    return numpy.concatenate(statistics), data.nbytes
+
+
+def compare_dtypes(tool, folder, tolerance=FLOAT32_TOLERANCE):
+    """
+    Checks that the statistics of a batch read with float32 counts are within a tolerance of those read with float64
+    counts, and compares the memory the counts need
+    :param tool: str, key of BENCHMARKS
+    :param folder: str, folder with SMPL.csv files
+    :param tolerance: float, maximum relative difference of the statistics
+    :return: dict with the size of the counts per type, the largest relative difference and if it is within the
+    tolerance
+    """
+    import numpy
+
+    reference, reference_bytes = dtype_statistics(tool, folder, 'float64')
+    compact, compact_bytes = dtype_statistics(tool, folder, 'float32')
+    valid = numpy.isfinite(reference) & (reference != 0)
+    difference = float(numpy.max(numpy.abs(compact[valid] - reference[valid]) / numpy.abs(reference[valid]),
+                                 initial=0.0))
+    return {'bytes': {'float64': reference_bytes, 'float32': compact_bytes}, 'max_relative_difference': difference,
+            'tolerance': tolerance, 'within_tolerance': difference <= tolerance}
+
+
+def run_case(tool, folder, repeat, dtype='float64'):
+    """
+    Runs one benchmark (in a fresh process, so that peak RSS is measured per tool) and keeps the fastest repeat
+    :param tool: str, key of BENCHMARKS
+    :param folder: str, folder with SMPL.csv files
+    :param repeat: int, number of repeats
+    :param dtype: str, type of the counts held in memory
+    :return: dict with stage timings, wall time and peak RSS
+    """
+    best = None
+    for _ in range(repeat):
+        stages = BENCHMARKS[tool](folder, dtype=dtype)
+        if best is None or sum(stages.values()) < sum(best.values()):
+            best = stages
+    return {'stages': best, 'wall_time': sum(best.values()), 'peak_rss_mb': peak_rss_mb()}
+
+
+def startup_time(command, repeat):
+    """
+    Measures the time a command needs to run (the fastest of several runs)
+    :param command: list, command and arguments
+    :param repeat: int, number of runs
+    :return: float, seconds
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.join(REPO_ROOT, 'icpms_common/src'),
+                                                       os.environ.get('PYTHONPATH', '')]))
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_startup(tools, repeat=5, target=STARTUP_TARGET):
+    """
+    Measures the startup time of the command line tools (running them with --help) relative to the bare interpreter
+    :param tools: list, keys of SCRIPTS
+    :param repeat: int, number of runs (the fastest is kept)
+    :param target: float, maximum startup overhead in seconds
+    :return: dict with the interpreter startup time and per tool the startup time, overhead and if the target was met
+    """
+    interpreter = startup_time([sys.executable, '-c', 'pass'], repeat)
+    result = {'interpreter': interpreter, 'target_overhead': target, 'tools': {}}
+    for tool in tools:
+        seconds = startup_time([sys.executable, os.path.join(REPO_ROOT, SCRIPTS[tool]), '--help'], repeat)
+        result['tools'][tool] = {'startup_time': seconds, 'overhead': seconds - interpreter,
+                                 'target_met': seconds - interpreter <= target}
+    return result
+
+
+def environment():
+    """
+    Collects information about the environment the benchmarks ran in
+    :return: dict
+    """
+    info = {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count()}
+    for module in ['numpy', 'pandas']:
+        try:
+            info[module] = __import__(module).__version__
+        except ImportError:
+            info[module] = None
+    try:
+        info['git_commit'] = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                                            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        info['git_commit'] = None
+    return info
+
+
+def run_benchmarks(lines, samples, elements, tools, repeat=3, seed=0, workdir=None, startup_target=STARTUP_TARGET,
+                   dtype='float64'):
+    """
+    Generates synthetic batches and benchmarks the formatting tools on them
+    :param lines: int, number of lines (SMPL.csv files) per batch
+    :param samples: int, number of samples per line
+    :param elements: int, number of elements
+    :param tools: list, keys of BENCHMARKS to run
+    :param repeat: int, number of repeats per tool (the fastest is reported)
+    :param seed: int, seed of the synthetic data
+    :param workdir: str or None, folder for the synthetic data (default: temporary folder)
+    :param startup_target: float, maximum startup overhead of the tools in seconds
+    :param dtype: str, type of the counts held in memory by the pipelines
+    :return: dict, benchmark report
+    """
+    report = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'environment': environment(),
+              'parameters': {'lines': lines, 'samples': samples, 'elements': elements, 'repeat': repeat,
+                             'seed': seed, 'dtype': dtype},
+              'startup': bench_startup(tools, target=startup_target),
+              'results': {}, 'dtypes': {}}
+
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        for tool in tools:
+            folder = os.path.join(tmp, tool)
+            generate_batch(folder, lines=lines, samples=samples, elements=elements, seed=seed)
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+                result = executor.submit(run_case, tool, folder, repeat, dtype).result()
+                report['dtypes'][tool] = executor.submit(compare_dtypes, tool, folder).result()
+            result['rows_per_sec'] = lines * samples / result['wall_time'] if result['wall_time'] else None
+            report['results'][tool] = result
+
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks format_icpms_map_data and format_icpms_linescans on '
+                                                 'synthetic SMPL.csv batches')
+    parser.add_argument('--lines', type=int, default=200, help='number of lines (SMPL.csv files), default: 200')
+    parser.add_argument('--samples', type=int, default=500, help='number of samples per line, default: 500')
+    parser.add_argument('--elements', type=int, default=10, help='number of elements, default: 10')
+    parser.add_argument('--tools', nargs='+', choices=sorted(BENCHMARKS), default=sorted(BENCHMARKS),
+                        help='tools to benchmark (default: all)')
+    parser.add_argument('--repeat', type=int, default=3, help='repeats per tool, the fastest is kept (default: 3)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data')
+    parser.add_argument('--workdir', default=None, help='folder for the synthetic data (default: system temp)')
+    parser.add_argument('--dtype', choices=['float64', 'float32'], default='float64',
+                        help='type of the counts held in memory by the pipelines (default: float64)')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON report to write')
+    parser.add_argument('--startup-target', type=float, default=STARTUP_TARGET,
+                        help='maximum startup time of a tool on top of the bare interpreter in seconds, the benchmark '
+                             'fails if it is exceeded (default: {})'.format(STARTUP_TARGET))
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.lines, args.samples, args.elements, args.tools, repeat=args.repeat, seed=args.seed,
+                            workdir=args.workdir, startup_target=args.startup_target, dtype=args.dtype)
+    with open(args.output, 'w') as F:
+        json.dump(report, F, indent=2)
+
+    startup = report['startup']
+    print('Interpreter startup: {:.3f} s'.format(startup['interpreter']))
+    for tool, result in startup['tools'].items():
+        print('{} startup: {:.3f} s (+{:.3f} s, target +{:.3f} s) {}'.format(
+            tool, result['startup_time'], result['overhead'], startup['target_overhead'],
+            'OK' if result['target_met'] else 'TOO SLOW'))
+
+    for tool, result in report['results'].items():
+        print('{}: {:.3f} s, {:.0f} rows/s, peak RSS {:.1f} MB'.format(tool, result['wall_time'],
+                                                                      result['rows_per_sec'], result['peak_rss_mb']))
+        for stage, seconds in result['stages'].items():
+            print('    {}: {:.3f} s'.format(stage, seconds))
+
+    for tool, result in report['dtypes'].items():
+        print('{} float32: counts need {:.1f} MB instead of {:.1f} MB, statistics differ by up to {:.1e} (tolerance '
+              '{:.0e}) {}'.format(tool, result['bytes']['float32'] / 1e6, result['bytes']['float64'] / 1e6,
+                                  result['max_relative_difference'], result['tolerance'],
+                                  'OK' if result['within_tolerance'] else 'OUT OF TOLERANCE'))
+    print('Report written to {}'.format(args.output))
+
+    if not all(result['target_met'] for result in startup['tools'].values()) or \
+            not all(result['within_tolerance'] for result in report['dtypes'].values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import os
+
+import numpy
+
+# Isotopes measured in our experiments; further elements get synthetic names with unique symbols
+ISOTOPES = ['S34', 'Ca43', 'Fe56', 'Zn66', 'W182', 'P31', 'Mg24', 'Mn55', 'Cu63', 'Sr88', 'Na23', 'K39', 'Co59',
+            'Ni60', 'Se78', 'Mo95', 'Cd111', 'Ba137', 'Pb208', 'Gd157']
+
+TIME_STEP = 0.494
+
+
+def element_names(count):
+    """
+    Determines element headers for a synthetic batch. Symbols (headers without digits) are unique, so that every
+    element gets its own matrix file.
+    :param count: int, number of elements
+    :return: list of element headers
+    """
+    names = ISOTOPES[:count]
+    for index in range(count - len(names)):
+        letters = ''
+        index_left = index
+        while True:
+            letters = chr(ord('a') + index_left % 26) + letters
+            index_left = index_left // 26 - 1
+            if index_left < 0:
+                break
+        names.append('X' + letters + str(100 + index))
+    return names
+
+
+def write_smpl_file(path, time, counts, elements, batch='synthetic.b'):
+    """
+    Writes an Agilent-style SMPL.csv file with the same 4 line header and 3 line footer as the instrument exports
+    :param path: str, path of file to write
+    :param time: ndarray, acquisition times
+    :param counts: ndarray, counts of shape (sample x element)
+    :param elements: list, element headers
+    :param batch: str, name of the batch folder written in the header
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    with open(path, 'w') as F:
+        F.write('D:\\Data\\{}\\{}.d\n'.format(batch, name))
+        F.write('Intensity Vs Time,CPS\n')
+        F.write('Acquired      : 4/29/2018 9:32:05 AM using Batch {}\n'.format(batch))
+        F.write('Time [Sec],{}\n'.format(','.join(elements)))
+        numpy.savetxt(F, numpy.column_stack([time, counts]), fmt=['%.4f'] + ['%.2f'] * len(elements), delimiter=',')
+        F.write('\n\n          Printed:4/29/2018 9:33:24 AM\n')
+
+
+def generate_batch(folder, lines, samples, elements, seed=0, start_index=1):
+    """
+    Generates a batch of synthetic SMPL.csv files (one per line) with log-normally distributed counts
+    :param folder: str, folder to write the files to (created if needed)
+    :param lines: int, number of lines (files)
+    :param samples: int, number of samples per line
+    :param elements: int, number of elements
+    :param seed: int, seed of the random number generator
+    :param start_index: int, number of the first file (e.g. 1 => 001SMPL.csv)
+    :return: list of files written (full path)
+    """
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    rng = numpy.random.default_rng(seed)
+    names = element_names(elements)
+    scales = rng.uniform(1e2, 1e5, size=elements)
+    time = TIME_STEP * numpy.arange(1, samples + 1) + 0.028
+
+    files = []
+    for index in range(start_index, start_index + lines):
+        path = os.path.join(folder, '{:03d}SMPL.csv'.format(index))
+        counts = rng.lognormal(mean=0.0, sigma=0.5, size=(samples, elements)) * scales
+        write_smpl_file(path, time, counts, names, batch=os.path.basename(folder) or 'synthetic.b')
+        files.append(path)
+    return files
@@ -8,10 +8,11 @@ setuptools.setup(
     description="Tool to format LA-ICP-MS data",
     long_description="Formats LA-ICP-MS line-scan csv files into separate elemental matrix files",
     url="https://github.com/davidkuter/ICP-MS/tree/master/",
-    packages=setuptools.find_packages('src'),
+    py_modules=['format_icpms_linescans', 'format_ref_data'],
     package_dir={'': 'src'},
     include_package_data=True,
-    entry_points={'console_scripts': ['format_icpms_linescans = format_icpms_linescans:main']},
+    entry_points={'console_scripts': ['format_icpms_linescans = format_icpms_linescans:main',
+                                      'format_ref_data = format_ref_data:main']},
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: Free for non-commercial use  ",
@@ -1,26 +1,126 @@
-import numpy
-import pandas as pd
+import argparse
 import os
 import sys
+import tempfile
+import time
 
-from loguru import logger
+from collections import namedtuple
+from contextlib import ExitStack
+from icpms_common import (DESPIKE_THRESHOLD, DTYPES, FORMATS, PREFETCH_BYTES, PREFETCH_DEPTH, LazyObject,
+                          PrefetchReader, Preprocessor, Profiler, archive_folders, extracted_path, format_available,
+                          format_rows, is_archive, lazy_import, numeric_prefix, open_output, read_smpl_files,
+                          scan_folder, sequence_problems, write_container, write_rows)
+
+# Heavy dependencies are imported on first use, so that usage errors and --help return immediately
+numpy = lazy_import('numpy')
+logger = LazyObject('loguru', 'logger')
+
+
+def parse_arguments(input_args):
+    """
+    Parses command line arguments
+    :param input_args: list of arguments (excluding the program name)
+    :return: argparse.Namespace with attributes path_to_data_folder, format, jobs, streaming, despike,
+    despike_threshold, blank, dtype, precision, prefetch, prefetch_memory, profile, profile_report and cprofile
+    """
+    parser = argparse.ArgumentParser(prog='format_icpms_linescans',
+                                     description='Formats LA-ICP-MS line-scan csv files into separate elemental '
+                                                 'matrix files')
+    parser.add_argument('path_to_data_folder',
+                        help='data folder (or zip or tar archive of it) containing one folder per sample')
+    parser.add_argument('--format', choices=FORMATS, default='csv',
+                        help='output format: csv files (default) or one compressed npz/parquet/hdf5 container per '
+                             'sample and spot size holding every element matrix')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of sample/spotsize folders processed in parallel (0 = all cores, default: 1)')
+    parser.add_argument('--streaming', action='store_true',
+                        help='process linescans one at a time so that memory does not grow with the number of '
+                             'linescans (csv output only)')
+    parser.add_argument('--despike', metavar='WINDOW', type=int, default=0,
+                        help='replace spikes by the rolling median of a window of WINDOW samples (odd) along each '
+                             'linescan before the statistics are determined (0 = no despike, default: 0)')
+    parser.add_argument('--despike-threshold', type=float, default=DESPIKE_THRESHOLD,
+                        help='modified Z-score (relative to the rolling median) above which a sample is a spike '
+                             f'(default: {DESPIKE_THRESHOLD})')
+    parser.add_argument('--blank', metavar='SAMPLES', type=int, default=0,
+                        help='subtract the gas blank of each linescan, the average of its first SAMPLES samples '
+                             '(0 = no gas blank subtraction, default: 0)')
+    parser.add_argument('--dtype', choices=DTYPES, default='float64',
+                        help='type of the counts held in memory: float32 halves the memory of the counts, which are '
+                             'then written with float32 precision (9 significant digits; statistics '
+                             'are still accumulated in float64; default: float64)')
+    parser.add_argument('--precision', type=int, default=None,
+                        help='number of significant digits of the counts and averages written to csv files (default: '
+                             'full precision, i.e. the shortest number that reads back as the same value)')
+    parser.add_argument('--prefetch', type=int, default=PREFETCH_DEPTH,
+                        help='number of csv files read ahead in threads while a file is parsed, to hide the latency '
+                             f'of network storage (0 = no read ahead, default: {PREFETCH_DEPTH})')
+    parser.add_argument('--prefetch-memory', metavar='MB', type=float, default=PREFETCH_BYTES / 2 ** 20,
+                        help='stop reading ahead while the files read ahead hold this many MB '
+                             f'(default: {PREFETCH_BYTES / 2 ** 20:g})')
+    parser.add_argument('--profile', action='store_true',
+                        help='record wall time, bytes read/written, rows processed and peak memory per stage and '
+                             'log a summary table')
+    parser.add_argument('--profile-report', metavar='FILE', default=None,
+                        help='write the --profile measurements to a JSON file (implies --profile)')
+    parser.add_argument('--cprofile', metavar='FILE', default=None,
+                        help='write cProfile statistics of the run to FILE (implies --profile; with --jobs only the '
+                             'main process is profiled)')
+    return parser.parse_args(input_args)
 
 
 def input_validation(input_args):
     """
     Validates input arguments
-    :param input_args: list of arguments of type: ['format_icpms_linescans.py', 'path_to_data_folder']
+    :param input_args: argparse.Namespace, arguments returned by parse_arguments
     :return: False if not valid, else True is returned
     """
-    # Determine if number of arguments are correct
-    if len(input_args) != 2:
-        logger.critical("Invalid number of arguments. Usage:")
-        logger.critical("format_icpms_linescans <path_to_data_folder>")
+    # Determine if the optional dependency of the output format is installed
+    if not format_available(input_args.format):
+        logger.critical(f'Output format "{input_args.format}" requires an optional dependency: '
+                        f'pip install icpms_common[{input_args.format}]')
+        return False
+
+    # Streaming mode writes the element matrices from per-element spill files, which the containers do not support
+    if input_args.streaming and input_args.format != 'csv':
+        logger.critical('Streaming mode only supports csv output')
+        return False
+
+    # Determine if the preprocessing settings are valid
+    if input_args.despike < 0 or (input_args.despike and input_args.despike % 2 == 0) or input_args.despike == 1:
+        logger.critical(f'Despike window ("{input_args.despike}") must be 0 (no despike) or an odd number of samples '
+                        f'of at least 3')
+        return False
+    if input_args.despike_threshold <= 0:
+        logger.critical(f'Despike threshold ("{input_args.despike_threshold}") must be positive')
+        return False
+    if input_args.blank < 0:
+        logger.critical(f'Number of gas blank samples ("{input_args.blank}") must be 0 (no gas blank subtraction) or '
+                        f'a positive number')
+        return False
+
+    # Determine if the precision is valid (it only applies to csv output)
+    if input_args.precision is not None and input_args.precision < 1:
+        logger.critical(f'Precision ("{input_args.precision}") must be a positive number of significant digits')
+        return False
+    if input_args.precision is not None and input_args.format != 'csv':
+        logger.critical('--precision only applies to csv output')
+        return False
+
+    # Determine if the read ahead settings are valid
+    if input_args.prefetch < 0 or input_args.prefetch_memory <= 0:
+        logger.critical('--prefetch must be 0 (no read ahead) or a positive number and --prefetch-memory must be '
+                        'positive')
+        return False
+
+    # Determine if number of jobs is valid
+    if input_args.jobs < 0:
+        logger.critical(f'Number of jobs ("{input_args.jobs}") must be 0 (all cores) or a positive number')
         return False
 
-    # Determine if directory specified exists
-    if not os.path.isdir(input_args[1]):
-        logger.critical(f'Directory "{input_args[1]}" does not exist')
+    # Determine if directory (or archive) specified exists
+    if not os.path.isdir(input_args.path_to_data_folder) and not is_archive(input_args.path_to_data_folder):
+        logger.critical(f'Directory "{input_args.path_to_data_folder}" does not exist')
         return False
 
     return True
@@ -28,203 +128,636 @@ def input_validation(input_args):
 
 def numeric_filename(filename):
     """
-    Determines the numeric portion of a filename. E.g. 0123SMPL.csv => 0123
+    Determines the numeric portion of a filename. E.g. 0123SMPL.csv => 123, 1000SMPL.csv => 1000
     :param filename: str, name of a file
-    :return: int, numeric portion of filename
+    :return: int, numeric portion of filename (None if there is none)
     """
-    return filename[:3]
+    return numeric_prefix(filename)
 
 
-def element_determination(sample_file):
+def find_csv_files(folder):
     """
-    Determines the elements measured in a file
-    :param sample_file: str, filename
-    :return: list of elements
+    Finds all csv files (one per linescan) in a folder and sorts them by the numerical component
+    :param folder: str, path to spotsize folder
+    :return: list of files (full path)
     """
-    with open(sample_file) as F:
-        # Skips unnecessary header
-        for skip in range(0, 3):
-            next(F)
-        element_header = F.readline()
-    return element_header.strip().split(',')[1:]
+    return scan_folder(folder, extension='.csv').files
 
 
-def file_len(fname):
+def element_columns(smpl, elements):
     """
-    Determine length of file
-    :param fname: str, path to file
-    :return: int, number of lines in file
+    Orders the counts of a linescan by a list of elements (elements not measured in the linescan are NaN)
+    :param smpl: SmplData, parsed SMPL.csv file
+    :param elements: list, list of elements
+    :return: ndarray, counts of shape (sample x element)
     """
-    with open(fname) as f:
-        for i, l in enumerate(f):
-            pass
-    return i + 1
+    if smpl.elements == elements:
+        return smpl.data
+    columns = numpy.full((len(smpl.data), len(elements)), numpy.nan)
+    for element_index, element in enumerate(elements):
+        if element in smpl.elements:
+            columns[:, element_index] = smpl.data[:, smpl.elements.index(element)]
+    return columns
 
 
-def store_data_in_df(csv_files):
-    linescan_count = 0
-    first_file = True
-    df = None
-    for csv in csv_files:
-        linescan_count += 1
+def stack_linescans(csv_files, reader=None, dtype='float64'):
+    """
+    Reads all linescans (each file is read only once) directly into one (line x sample) matrix per element. Samples
+    are aligned on the rows of the first linescan (missing samples are NaN, additional samples are dropped).
+    :param csv_files: list, sorted list of csv files (full path)
+    :param reader: PrefetchReader or None, reader of the csv files (files are read ahead in threads while the current
+    file is parsed; default: PrefetchReader())
+    :param dtype: str, type of the counts (one of DTYPES; float32 halves the memory of the matrices)
+    :return: (ndarray, ndarray, str, list, list, list), counts of shape (element x line x sample), times of the first
+    linescan, header of the time column, list of linescans (numbered from 1), list of elements measured and SMPL.csv
+    header information per linescan
+    """
+    matrices = None
+    time_points = numpy.empty(0)
+    time_label = 'Time [Sec]'
+    elements = []
+    line_metadata = []
+    for line_index, smpl in enumerate(read_smpl_files(csv_files, reader=reader)):
+        if matrices is None:
+            time_points, time_label, elements = smpl.time, smpl.time_label, smpl.elements
+            matrices = numpy.full((len(elements), len(csv_files), len(time_points)), numpy.nan, dtype=dtype)
+        line_metadata.append(smpl.metadata)
+
+        n_samples = min(len(smpl.data), matrices.shape[2])
+        matrices[:, line_index, :n_samples] = element_columns(smpl, elements)[:n_samples].T
+
+    if matrices is None:
+        matrices = numpy.empty((0, 0, 0), dtype=dtype)
+    linescans = list(range(1, len(csv_files) + 1))
+    return matrices, time_points, time_label, linescans, elements, line_metadata
+
+
+def matrix_file_path(working_dir, element):
+    """
+    Determines the path of the matrix file of an element (e.g. Fe56 => Fe_matrix.csv)
+    :param working_dir: str, path to output folder
+    :param element: str, element header
+    :return: (str, str), element symbol and path to matrix file
+    """
+    symbol = ''.join([char for char in element if not char.isdigit()])
+    return symbol, os.path.join(working_dir, symbol + '_matrix.csv')
 
-        # If first file, dataframe does not exist yet
-        if first_file:
-            df = pd.read_csv(csv, sep=',', skiprows=[0, 1, 2])
-            df.dropna(inplace=True)
-            df['line'] = str(linescan_count)
-            first_file = False
-        # If dataframe already exists
-        else:
-            df_next = pd.read_csv(csv, sep=',', skiprows=[0, 1, 2])
-            df_next.dropna(inplace=True)
-            df_next['line'] = str(linescan_count)
-            df = pd.concat([df, df_next])
-            del df_next
 
-    return df
+def write_matrix_rows(W, time_values, rows, precision=None):
+    """
+    Writes rows of an element matrix (time vs line#); missing samples (NaN) are left empty
+    :param W: file, open matrix file
+    :param time_values: list, time of each row
+    :param rows: ndarray, counts of each row (one value per linescan)
+    :param precision: int or None, number of significant digits of the counts (None: full precision)
+    """
+    write_rows(W, rows, precision=precision, missing='', leading=(time_values,))
 
 
-def write_all_results(df, working_dir, elements):
+def write_all_results(matrices, time, linescans, working_dir, elements, time_label='Time [Sec]', precision=None):
     """
-    Writes element data from all csv files into a separate results files
-    :param df: dataframe, Pandas dataframe containing results from all linescans
+    Writes element data from all csv files into a separate results files (time vs line# per element)
+    :param matrices: ndarray, counts of shape (element x line x sample)
+    :param time: ndarray, times of the first linescan
+    :param linescans: list, list of linescans (for header)
     :param working_dir: str, path to current working directory
     :param elements: list, list of elements (for header)
+    :param time_label: str, header of the time column
+    :param precision: int or None, number of significant digits of the counts (None: full precision)
     """
+    columns = ['line_' + str(line) for line in linescans]
+    time_values = numpy.asarray(time).tolist()
 
-    linescans = df.line.unique().tolist()
-
-    for element in elements:
-        # Create symbolic file name from element header
-        symbol = ''.join([char for char in element if not char.isdigit()])
-        filename = symbol + '_matrix'
-        output_file = os.path.join(working_dir, filename + '.csv')
-
-        # Set up dataframe to store results in. Select times for only the first line to prevent weird duplicates
-        df_element = df[['Time [Sec]', 'line']]
-        df_element = df_element.astype({'line': 'int32'})
-        df_element = df_element[df_element.line == 1]
-        df_element.drop(columns=['line'], inplace=True)
-
-        # Grab element values and merge into matrix (time vs line# per element)
-        for line in linescans:
-            # Grab data from each linescan separately for a specific element
-            df_matrix = df[element][(df['line'] == str(line))].to_frame()
-            new_col = 'line_' + str(line)
-            df_matrix.rename(columns={element: new_col}, inplace=True)
-            # Create matrix of linescans (columns) vs time
-            df_element = df_element.join(df_matrix)
-            del df_matrix
-
-        # write data to file
-        df_element.to_csv(output_file, sep=',', index=False)
+    for element_index, element in enumerate(elements):
+        symbol, output_file = matrix_file_path(working_dir, element)
+
+        # Matrix of time (rows) vs linescans (columns) is a slice of the reshaped data
+        with open_output(output_file) as W:
+            W.write('{}\n'.format(','.join([time_label] + columns)))
+            write_matrix_rows(W, time_values, matrices[element_index].T, precision=precision)
         logger.info(f'    Data for {symbol} written to {output_file}')
 
 
-def calc_mod_zscore(values_list):
+def write_linescan_container(path, fmt, matrices, time, linescans, elements, metadata):
     """
-    Calculates modified Z-score
-    (see https://www.itl.nist.gov/div898/handbook/eda/section3/eda35h.htm)
-    :param values_list: list, values to calculate the modified Z-score for
-    :return: list, Modified Z-scores
+    Writes all element matrices (time vs line#) with their time and line axes into one container
+    :param path: str, path of container without extension
+    :param fmt: str, container format ('npz', 'parquet' or 'hdf5')
+    :param matrices: ndarray, counts of shape (element x line x sample)
+    :param time: ndarray, times of the first linescan
+    :param linescans: list, list of linescans
+    :param elements: list, list of elements
+    :param metadata: dict, metadata stored with the matrices
+    :return: str, path of the container written
     """
-    median = numpy.median(values_list)
-    abs_dev = [abs(value - median) for value in values_list]
-    median_abs_dev = numpy.median(abs_dev)
-    return [0.6745*(value - median)/median_abs_dev for value in values_list]
+    element_data = {element: matrices[element_index].T for element_index, element in enumerate(elements)}
+    axes = {'time': numpy.asarray(time), 'line': numpy.array(linescans)}
+    return write_container(path, fmt, matrices=element_data, axes=axes, metadata=metadata)
 
 
-def calculate_average(values_list, outlier_index):
+def calc_mod_zscore(values):
     """
-    Calculates average and standard deviation taking into account outliers (based on modified z-score calculation).
-    Cutoff of 3.5 is used
-    :param values_list: list, List of element counts
-    :param outlier_index: list, List of indexes of outlying values that must not be used in the average calculation
-    :return: (float, float), Average and standard deviation
+    Calculates modified Z-scores of all lines at once
+    (see https://www.itl.nist.gov/div898/handbook/eda/section3/eda35h.htm)
+    If the median absolute deviation of a line is 0, values equal to the median get a Z-score of 0 and all other
+    values a Z-score of +/- infinity (i.e. they are treated as outliers).
+    :param values: ndarray, values of shape (... x sample); NaN values are ignored
+    :return: ndarray, Modified Z-scores (same shape as values)
     """
+    median = numpy.nanmedian(values, axis=-1, keepdims=True)
+    deviation = values - median
+    median_abs_dev = numpy.nanmedian(numpy.abs(deviation), axis=-1, keepdims=True)
 
-    # Remove outliers from list
-    if len(outlier_index) != 0:
-        outlier_index = sorted(outlier_index, reverse=True)
-        for index in outlier_index:
-            values_list.pop(int(index))
+    zero_mad = median_abs_dev == 0
+    z_scores = 0.6745 * deviation / numpy.where(zero_mad, 1.0, median_abs_dev)
+    # A MAD of 0 means at least half the values equal the median, so any other value is an outlier
+    return numpy.where(zero_mad & (numpy.abs(deviation) > 0), numpy.copysign(numpy.inf, deviation), z_scores)
 
-    # Calculate average and standard deviation
-    numeric_counts = [float(i) for i in values_list]
-    ave = numpy.mean(numeric_counts)
-    std = numpy.std(numeric_counts)
 
-    return ave, std
+def calculate_average(values, outliers):
+    """
+    Calculates average and standard deviation of all lines at once, taking into account outliers (based on modified
+    z-score calculation)
+    :param values: ndarray, element counts of shape (... x sample); NaN values are ignored
+    :param outliers: ndarray, boolean mask (same shape as values) of outlying values that must not be used in the
+    average calculation
+    :return: (ndarray, ndarray), Average and standard deviation per line (accumulated in float64, also for float32
+    counts)
+    """
+    rows = values.reshape(-1, values.shape[-1])
+    kept = ~(outliers | numpy.isnan(values)).reshape(rows.shape)
+    counts = kept.sum(axis=-1)
+
+    # The kept values of each line are moved to its front (in their original order), and lines with the same number
+    # of kept values are reduced together. Every line is therefore summed exactly like numpy.mean/numpy.std of its
+    # kept values alone, so the results do not depend on how many values of other lines were rejected.
+    order = numpy.argsort(~kept, axis=-1, kind='stable')
+    compacted = numpy.take_along_axis(rows, order, axis=-1)
+    ave = numpy.full(len(rows), numpy.nan)
+    std = numpy.full(len(rows), numpy.nan)
+    for count in numpy.unique(counts[counts > 0]).tolist():
+        selected = counts == count
+        line_values = numpy.ascontiguousarray(compacted[selected, :count], dtype=numpy.float64)
+        ave[selected] = numpy.mean(line_values, axis=-1)
+        std[selected] = numpy.std(line_values, axis=-1)
+    return ave.reshape(values.shape[:-1]), std.reshape(values.shape[:-1])
+
+
+# average, stddev and outliers: arrays of shape (element x line), total_average and total_stddev: arrays of the
+# average and standard deviation of the line averages per element
+LinescanStats = namedtuple('LinescanStats', ['average', 'stddev', 'outliers', 'total_average', 'total_stddev'])
+
+
+def compute_stats(matrices, cutoff=3.5):
+    """
+    Calculates outliers (based on z-score) and ave/stdev per line per element in one batched calculation. Z-scores
+    are calculated in float64 (one element at a time for float32 counts), so that values close to the cutoff are
+    classified as in a float64 run.
+    :param matrices: ndarray, counts of shape (element x line x sample)
+    :param cutoff: float, values with a modified Z-score above cutoff are outliers
+    :return: LinescanStats
+    """
+    # Determines z-score of data points per line and lists values that have a z-score above the cutoff
+    outliers = numpy.empty(matrices.shape, dtype=bool)
+    for element_index, values in enumerate(matrices):
+        outliers[element_index] = calc_mod_zscore(values.astype(numpy.float64, copy=False)) > cutoff
+    # Calculates ave and stdev of non-outlier data per line
+    ave, std = calculate_average(matrices, outliers)
+    return LinescanStats(average=ave, stddev=std, outliers=outliers.sum(axis=-1),
+                         total_average=numpy.mean(ave, axis=-1), total_stddev=numpy.std(ave, axis=-1))
 
 
-def calculate_stats(working_dir, elements):
+def write_stats(stats, linescans, working_dir, elements, precision=None):
     """
-    Calculates outliers (based on z-score) and ave/stdev per line per element
+    Writes statistics to average.csv
+    :param stats: LinescanStats, statistics returned by compute_stats
+    :param linescans: list, linescan numbers (for output)
     :param working_dir: str, Location of output folder
-    :param elements: list, List of elements to perform calculations on
+    :param elements: list, List of elements
+    :param precision: int or None, number of significant digits of the averages (None: full precision)
     """
-
-    with open(os.path.join(working_dir, 'average.csv'), 'w') as w:
+    lines = ['line_' + str(line) for line in linescans]
+    with open_output(os.path.join(working_dir, 'average.csv')) as w:
         w.write('Element,Line,Average,StdDev,Outliers\n')
-        for element in elements:
-            symbol = ''.join([char for char in element if not char.isdigit()])
-            df = pd.read_csv(os.path.join(working_dir, symbol + '_matrix.csv'), sep=',')
-            cols = list(df)
-            element_stats = []
-            for col in cols[1:]:
-                # Determines z-score of data points per line
-                z_scores = calc_mod_zscore(df[col])
-                # Lists values that have a z-score of > 3.5
-                outliers = [x[0] for x in enumerate(z_scores) if x[1] > 3.5]
-                # Calculates ave and stdev of non-outlier data per line
-                ave, std = calculate_average(df[col].tolist(), outliers)
-                element_stats.append(ave)
-                # Writes data to file
-                w.write('{},{},{},{},{}\n'.format(element, col, ave, std, len(outliers)))
-            total_ave = numpy.mean(element_stats)
-            total_std = numpy.std(element_stats)
-            w.write('{},{},{},{}\n'.format(element, 'Total', total_ave, total_std))
+        for element_index, element in enumerate(elements):
+            write_rows(w, numpy.stack([stats.average[element_index], stats.stddev[element_index]], axis=-1),
+                       precision=precision, leading=([element] * len(lines), lines),
+                       trailing=(stats.outliers[element_index].tolist(),))
+            w.write(format_rows([stats.total_average[element_index], stats.total_stddev[element_index]],
+                                precision=precision, leading=([element], ['Total'])))
+
+
+def calculate_stats(matrices, linescans, working_dir, elements, cutoff=3.5, precision=None):
+    """
+    Calculates outliers (based on z-score) and ave/stdev per line per element and writes them to average.csv
+    :param matrices: ndarray, counts of shape (element x line x sample)
+    :param linescans: list, linescan numbers (for output)
+    :param working_dir: str, Location of output folder
+    :param elements: list, List of elements
+    :param cutoff: float, values with a modified Z-score above cutoff are outliers
+    :param precision: int or None, number of significant digits of the averages (None: full precision)
+    :return: LinescanStats
+    """
+    stats = compute_stats(matrices, cutoff=cutoff)
+    write_stats(stats, linescans, working_dir, elements, precision=precision)
+    return stats
+
+
+class LinescanResult(namedtuple('LinescanResult', ['folder', 'matrices', 'time', 'time_label', 'elements',
+                                                   'linescans', 'stats', 'files', 'line_metadata', 'preprocessing'],
+                                defaults=[None])):
+    """
+    In-memory result of load_linescans:
+    folder: str, folder of the linescans, matrices: ndarray of counts of shape (element x line x sample),
+    time: ndarray of times of the first linescan, time_label: str, header of the time column,
+    elements: list of elements, linescans: list of linescan numbers, stats: LinescanStats,
+    files: list of csv files (one per linescan), line_metadata: list of SMPL.csv header information per linescan,
+    preprocessing: dict or None, settings of the despike and gas blank subtraction applied to matrices (see
+    Preprocessor)
+    """
+    __slots__ = ()
+
+    def matrix(self, element):
+        """
+        :param element: str, element header (e.g. 'Fe56')
+        :return: ndarray, matrix of the element (time as rows, linescans as columns)
+        """
+        return self.matrices[self.elements.index(element)].T
+
+    def metadata(self):
+        """
+        :return: dict, metadata stored in binary containers
+        """
+        spotsize_path = os.path.abspath(self.folder)
+        metadata = {'sample': os.path.basename(os.path.dirname(spotsize_path)),
+                    'spotsize': os.path.basename(spotsize_path),
+                    'files': [os.path.basename(csv_file) for csv_file in self.files], 'lines': self.line_metadata}
+        if self.preprocessing:
+            metadata['preprocessing'] = self.preprocessing
+        return metadata
+
+
+def load_linescans(folder, cutoff=3.5, profiler=None, reader=None, preprocessor=None, dtype='float64',
+                   csv_files=None):
+    """
+    Reads all linescans (csv files) of a folder into memory and determines their statistics. Nothing is written to
+    disk (see save_linescans).
+    :param folder: str, path to folder containing the SMPL.csv files (e.g. <sample>/<spotsize>)
+    :param cutoff: float, values with a modified Z-score above cutoff are outliers
+    :param profiler: Profiler or None, profiler recording the stages
+    :param reader: PrefetchReader or None, reader of the csv files (default: PrefetchReader())
+    :param preprocessor: Preprocessor or None, despike and gas blank subtraction applied to every linescan before the
+    statistics are determined (None: counts are not changed)
+    :param dtype: str, type of the counts held in memory (one of DTYPES)
+    :param csv_files: list or None, csv files of the folder in numerical order, if the folder was already listed
+    (see find_csv_files; None: the folder is listed here)
+    :return: LinescanResult
+    """
+    folder = os.path.abspath(folder)
+    profiler = profiler or Profiler(enabled=False)
+
+    # Determines csv files with the spotsize folder
+    logger.info("    Sorting csv files numerically")
+    with profiler.stage('sort_csv_files') as stage:
+        sorted_csv_files = find_csv_files(folder) if csv_files is None else csv_files
+        stage.rows = len(sorted_csv_files)
+
+    # Read linescans and determine elements measured
+    logger.info("    Reading linescans and determining elements")
+    with profiler.stage('stack_linescans') as stage:
+        matrices, time_points, time_label, linescans, elements, line_metadata = stack_linescans(
+            sorted_csv_files, reader=reader, dtype=dtype)
+        stage.rows = int(numpy.prod(matrices.shape[1:]))
+
+    # Despike and subtract the gas blank of every linescan of every element in one batched pass
+    preprocessing = None
+    if preprocessor is not None and preprocessor.enabled:
+        logger.info("    Despiking and subtracting gas blanks")
+        with profiler.stage('preprocess') as stage:
+            matrices = preprocessor.apply(matrices, axis=-1)
+            preprocessing = preprocessor.settings()
+            stage.rows = int(numpy.prod(matrices.shape[1:]))
+
+    # Determining statistics
+    logger.info("    Determining statistics")
+    with profiler.stage('compute_stats') as stage:
+        stats = compute_stats(matrices, cutoff=cutoff)
+        stage.rows = int(numpy.prod(matrices.shape[1:]))
+
+    return LinescanResult(folder=folder, matrices=matrices, time=time_points, time_label=time_label,
+                          elements=elements, linescans=linescans, stats=stats, files=sorted_csv_files,
+                          line_metadata=line_metadata, preprocessing=preprocessing)
+
+
+def save_linescans(result, fmt='csv', out_path=None, profiler=None, precision=None):
+    """
+    Writes linescans to the output folder: element matrices (or one binary container) and average.csv
+    :param result: LinescanResult, linescans returned by load_linescans
+    :param fmt: str, output format (one of FORMATS)
+    :param out_path: str or None, output folder (default: output folder within the folder of the linescans, or where
+    it would be extracted to if it is inside an archive)
+    :param profiler: Profiler or None, profiler recording the stages
+    :param precision: int or None, number of significant digits of the counts and averages in csv output (None: full
+    precision)
+    :return: list of files written
+    """
+    out_path = out_path or os.path.join(extracted_path(result.folder), 'output')
+    profiler = profiler or Profiler(enabled=False)
+    os.makedirs(out_path, exist_ok=True)
+    rows = int(numpy.prod(result.matrices.shape[1:]))
+
+    # Write element data into separate files or one container
+    if fmt != 'csv':
+        logger.info(f"    Writing results to {fmt} container")
+        with profiler.stage('write_linescan_container') as stage:
+            metadata = result.metadata()
+            name = f"{metadata['sample']}_{metadata['spotsize']}"
+            container = write_linescan_container(os.path.join(out_path, name), fmt, result.matrices, result.time,
+                                                 result.linescans, result.elements, metadata)
+            stage.rows = rows
+        logger.info(f'    Data written to {container}')
+        written = [container]
+    else:
+        logger.info("    Writing results to separate element files")
+        with profiler.stage('write_all_results') as stage:
+            write_all_results(result.matrices, result.time, result.linescans, out_path, result.elements,
+                              time_label=result.time_label, precision=precision)
+            stage.rows = rows
+        written = [matrix_file_path(out_path, element)[1] for element in result.elements]
+
+    with profiler.stage('write_stats'):
+        write_stats(result.stats, result.linescans, out_path, result.elements, precision=precision)
+    written.append(os.path.join(out_path, 'average.csv'))
+
+    return written
+
+
+def discover_folders(work_path):
+    """
+    Determines the (sample, spotsize) folders to process: every sub-folder of a sample folder that contains csv files.
+    In a zip or tar archive, every folder containing csv files is a spotsize folder and the path of its parent folder
+    within the archive is the sample (e.g. example_data/sample_A).
+    :param work_path: str, path to data folder containing one folder per sample, or to an archive
+    :return: list of (sample, spotsize) tuples, sorted by name
+    """
+    if is_archive(work_path):
+        folders = [os.path.relpath(folder, work_path) for folder in archive_folders(work_path)]
+        return sorted(os.path.split(folder) for folder in folders if folder != os.curdir)
+
+    def entries(path, directories):
+        with os.scandir(path) as scan:
+            return sorted(entry.name for entry in scan if (entry.is_dir() if directories else entry.is_file()))
+
+    folders = []
+    for sample in entries(work_path, directories=True):
+        sample_path = os.path.join(work_path, sample)
+        for spotsize in entries(sample_path, directories=True):
+            spotsize_path = os.path.join(sample_path, spotsize)
+            if any(name.endswith('.csv') for name in entries(spotsize_path, directories=False)):
+                folders.append((sample, spotsize))
+    return folders
+
+
+# Number of values per block when the element matrices of stream_linescans are transposed (8 MB of float64)
+STREAM_BLOCK_VALUES = 1 << 20
+
+
+def stream_linescans(folder, out_path=None, cutoff=3.5, profiler=None, precision=None, reader=None,
+                     preprocessor=None, dtype='float64', csv_files=None):
+    """
+    Formats the linescans of a folder with bounded memory: linescans are read one at a time, their statistics are
+    determined per linescan and their counts are appended to one binary spill file per element (all held open at the
+    same time). The element matrices (time vs line#) are then written from the spill files in blocks of rows, so peak
+    memory depends on the size of one linescan rather than on the number of linescans. Only csv output is supported.
+    :param folder: str, path to folder containing the SMPL.csv files (e.g. <sample>/<spotsize>)
+    :param out_path: str or None, output folder (default: output folder within the folder of the linescans, or where
+    it would be extracted to if it is inside an archive)
+    :param cutoff: float, values with a modified Z-score above cutoff are outliers
+    :param profiler: Profiler or None, profiler recording the stages
+    :param precision: int or None, number of significant digits of the counts and averages in csv output (None: full
+    precision)
+    :param reader: PrefetchReader or None, reader of the csv files (default: PrefetchReader())
+    :param preprocessor: Preprocessor or None, despike and gas blank subtraction applied to every linescan
+    :param dtype: str, type of the counts (one of DTYPES; also the type of the spill files)
+    :param csv_files: list or None, csv files of the folder in numerical order, if the folder was already listed
+    (see find_csv_files; None: the folder is listed here)
+    :return: list of files written
+    """
+    folder = os.path.abspath(folder)
+    out_path = out_path or os.path.join(extracted_path(folder), 'output')
+    profiler = profiler or Profiler(enabled=False)
+    os.makedirs(out_path, exist_ok=True)
+
+    logger.info("    Sorting csv files numerically")
+    with profiler.stage('sort_csv_files') as stage:
+        if csv_files is None:
+            csv_files = find_csv_files(folder)
+        stage.rows = len(csv_files)
+    linescans = list(range(1, len(csv_files) + 1))
+
+    with tempfile.TemporaryDirectory(dir=out_path) as spill_dir, ExitStack() as stack:
+        # Read linescans one at a time, determine their statistics and spill their counts to disk
+        logger.info("    Streaming linescans and determining statistics")
+        with profiler.stage('stream_linescans') as stage:
+            elements = []
+            time_values = []
+            time_label = 'Time [Sec]'
+            n_samples = 0
+            spill_files = []
+            line_stats = []
+            for smpl in read_smpl_files(csv_files, reader=reader):
+                if not spill_files:
+                    elements, time_label, n_samples = smpl.elements, smpl.time_label, len(smpl.time)
+                    time_values = smpl.time.tolist()
+                    spill_files = [stack.enter_context(open(os.path.join(spill_dir, str(index)), 'wb'))
+                                   for index in range(len(elements))]
+
+                # Samples are aligned on the rows of the first linescan (as in stack_linescans)
+                line = numpy.full((len(elements), n_samples), numpy.nan, dtype=dtype)
+                n_line = min(len(smpl.data), n_samples)
+                line[:, :n_line] = element_columns(smpl, elements)[:n_line].T
+                if preprocessor is not None:
+                    line = preprocessor.apply(line, axis=-1)
+                line_stats.append(compute_stats(line[:, None, :], cutoff=cutoff))
+                for spill_file, values in zip(spill_files, line):
+                    values.tofile(spill_file)
+                stage.rows += n_samples
+            for spill_file in spill_files:
+                spill_file.close()
+
+        # Statistics of all linescans (only a few numbers per linescan are kept in memory)
+        if line_stats:
+            average = numpy.concatenate([stats.average for stats in line_stats], axis=1)
+            stats = LinescanStats(average=average,
+                                  stddev=numpy.concatenate([stats.stddev for stats in line_stats], axis=1),
+                                  outliers=numpy.concatenate([stats.outliers for stats in line_stats], axis=1),
+                                  total_average=numpy.mean(average, axis=-1), total_stddev=numpy.std(average, axis=-1))
+        else:
+            empty = numpy.empty((0, 0))
+            stats = LinescanStats(average=empty, stddev=empty, outliers=empty, total_average=numpy.empty(0),
+                                  total_stddev=numpy.empty(0))
+
+        # Transpose the spill files into element matrices, a block of rows at a time
+        logger.info("    Writing results to separate element files")
+        written = []
+        with profiler.stage('write_all_results') as stage:
+            columns = ['line_' + str(line) for line in linescans]
+            block_rows = max(1, STREAM_BLOCK_VALUES // max(1, len(linescans)))
+            for element_index, element in enumerate(elements):
+                symbol, output_file = matrix_file_path(out_path, element)
+                spill = numpy.memmap(os.path.join(spill_dir, str(element_index)), dtype=dtype, mode='r',
+                                     shape=(len(linescans), n_samples))
+                with open_output(output_file) as W:
+                    W.write('{}\n'.format(','.join([time_label] + columns)))
+                    for start in range(0, n_samples, block_rows):
+                        write_matrix_rows(W, time_values[start:start + block_rows],
+                                          spill[:, start:start + block_rows].T, precision=precision)
+                del spill
+                written.append(output_file)
+                logger.info(f'    Data for {symbol} written to {output_file}')
+            stage.rows = len(linescans) * n_samples
+
+    with profiler.stage('write_stats'):
+        write_stats(stats, linescans, out_path, elements, precision=precision)
+    written.append(os.path.join(out_path, 'average.csv'))
+
+    return written
+
+
+def process_folder(work_path, sample, spotsize, fmt='csv', profile=False, streaming=False, precision=None,
+                   reader=None, preprocessor=None, dtype='float64'):
+    """
+    Formats the linescans of one sample/spotsize folder and determines their statistics
+    :param work_path: str, path to data folder
+    :param sample: str, name of sample folder
+    :param spotsize: str, name of spotsize folder
+    :param fmt: str, output format (one of FORMATS)
+    :param profile: bool, if True the pipeline stages are profiled
+    :param streaming: bool, if True linescans are processed one at a time with bounded memory (csv output only)
+    :param precision: int or None, number of significant digits of the counts and averages in csv output (None: full
+    precision)
+    :param reader: PrefetchReader or None, reader of the csv files (default: PrefetchReader())
+    :param preprocessor: Preprocessor or None, despike and gas blank subtraction applied to every linescan
+    :param dtype: str, type of the counts held in memory (one of DTYPES)
+    :return: (str, float, list), path of the folder processed, processing time in seconds and profiled stages
+    """
+    start = time.perf_counter()
+    profiler = Profiler(enabled=profile)
+    spotsize_path = os.path.join(work_path, sample, spotsize)
+    logger.info(f"Formating results in folder: {spotsize_path}")
+
+    # List the linescans once and flag missing or duplicate linescans before anything is parsed
+    index = scan_folder(spotsize_path, extension='.csv')
+    for problem in sequence_problems(index):
+        logger.warning(f"    {problem}")
+
+    if streaming:
+        stream_linescans(spotsize_path, profiler=profiler, precision=precision, reader=reader,
+                         preprocessor=preprocessor, dtype=dtype, csv_files=index.files)
+    else:
+        result = load_linescans(spotsize_path, profiler=profiler, reader=reader, preprocessor=preprocessor,
+                                dtype=dtype, csv_files=index.files)
+        save_linescans(result, fmt=fmt, profiler=profiler, precision=precision)
+
+    return spotsize_path, time.perf_counter() - start, profiler.records()
+
+
+def process_all_folders(work_path, folders, fmt='csv', jobs=1, profiler=None, streaming=False, precision=None,
+                        reader=None, preprocessor=None, dtype='float64'):
+    """
+    Processes sample/spotsize folders, optionally in a pool of worker processes. A failure in one folder is logged
+    and does not stop the other folders from being processed.
+    :param work_path: str, path to data folder
+    :param folders: list of (sample, spotsize) tuples
+    :param fmt: str, output format (one of FORMATS)
+    :param jobs: int, number of worker processes (0 = all cores, 1 = process in the current process)
+    :param profiler: Profiler or None, if given the stages of all folders are profiled and added to it
+    :param streaming: bool, if True linescans are processed one at a time with bounded memory (csv output only)
+    :param precision: int or None, number of significant digits of the counts and averages in csv output (None: full
+    precision)
+    :param reader: PrefetchReader or None, reader of the csv files (default: PrefetchReader())
+    :param preprocessor: Preprocessor or None, despike and gas blank subtraction applied to every linescan
+    :param dtype: str, type of the counts held in memory (one of DTYPES)
+    :return: list of (sample, spotsize) tuples that failed
+    """
+    failed = []
+    total = len(folders)
+    profile = profiler is not None and profiler.enabled
+
+    def report(done, folder, future_result):
+        try:
+            spotsize_path, elapsed, stages = future_result()
+            logger.success(f"[{done}/{total}] Finished {spotsize_path} in {elapsed:.2f} s")
+            for record in stages:
+                profiler.add(record)
+        except Exception as error:
+            failed.append(folder)
+            logger.error(f"[{done}/{total}] Failed to process {os.path.join(work_path, *folder)}: "
+                         f"{type(error).__name__}: {error}")
+
+    if jobs == 1 or total < 2:
+        for done, folder in enumerate(folders, start=1):
+            report(done, folder, lambda: process_folder(work_path, *folder, fmt=fmt, profile=profile,
+                                                        streaming=streaming, precision=precision, reader=reader,
+                                                        preprocessor=preprocessor, dtype=dtype))
+        return failed
+
+    # Imported here as it is only needed with --jobs and adds noticeably to the startup time
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    workers = jobs if jobs > 0 else os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_folder, work_path, *folder, fmt=fmt, profile=profile,
+                                   streaming=streaming, precision=precision, reader=reader,
+                                   preprocessor=preprocessor, dtype=dtype): folder
+                   for folder in folders}
+        for done, future in enumerate(as_completed(futures), start=1):
+            report(done, futures[future], future.result)
+
+    return failed
 
 
 def main():
-    valid_input = input_validation(input_args=sys.argv)
+    args = parse_arguments(sys.argv[1:])
+    valid_input = input_validation(input_args=args)
 
     if not valid_input:
         sys.exit()
     else:
-        work_path = os.path.abspath(sys.argv[1])
-
-    # Determines sample sub-folders
-    dir_structure = [x[1] for x in os.walk(work_path)]
-    for parent_dir in dir_structure[0]:
-        current_dir = os.path.join(work_path, parent_dir)
-        # Determine spotsize folders
-        for spotsize in dir_structure[1]:
-            spotsize_path = os.path.join(current_dir, spotsize)
-            logger.info(f"Formating results in folder: {spotsize_path}")
-            out_path = os.path.join(spotsize_path, 'output')
-            if not os.path.isdir(out_path):
-                os.mkdir(out_path)
-
-            # Determines csv files with the spotsize folder
-            logger.info("    Sorting csv files numerically")
-            csv_files = [csv_file for csv_file in os.listdir(spotsize_path) if csv_file.endswith(".csv")]
-            sorted_csv_files = sorted(csv_files, key=numeric_filename)
-            sorted_csv_files = [os.path.join(spotsize_path, text_file) for text_file in sorted_csv_files]
-
-            # Determine elements measured
-            logger.info("    Determining elements")
-            elements = element_determination(sorted_csv_files[0])
-
-            # Write element data into separate files
-            logger.info("    Writing results to separate element files")
-            results_df = store_data_in_df(sorted_csv_files)
-            write_all_results(results_df, out_path, elements)
-
-            # Determining statistics
-            logger.info("    Determining statistics")
-            calculate_stats(out_path, elements)
+        work_path = os.path.abspath(args.path_to_data_folder)
+
+    # Determines sample/spotsize sub-folders
+    folders = discover_folders(work_path)
+    logger.info(f"Found {len(folders)} sample/spotsize folders in {work_path}")
+
+    profiler = Profiler(enabled=args.profile or bool(args.profile_report) or bool(args.cprofile),
+                        cprofile_path=args.cprofile)
+    profiler.start()
+    start = time.perf_counter()
+    failed = process_all_folders(work_path, folders, fmt=args.format, jobs=args.jobs, profiler=profiler,
+                                 streaming=args.streaming, precision=args.precision,
+                                 reader=PrefetchReader(depth=args.prefetch,
+                                                       max_bytes=int(args.prefetch_memory * 2 ** 20)),
+                                 preprocessor=Preprocessor(despike_window=args.despike,
+                                                           despike_threshold=args.despike_threshold,
+                                                           blank_samples=args.blank),
+                                 dtype=args.dtype)
+    logger.info(f"Processed {len(folders) - len(failed)} of {len(folders)} folders in "
+                f"{time.perf_counter() - start:.2f} s")
+
+    profiler.finish()
+    if profiler.enabled:
+        for line in profiler.summary_table():
+            logger.info(line)
+        if args.profile_report:
+            profiler.write_report(args.profile_report, tool='format_icpms_linescans', arguments=vars(args),
+                                  folders=[os.path.join(*folder) for folder in folders])
+            logger.info(f'Profile report written to {args.profile_report}')
+        if args.cprofile:
+            logger.info(f'cProfile statistics written to {args.cprofile}')
+    if failed:
+        logger.error(f"Failed folders: {', '.join(os.path.join(*folder) for folder in failed)}")
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,238 @@
+#######################################################################
+# April 2018 - David Kuter                                            #
+#                                                                     #
+# Script to extract counts from LA-ICP-MS data (SMPL.csv files)       #
+# of reference samples with different spot sizes                      #
+#######################################################################
+
+import argparse
+import os
+import sys
+import time
+
+from format_icpms_linescans import discover_folders, find_csv_files, matrix_file_path, stack_linescans, \
+    write_matrix_rows
+from icpms_common import DTYPES, LazyObject, extracted_path, is_archive, lazy_import, open_output
+
+# Heavy dependencies are imported on first use, so that usage errors and --help return immediately
+numpy = lazy_import('numpy')
+logger = LazyObject('loguru', 'logger')
+
+# Number of samples at the start of each linescan that are not included in the line averages
+SKIPPED_SAMPLES = 1
+
+# Number of decimals of the reference averages and standard deviations
+AVERAGE_DECIMALS = 3
+
+
+def parse_arguments(input_args):
+    """
+    Parses command line arguments
+    :param input_args: list of arguments (excluding the program name)
+    :return: argparse.Namespace with attributes path_to_data_folder, jobs, dtype and precision
+    """
+    parser = argparse.ArgumentParser(prog='format_ref_data',
+                                     description='Formats LA-ICP-MS line-scan csv files of reference samples into '
+                                                 'separate elemental matrix files and determines the average counts '
+                                                 'per element and spot size')
+    parser.add_argument('path_to_data_folder', nargs='?', default='.',
+                        help='folder (or zip or tar archive) containing one folder per reference sample, each with '
+                             'one folder per spot size (default: current folder)')
+    parser.add_argument('--jobs', type=int, default=0,
+                        help='number of sample/spotsize folders processed in parallel (0 = all cores, default: 0)')
+    parser.add_argument('--dtype', choices=DTYPES, default='float64',
+                        help='type of the counts held in memory: float32 halves the memory of the counts, which are '
+                             'then written with float32 precision (9 significant digits; averages are accumulated in '
+                             'float64; default: float64)')
+    parser.add_argument('--precision', type=int, default=None,
+                        help='number of significant digits of the counts written to the element matrices (default: '
+                             'full precision)')
+    return parser.parse_args(input_args)
+
+
+def input_validation(input_args):
+    """
+    Validates input arguments
+    :param input_args: argparse.Namespace, arguments returned by parse_arguments
+    :return: False if not valid, else True is returned
+    """
+    # Determine if number of jobs is valid
+    if input_args.jobs < 0:
+        logger.critical(f'Number of jobs ("{input_args.jobs}") must be 0 (all cores) or a positive number')
+        return False
+
+    # Determine if the precision is valid
+    if input_args.precision is not None and input_args.precision < 1:
+        logger.critical(f'Precision ("{input_args.precision}") must be a positive number of significant digits')
+        return False
+
+    # Determine if directory (or archive) specified exists
+    if not os.path.isdir(input_args.path_to_data_folder) and not is_archive(input_args.path_to_data_folder):
+        logger.critical(f'Directory "{input_args.path_to_data_folder}" does not exist')
+        return False
+
+    return True
+
+
+def reference_averages(matrices, skipped=SKIPPED_SAMPLES):
+    """
+    Determines the reference counts of all elements at once: the average of each linescan (without its first samples)
+    and the average and standard deviation of these line averages
+    :param matrices: ndarray, counts of shape (element x line x sample)
+    :param skipped: int, number of samples at the start of each linescan that are not included in the line averages
+    :return: (ndarray, ndarray), average and standard deviation of the line averages per element (accumulated in
+    float64, also for float32 counts)
+    """
+    line_averages = numpy.nanmean(matrices[:, :, skipped:], axis=-1, dtype=numpy.float64)
+    return numpy.mean(line_averages, axis=-1), numpy.std(line_averages, axis=-1)
+
+
+def write_reference_matrices(matrices, time, working_dir, elements, precision=None):
+    """
+    Writes one matrix file (time vs line#, without header) per element
+    :param matrices: ndarray, counts of shape (element x line x sample)
+    :param time: ndarray, times of the first linescan
+    :param working_dir: str, path to output folder
+    :param elements: list, list of elements
+    :param precision: int or None, number of significant digits of the counts (None: full precision)
+    :return: list of files written
+    """
+    time_values = numpy.asarray(time).tolist()
+    written = []
+    for element_index, element in enumerate(elements):
+        symbol, output_file = matrix_file_path(working_dir, element)
+        with open_output(output_file) as W:
+            write_matrix_rows(W, time_values, matrices[element_index].T, precision=precision)
+        written.append(output_file)
+    return written
+
+
+def write_reference_averages(path, symbols, average, std):
+    """
+    Writes the reference averages of one sample/spotsize folder to average.csv
+    :param path: str, path of average.csv
+    :param symbols: list, element symbols
+    :param average: ndarray, average per element
+    :param std: ndarray, standard deviation per element
+    """
+    with open_output(path) as j:
+        j.write('element,average,std\n')
+        j.write(''.join('{},{:.{decimals}f},{:.{decimals}f}\n'.format(symbol, ave, sd, decimals=AVERAGE_DECIMALS)
+                        for symbol, ave, sd in zip(symbols, average.tolist(), std.tolist())))
+
+
+def process_folder(work_path, sample, spotsize, precision=None, dtype='float64'):
+    """
+    Formats the linescans of one reference sample/spotsize folder and determines its reference averages
+    :param work_path: str, path to data folder
+    :param sample: str, name of sample folder
+    :param spotsize: str, name of spotsize folder
+    :param precision: int or None, number of significant digits of the counts (None: full precision)
+    :param dtype: str, type of the counts held in memory (one of DTYPES)
+    :return: (str, float, list), path of the folder processed, processing time in seconds and (element symbol,
+    average, standard deviation) of each element
+    """
+    start = time.perf_counter()
+    spotsize_path = os.path.join(work_path, sample, spotsize)
+    out_path = os.path.join(extracted_path(spotsize_path), 'output')
+    os.makedirs(out_path, exist_ok=True)
+
+    matrices, time_points, _, _, elements, _ = stack_linescans(find_csv_files(spotsize_path), dtype=dtype)
+    write_reference_matrices(matrices, time_points, out_path, elements, precision=precision)
+
+    symbols = [matrix_file_path(out_path, element)[0] for element in elements]
+    average, std = reference_averages(matrices)
+    write_reference_averages(os.path.join(out_path, 'average.csv'), symbols, average, std)
+
+    return spotsize_path, time.perf_counter() - start, list(zip(symbols, average.tolist(), std.tolist()))
+
+
+def process_all_folders(work_path, folders, jobs=0, precision=None, dtype='float64'):
+    """
+    Processes reference sample/spotsize folders in a pool of worker processes. A failure in one folder is logged and
+    does not stop the other folders from being processed.
+    :param work_path: str, path to data folder
+    :param folders: list of (sample, spotsize) tuples
+    :param jobs: int, number of worker processes (0 = all cores, 1 = process in the current process)
+    :param precision: int or None, number of significant digits of the counts (None: full precision)
+    :param dtype: str, type of the counts held in memory (one of DTYPES)
+    :return: (dict, list), (sample, spotsize) -> reference averages (see process_folder) of each folder processed and
+    (sample, spotsize) tuples that failed
+    """
+    averages = {}
+    failed = []
+    total = len(folders)
+
+    def report(done, folder, future_result):
+        try:
+            spotsize_path, elapsed, averages[folder] = future_result()
+            logger.success(f"[{done}/{total}] Finished {spotsize_path} in {elapsed:.2f} s")
+        except Exception as error:
+            failed.append(folder)
+            logger.error(f"[{done}/{total}] Failed to process {os.path.join(work_path, *folder)}: "
+                         f"{type(error).__name__}: {error}")
+
+    if jobs == 1 or total < 2:
+        for done, folder in enumerate(folders, start=1):
+            report(done, folder, lambda: process_folder(work_path, *folder, precision=precision, dtype=dtype))
+        return averages, failed
+
+    # Imported here as it is only needed with --jobs and adds noticeably to the startup time
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    workers = jobs if jobs > 0 else os.cpu_count()
+    with ProcessPoolExecutor(max_workers=min(workers, total)) as executor:
+        futures = {executor.submit(process_folder, work_path, *folder, precision=precision, dtype=dtype): folder
+                   for folder in folders}
+        for done, future in enumerate(as_completed(futures), start=1):
+            report(done, futures[future], future.result)
+
+    return averages, failed
+
+
+def write_summary(path, folders, averages):
+    """
+    Writes the reference averages of all sample/spotsize folders to one file
+    :param path: str, path of summary
+    :param folders: list of (sample, spotsize) tuples (in output order)
+    :param averages: dict, (sample, spotsize) -> reference averages returned by process_folder
+    """
+    with open_output(path) as j:
+        j.write('sample,spotsize,element,average,std\n')
+        for folder in folders:
+            j.write(''.join('{},{},{},{:.{decimals}f},{:.{decimals}f}\n'.format(
+                *folder, symbol, ave, sd, decimals=AVERAGE_DECIMALS) for symbol, ave, sd in averages.get(folder, [])))
+
+
+def main():
+    args = parse_arguments(sys.argv[1:])
+    valid_input = input_validation(input_args=args)
+
+    if not valid_input:
+        sys.exit()
+    else:
+        work_path = os.path.abspath(args.path_to_data_folder)
+
+    # Determines sample/spotsize sub-folders
+    folders = discover_folders(work_path)
+    logger.info(f"Found {len(folders)} sample/spotsize folders in {work_path}")
+
+    start = time.perf_counter()
+    averages, failed = process_all_folders(work_path, folders, jobs=args.jobs, precision=args.precision,
+                                           dtype=args.dtype)
+    logger.info(f"Processed {len(folders) - len(failed)} of {len(folders)} folders in "
+                f"{time.perf_counter() - start:.2f} s")
+
+    # The summary of an archive is written to the folder it would be extracted to
+    summary_path = os.path.join(os.path.dirname(work_path) if is_archive(work_path) else work_path,
+                                'reference_averages.csv')
+    write_summary(summary_path, folders, averages)
+    logger.info(f"Reference averages written to {summary_path}")
+
+    if failed:
+        logger.error(f"Failed folders: {', '.join(os.path.join(*folder) for folder in failed)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,12 @@
+import os
+import sys
+
+# format_icpms_linescans/__init__.py makes this folder a package that shadows the module in src when the tests are run
+# from the root of the repository, so the module is looked up in src first
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+if SRC in sys.path:
+    sys.path.remove(SRC)
+sys.path.insert(0, SRC)
+module = sys.modules.get('format_icpms_linescans')
+if module is not None and os.path.dirname(getattr(module, '__file__', None) or '') != SRC:
+    del sys.modules['format_icpms_linescans']
@@ -0,0 +1,26 @@
+import glob
+import os
+
+import numpy
+import pytest
+
+from format_icpms_linescans import compute_stats, find_csv_files, stack_linescans
+from icpms_common import FLOAT32_TOLERANCE
+
+EXAMPLE_FOLDERS = sorted(glob.glob(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                'example_data', '*', '*')))
+
+
+@pytest.mark.parametrize('folder', EXAMPLE_FOLDERS, ids=os.path.basename)
+def test_float32_stats_match_float64_stats(folder):
+    csv_files = find_csv_files(folder)
+    reference = compute_stats(stack_linescans(csv_files, dtype='float64')[0])
+    compact_matrices = stack_linescans(csv_files, dtype='float32')[0]
+    assert compact_matrices.dtype == numpy.float32
+    compact = compute_stats(compact_matrices)
+
+    # The same values are rejected as outliers, so the averages only differ by the rounding of the counts
+    numpy.testing.assert_array_equal(compact.outliers, reference.outliers)
+    for field in ('average', 'stddev', 'total_average', 'total_stddev'):
+        numpy.testing.assert_allclose(getattr(compact, field), getattr(reference, field), rtol=FLOAT32_TOLERANCE,
+                                      atol=0, err_msg=field)
@@ -8,7 +8,7 @@ setuptools.setup(
     description="Tool to format LA-ICP-MS data",
     long_description="Formats LA-ICP-MS csv files into separate elemental matrix files for 2D contour plotting",
     url="https://github.com/davidkuter/ICP-MS/tree/master/",
-    packages=setuptools.find_packages('src'),
+    py_modules=['format_icpms_map_data'],
     package_dir={'': 'src'},
     include_package_data=True,
     entry_points={'console_scripts': ['format_icpms_map_data = format_icpms_map_data:main']},
@@ -1,185 +1,1279 @@
+import argparse
+import csv
+import glob
+import json
 import os
-import pandas as pd
 import sys
+import time
+
+from collections import deque, namedtuple
+from contextlib import ExitStack
+from decimal import Decimal
+from itertools import islice
+from icpms_common import (DESPIKE_THRESHOLD, DTYPES, FORMATS, PREFETCH_BYTES, PREFETCH_DEPTH, PYRAMID_METHODS,
+                          PYRAMID_TILE_SIZE, ParseCache, PrefetchReader, Preprocessor, Profiler, RepeatedColumn,
+                          archive_folders, extracted_path, file_sort_key, format_available, format_rows, is_archive,
+                          lazy_import, member_size, numeric_prefix, open_output, read_smpl, read_smpl_files,
+                          scan_folder, sequence_problems, split_archive_path, write_container, write_pyramid,
+                          write_rows)
+
+# numpy is imported on first use, so that usage errors and --help return immediately
+numpy = lazy_import('numpy')
+
+# How lines of different length are made the same length (see regularize_lines)
+RAGGED_POLICIES = ('pad', 'truncate')
+
+# Maximum number of lines listed by ragged_report
+RAGGED_LISTED = 10
+
+
+def parse_arguments(input_args):
+    """
+    Parses command line arguments
+    :param input_args: list of arguments (excluding the program name)
+    :return: argparse.Namespace with attributes path_to_data_folder, x_step_size, y_step_size, manifest, summary, jobs,
+    no_alldata, format, pyramid, tile_size, streaming, ragged, despike, despike_threshold, blank, dtype, precision,
+    prefetch, prefetch_memory, no_cache, watch, poll_interval, idle_timeout, profile, profile_report and cprofile
+    """
+    parser = argparse.ArgumentParser(prog='format_icpms_map_data',
+                                     description='Formats LA-ICP-MS csv files into separate elemental matrix files')
+    parser.add_argument('path_to_data_folder',
+                        help='map folder, root folder containing map folders (e.g. .b batch folders), zip or tar '
+                             'archive of map folders, or glob pattern of map folders or archives (quote it so that '
+                             'the shell does not expand it)')
+    parser.add_argument('x_step_size', nargs='?', default=None,
+                        help='step size in x direction (for folders not listed in --manifest)')
+    parser.add_argument('y_step_size', nargs='?', default=None,
+                        help='step size in y direction (for folders not listed in --manifest)')
+    parser.add_argument('--manifest', metavar='FILE', default=None,
+                        help='csv file with the columns folder, x_step and y_step giving the step sizes of each map '
+                             'folder')
+    parser.add_argument('--summary', metavar='FILE', default=None,
+                        help='write a JSON summary of the successes, failures and throughput of all folders to FILE')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of worker processes used to parse the csv files (0 = all cores, default: 1)')
+    parser.add_argument('--no-alldata', action='store_true',
+                        help='do not write output/alldata.csv (element matrices are written regardless)')
+    parser.add_argument('--format', choices=FORMATS, default='csv',
+                        help='output format: csv files (default) or one compressed npz/parquet/hdf5 container '
+                             'holding every element matrix')
+    parser.add_argument('--pyramid', choices=PYRAMID_METHODS, default=None,
+                        help='also write output/<folder>.pyramid, a tiled multi-resolution pyramid of every element '
+                             'matrix (downsampled 2x, 4x, 8x, ... by mean or max pooling) for fast previews')
+    parser.add_argument('--tile-size', type=int, default=PYRAMID_TILE_SIZE,
+                        help='number of rows and columns of the tiles of --pyramid (default: {})'.format(
+                            PYRAMID_TILE_SIZE))
+    parser.add_argument('--streaming', action='store_true',
+                        help='parse and write one line at a time so that memory does not grow with the size of the '
+                             'map (csv output only)')
+    parser.add_argument('--ragged', choices=RAGGED_POLICIES, default=None,
+                        help='lines of different length are padded with NaN to the longest line (pad, default) or '
+                             'cut to the shortest line (truncate); not supported with --streaming and --watch, which '
+                             'fit every line to the first line')
+    parser.add_argument('--despike', metavar='WINDOW', type=int, default=0,
+                        help='replace spikes by the rolling median of a window of WINDOW samples (odd) along each '
+                             'line (0 = no despike, default: 0)')
+    parser.add_argument('--despike-threshold', type=float, default=DESPIKE_THRESHOLD,
+                        help='modified Z-score (relative to the rolling median) above which a sample is a spike '
+                             '(default: {})'.format(DESPIKE_THRESHOLD))
+    parser.add_argument('--blank', metavar='SAMPLES', type=int, default=0,
+                        help='subtract the gas blank of each line, the average of its first SAMPLES samples '
+                             '(0 = no gas blank subtraction, default: 0)')
+    parser.add_argument('--dtype', choices=DTYPES, default='float64',
+                        help='type of the counts held in memory: float32 halves the memory of the counts, which are '
+                             'then written with float32 precision (9 significant digits; default: float64)')
+    parser.add_argument('--precision', type=int, default=None,
+                        help='number of significant digits of the counts written to csv files (default: full '
+                             'precision, i.e. the shortest number that reads back as the same value)')
+    parser.add_argument('--prefetch', type=int, default=PREFETCH_DEPTH,
+                        help='number of csv files read ahead in threads while a file is parsed, to hide the latency '
+                             'of network storage (0 = no read ahead, default: {})'.format(PREFETCH_DEPTH))
+    parser.add_argument('--prefetch-memory', metavar='MB', type=float, default=PREFETCH_BYTES / 2 ** 20,
+                        help='stop reading ahead while the files read ahead hold this many MB (default: {:g})'.format(
+                            PREFETCH_BYTES / 2 ** 20))
+    parser.add_argument('--no-cache', action='store_true',
+                        help='ignore the cache of parsed csv files in output/.cache and parse every file again')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep watching the folder and append each completed csv file (one with a "Printed:" '
+                             'footer) to the csv output while the instrument is still acquiring')
+    parser.add_argument('--poll-interval', type=float, default=2.0,
+                        help='seconds between checks of the folder in watch mode (default: 2)')
+    parser.add_argument('--idle-timeout', type=float, default=None,
+                        help='stop watching after this many seconds without a new completed file '
+                             '(default: watch until interrupted with Ctrl+C)')
+    parser.add_argument('--profile', action='store_true',
+                        help='record wall time, bytes read/written, rows processed and peak memory per stage and '
+                             'print a summary table (bytes read by --jobs worker processes are not included)')
+    parser.add_argument('--profile-report', metavar='FILE', default=None,
+                        help='write the --profile measurements to a JSON file (implies --profile)')
+    parser.add_argument('--cprofile', metavar='FILE', default=None,
+                        help='write cProfile statistics of the run to FILE (implies --profile)')
+    return parser.parse_args(input_args)
 
 
 def input_validation(input_args):
     """
     Validates input arguments
-    :param input_args: list of arguments of type: ['format_icpms_map_data.py', 'path_to_data_folder', 'x_step', 'y_step']
+    :param input_args: argparse.Namespace, arguments returned by parse_arguments
     :return: False if not valid, else True is returned
     """
-    # Determine if number of arguments are correct
-    if len(input_args) != 4:
-        print("Invalid number of arguments. Usage:")
-        print("format_icpms_map_data.py <path_to_data_folder> <x_step_size> <y_step_size>")
+    # Determine if step sizes are provided (on the command line and/or in a manifest)
+    if (input_args.x_step_size is None) != (input_args.y_step_size is None):
+        print('Both the X and Y step size must be given')
+        return False
+    if input_args.x_step_size is None and input_args.manifest is None:
+        print('Step sizes must be given on the command line or in a manifest (--manifest)')
+        return False
+    if input_args.manifest is not None and not os.path.isfile(input_args.manifest):
+        print('Manifest "{}" does not exist'.format(input_args.manifest))
         return False
 
     # Determine if step sizes provided are valid
     try:
-        float(input_args[2])
-        float(input_args[3])
+        if input_args.x_step_size is not None:
+            float(input_args.x_step_size)
+            float(input_args.y_step_size)
     except ValueError:
-        print('X and/or Y step size ("{}" and/or "{}") is not a valid number'.format(input_args[2], input_args[3]))
+        print('X and/or Y step size ("{}" and/or "{}") is not a valid number'.format(input_args.x_step_size,
+                                                                                      input_args.y_step_size))
+        return False
+
+    # Determine if number of jobs is valid
+    if input_args.jobs < 0:
+        print('Number of jobs ("{}") must be 0 (all cores) or a positive number'.format(input_args.jobs))
+        return False
+
+    # Determine if the read ahead settings are valid
+    if input_args.prefetch < 0 or input_args.prefetch_memory <= 0:
+        print('--prefetch must be 0 (no read ahead) or a positive number and --prefetch-memory must be positive')
+        return False
+
+    # Determine if the optional dependency of the output format is installed
+    if not format_available(input_args.format):
+        print('Output format "{}" requires an optional dependency: pip install icpms_common[{}]'.format(
+            input_args.format, input_args.format))
+        return False
+
+    # Watch and streaming mode append rows to csv output, which the binary containers do not support
+    if input_args.watch and input_args.format != 'csv':
+        print('Watch mode only supports csv output')
+        return False
+    if input_args.streaming and input_args.format != 'csv':
+        print('Streaming mode only supports csv output')
+        return False
+
+    # The pyramid is built from the complete map, which streaming and watch mode never hold in memory
+    if input_args.pyramid and (input_args.streaming or input_args.watch):
+        print('--pyramid is not supported with --streaming or --watch')
+        return False
+    if input_args.tile_size < 1:
+        print('Tile size ("{}") must be a positive number'.format(input_args.tile_size))
+        return False
+
+    # Determine if the preprocessing settings are valid
+    if input_args.despike < 0 or (input_args.despike and input_args.despike % 2 == 0) or input_args.despike == 1:
+        print('Despike window ("{}") must be 0 (no despike) or an odd number of samples of at least 3'.format(
+            input_args.despike))
+        return False
+    if input_args.despike_threshold <= 0:
+        print('Despike threshold ("{}") must be positive'.format(input_args.despike_threshold))
+        return False
+    if input_args.blank < 0:
+        print('Number of gas blank samples ("{}") must be 0 (no gas blank subtraction) or a positive number'.format(
+            input_args.blank))
+        return False
+
+    # Determine if the precision is valid (it only applies to csv output)
+    if input_args.precision is not None and input_args.precision < 1:
+        print('Precision ("{}") must be a positive number of significant digits'.format(input_args.precision))
+        return False
+    if input_args.precision is not None and input_args.format != 'csv':
+        print('--precision only applies to csv output')
+        return False
+
+    # Lines written one at a time can only be fitted to the first line
+    if input_args.ragged and (input_args.streaming or input_args.watch):
+        print('--ragged is not supported with --streaming or --watch (every line is fitted to the first line)')
+        return False
+
+    # Determine if directory (or archive) specified exists (glob patterns are expanded later)
+    if not is_glob(input_args.path_to_data_folder) and not os.path.isdir(input_args.path_to_data_folder) and \
+            not is_archive(input_args.path_to_data_folder):
+        print('Directory "{}" does not exist'.format(input_args.path_to_data_folder))
         return False
 
-    # Determine if directory specified exists
-    if not os.path.isdir(input_args[1]):
-        print('Directory "{}" does not exist'.format(input_args[1]))
+    # Watch mode polls a folder for new files, which an archive does not receive
+    if input_args.watch and is_archive(input_args.path_to_data_folder):
+        print('Watch mode does not support archives')
         return False
 
     return True
 
 
-def file_len(fname):
+def numeric_filename(filename):
     """
-    Determines number of rows (length) in file
-    :param fname: str, name of file
-    :return: int, number of rows in file
+    Determines the numeric portion of a filename. E.g. 0123SMPL.csv => 123, 1000SMPL.csv => 1000
+    :param filename: str, name of a file
+    :return: int, numeric portion of filename (None if there is none)
     """
-    with open(fname) as F:
-        for row_num, row_content in enumerate(F):
-            pass
-    return row_num + 1
+    return numeric_prefix(filename)
 
 
-def numeric_filename(filename):
+def index_csv_files(work_path):
     """
-    Determines the numeric portion of a filename. E.g. 0123SMPL.csv => 0123
-    :param filename: str, name of a file
-    :return: int, numeric portion of filename
+    Lists all csv files in folder in numerical order and checks the sequence for missing and duplicate numbers. The
+    ordered listing is cached in output/.cache/index.json and reused until a file is added, removed or renamed.
+    :param work_path: str, path to working directory
+    :return: FileIndex
+    """
+    return scan_folder(work_path, extension='.csv', index_path=os.path.join(work_path, 'output', '.cache',
+                                                                             'index.json'))
+
+
+def find_csv_files(work_path):
+    """
+    Finds all csv files in folder, sorts them by the numerical component and returns them with their full path
+    :param work_path: str, path to working directory
+    :return: list of files (full path)
+    """
+    return index_csv_files(work_path).files
+
+
+def parse_files(file_list, jobs=1, reader=None):
+    """
+    Parses all csv files. If more than one job is requested, files are parsed in a pool of worker processes.
+    Results are always returned in the order of file_list, so the output does not depend on the number of jobs.
+    :param file_list: list, list of files (full path) to parse
+    :param jobs: int, number of worker processes (0 = all cores, 1 = parse in the current process)
+    :param reader: PrefetchReader or None, reader of the csv files when they are parsed in the current process (files
+    are read ahead in threads while the current file is parsed; default: PrefetchReader())
+    :return: iterator of SmplData
     """
-    return filename[:3]
+    # Files inside an archive are read in a single pass over the archive (each worker would have to read it again)
+    if jobs == 1 or len(file_list) < 2 or split_archive_path(file_list[0])[0] is not None:
+        for smpl in read_smpl_files(file_list, reader=reader):
+            yield smpl
+        return
+
+    # Imported here as it is only needed with --jobs and adds noticeably to the startup time
+    from concurrent.futures import ProcessPoolExecutor
 
+    workers = jobs if jobs > 0 else os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Only a few files per worker are parsed ahead of the consumer, so memory stays bounded if the results are
+        # consumed more slowly than they are parsed (e.g. --streaming)
+        files = iter(file_list)
+        pending = deque(executor.submit(read_smpl, csv_file) for csv_file in islice(files, 4 * workers))
+        while pending:
+            smpl = pending.popleft().result()
+            for csv_file in islice(files, 1):
+                pending.append(executor.submit(read_smpl, csv_file))
+            yield smpl
 
-def element_determination(sample_file):
+
+def read_all_files(file_list, jobs=1, cache=None, reader=None):
     """
-    Determines the elements measured in a file
-    :param sample_file: str, filename
-    :return: list of elements
+    Reads all csv files in the order of file_list. If a cache is given, unchanged files are loaded from it and only
+    new or changed files are parsed (and then added to the cache).
+    :param file_list: list, list of files (full path) to read
+    :param jobs: int, number of worker processes used for parsing (0 = all cores)
+    :param cache: ParseCache or None
+    :param reader: PrefetchReader or None, reader of the csv files (default: PrefetchReader())
+    :return: iterator of SmplData
     """
-    with open(sample_file) as F:
-        # Skips unnecessary header
-        for skip in range(0, 3):
-            next(F)
-        element_header = F.readline()
-    return element_header.strip().split(',')[1:]
+    if cache is None:
+        for smpl in parse_files(file_list, jobs=jobs, reader=reader):
+            yield smpl
+        return
 
+    cached = [cache.is_valid(csv_file) for csv_file in file_list]
+    parsed = parse_files([csv_file for csv_file, hit in zip(file_list, cached) if not hit], jobs=jobs, reader=reader)
+    for csv_file, hit in zip(file_list, cached):
+        if hit:
+            yield cache.load(csv_file)
+        else:
+            smpl = next(parsed)
+            cache.store(csv_file, smpl)
+            yield smpl
+    cache.save()
 
-def write_all_results(output_path, file_list, element_list, x_step, y_step, work_path):
+
+def build_map_array(file_list, jobs=1, cache=None, reader=None, dtype='float64'):
+    """
+    Stacks the data of every csv file (one raster line each) into a single 3D array. Each line is copied into the
+    array as soon as it is parsed, so the map is only held in memory once (the array grows if a line is longer than
+    the lines before it).
+    :param file_list: list, sorted list of files (full path) to extract data from
+    :param jobs: int, number of worker processes used to parse the csv files (0 = all cores)
+    :param cache: ParseCache or None, cache of previously parsed files
+    :param reader: PrefetchReader or None, reader of the csv files (default: PrefetchReader())
+    :param dtype: str, type of the counts in the array (one of DTYPES; float32 halves the memory of the map)
+    :return: (ndarray, list, list, list), array of shape (line x sample x element) padded with NaN if lines differ in
+    length, number of samples in each line, list of elements measured and SMPL.csv header information of each line
     """
-    Writes results from all csv files into a single summary file
+    data = numpy.empty((len(file_list), 0, 0), dtype=dtype)
+    line_lengths = []
+    line_metadata = []
+    element_list = None
+    for index, smpl in enumerate(read_all_files(file_list, jobs=jobs, cache=cache, reader=reader)):
+        if element_list is None:
+            element_list = smpl.elements
+            data = numpy.full((len(file_list), len(smpl.data), len(element_list)), numpy.nan, dtype=dtype)
+        if len(smpl.data) > data.shape[1]:
+            padding = numpy.full((len(file_list), len(smpl.data) - data.shape[1], data.shape[2]), numpy.nan,
+                                 dtype=dtype)
+            data = numpy.concatenate([data, padding], axis=1)
+        data[index, :len(smpl.data)] = smpl.data
+        line_lengths.append(len(smpl.data))
+        line_metadata.append(smpl.metadata)
+
+    return data, line_lengths, element_list, line_metadata
+
+
+def step_position(step, index):
+    """
+    Determines a position along an axis as index * step. The product is calculated from the decimal step size, so
+    the position is the float closest to the exact position (e.g. 3 * 0.015 => 0.045) and does not depend on the
+    size of the map.
+    :param step: float, step size
+    :param index: int, number of the position (1 = first position)
+    :return: float, position
+    """
+    return float(Decimal(repr(float(step))) * index)
+
+
+def step_positions(step, count):
+    """
+    Determines positions along an axis (the first position is step, see step_position)
+    :param step: float, step size
+    :param count: int, number of positions
+    :return: list of positions
+    """
+    return [step_position(step, index) for index in range(1, count + 1)]
+
+
+def regularize_lines(data, line_lengths, ragged='pad'):
+    """
+    Makes every line of a map the same length. build_map_array pads shorter lines with NaN to the longest line;
+    with ragged='truncate' every line is cut to the shortest line instead.
+    :param data: ndarray, map data of shape (line x sample x element), padded with NaN
+    :param line_lengths: list, number of samples in each line
+    :param ragged: str, 'pad' or 'truncate'
+    :return: ndarray, map data of shape (line x width x element)
+    """
+    if ragged == 'truncate':
+        return data[:, :min(line_lengths, default=0)]
+    return data
+
+
+def ragged_report(files, line_lengths, width, policy):
+    """
+    Describes lines whose length differs from the width of the map
+    :param files: list, csv file of each line
+    :param line_lengths: list, number of samples in each line
+    :param width: int, number of samples per line in the output
+    :param policy: str, how the lines were made the same length (e.g. 'padded with NaN')
+    :return: list of str, report (empty if all lines have the same length)
+    """
+    ragged = [(csv_file, length) for csv_file, length in zip(files, line_lengths) if length != width]
+    if not ragged:
+        return []
+    listed = ', '.join('{} ({} samples)'.format(os.path.basename(csv_file), length)
+                       for csv_file, length in ragged[:RAGGED_LISTED])
+    if len(ragged) > RAGGED_LISTED:
+        listed += ', ... ({} more)'.format(len(ragged) - RAGGED_LISTED)
+    return ['{} of {} lines differ in length (min {}, max {}) and were {} to {} samples: {}'.format(
+        len(ragged), len(line_lengths), min(line_lengths), max(line_lengths), policy, width, listed)]
+
+
+def write_axes(work_path, x_list, y_list):
+    """
+    Writes x and y positions to x_data.csv and y_data.csv
+    :param work_path: str, path to working directory
+    :param x_list: list, x positions
+    :param y_list: list, y positions
+    """
+    x_file_path = os.path.join(work_path, 'output/x_data.csv')
+    y_file_path = os.path.join(work_path, 'output/y_data.csv')
+    with open(x_file_path, 'w') as gx, open(y_file_path, 'w') as gy:
+        gx.write('\n'.join([str(x) for x in x_list]))
+        gy.write('\n'.join([str(y) for y in y_list]))
+
+
+def write_all_results(output_path, data, element_list, x_list, y_list, precision=None):
+    """
+    Writes results from all lines into a single summary file of x, y and element counts. The x and y columns are
+    determined for each block of rows as it is written.
     :param output_path: str, full path to output file that is to be created
-    :param file_list: list, list of files (full path) to extract data from
+    :param data: ndarray, map data of shape (line x sample x element), all lines of the same length
     :param element_list: list, list of elements (only needed for header creation)
+    :param x_list: list, x positions of the samples
+    :param y_list: list, y positions of the lines
+    :param precision: int or None, number of significant digits of the counts (None: full precision)
+    """
+    with open_output(output_path) as g:
+        g.write("x,y,{}\n".format(','.join(element_list)))
+        write_rows(g, data.reshape(-1, data.shape[-1]), precision=precision,
+                   leading=(RepeatedColumn(x_list, tile=len(y_list)), RepeatedColumn(y_list, repeat=len(x_list))))
+
+
+def matrix_file_path(work_path, element):
+    """
+    Determines the path of the matrix file of an element (e.g. S34 => output/S_matrix.csv)
+    :param work_path: str, path to working directory
+    :param element: str, element header
+    :return: str, path to matrix file
+    """
+    e = ''.join([i for i in element if not i.isdigit()])
+    e_file_name = "output/" + e + "_matrix.csv"
+    return os.path.join(work_path, e_file_name)
+
+
+def create_element_matrices(data, element_list, work_path, precision=None):
+    """
+    Writes one matrix file (lines as rows, samples as columns) per element. Each matrix is a slice of the map data.
+    :param data: ndarray, map data of shape (line x sample x element), all lines of the same length
+    :param element_list: list, list of elements
+    :param work_path: str, path to working directory
+    :param precision: int or None, number of significant digits of the counts (None: full precision)
+    :return: element matrix csv files
+    """
+    for element_index, element in enumerate(element_list):
+        e_path = matrix_file_path(work_path, element)
+
+        with open_output(e_path) as W:
+            write_rows(W, data[:, :, element_index], precision=precision)
+
+
+def write_map_container(work_path, fmt, data, element_list, x_list, y_list, metadata):
+    """
+    Writes all element matrices (lines as rows, samples as columns) with their x and y axes into one container
+    :param work_path: str, path to working directory
+    :param fmt: str, container format ('npz', 'parquet' or 'hdf5')
+    :param data: ndarray, map data of shape (line x sample x element)
+    :param element_list: list, list of elements
+    :param x_list: list, x positions of the samples
+    :param y_list: list, y positions of the lines
+    :param metadata: dict, metadata stored with the matrices
+    :return: str, path of the container written
+    """
+    matrices = {element: data[:, :, element_index] for element_index, element in enumerate(element_list)}
+    axes = {'y': numpy.array(y_list), 'x': numpy.array(x_list)}
+    path = os.path.join(work_path, 'output', os.path.basename(work_path))
+    return write_container(path, fmt, matrices=matrices, axes=axes, metadata=metadata)
+
+
+def write_map_pyramid(work_path, method, tile_size, data, element_list, x_list, y_list, metadata):
+    """
+    Writes a tiled multi-resolution pyramid of all element matrices (lines as rows, samples as columns)
+    :param work_path: str, path to working directory
+    :param method: str, pooling method (one of PYRAMID_METHODS)
+    :param tile_size: int, number of rows and columns of a tile
+    :param data: ndarray, map data of shape (line x sample x element)
+    :param element_list: list, list of elements
+    :param x_list: list, x positions of the samples
+    :param y_list: list, y positions of the lines
+    :param metadata: dict, metadata stored with the pyramid
+    :return: str, path of the pyramid written
+    """
+    matrices = {element: data[:, :, element_index] for element_index, element in enumerate(element_list)}
+    axes = {'y': numpy.array(y_list), 'x': numpy.array(x_list)}
+    path = os.path.join(work_path, 'output', os.path.basename(work_path))
+    return write_pyramid(path, matrices, axes, method=method, tile_size=tile_size, metadata=metadata)
+
+
+class MapResult(namedtuple('MapResult', ['folder', 'data', 'elements', 'x', 'y', 'line_lengths', 'files',
+                                         'line_metadata', 'x_step', 'y_step', 'ragged', 'preprocessing'],
+                           defaults=[None])):
+    """
+    In-memory result of load_map:
+    folder: str, data folder, data: ndarray of shape (line x sample x element) with lines of different length padded
+    with NaN or truncated, elements: list of elements, x: ndarray of x positions (samples), y: ndarray of y positions
+    (lines), line_lengths: list of the number of samples measured per line, files: list of csv files (one per line),
+    line_metadata: list of SMPL.csv header information per line, x_step/y_step: float, step sizes,
+    ragged: str, how lines of different length were made the same length (one of RAGGED_POLICIES),
+    preprocessing: dict or None, settings of the despike and gas blank subtraction applied to data (see Preprocessor)
+    """
+    __slots__ = ()
+
+    def matrix(self, element):
+        """
+        :param element: str, element header (e.g. 'Fe56')
+        :return: ndarray, matrix of the element (lines as rows, samples as columns)
+        """
+        return self.data[:, :, self.elements.index(element)]
+
+    def metadata(self):
+        """
+        :return: dict, metadata stored in binary containers
+        """
+        metadata = {'x_step': self.x_step, 'y_step': self.y_step, 'line_lengths': self.line_lengths,
+                    'ragged': self.ragged, 'files': [os.path.basename(csv_file) for csv_file in self.files],
+                    'lines': self.line_metadata}
+        if self.preprocessing:
+            metadata['preprocessing'] = self.preprocessing
+        return metadata
+
+    def ragged_report(self):
+        """
+        :return: list of str, report of lines whose length differs from the width of the map (see ragged_report)
+        """
+        policy = 'truncated' if self.ragged == 'truncate' else 'padded with NaN'
+        return ragged_report(self.files, self.line_lengths, self.data.shape[1], policy)
+
+
+def load_map(folder, x_step, y_step, jobs=1, cache=None, profiler=None, ragged='pad', reader=None,
+             preprocessor=None, dtype='float64', csv_files=None):
+    """
+    Reads all csv files (one per raster line) of a map into memory. Nothing is written to disk (see save_map).
+    :param folder: str, path to folder containing the SMPL.csv files
+    :param x_step: float, step size in x direction
+    :param y_step: float, step size in y direction
+    :param jobs: int, number of worker processes used to parse the csv files (0 = all cores)
+    :param cache: ParseCache or None, cache of previously parsed files
+    :param profiler: Profiler or None, profiler recording the stages
+    :param ragged: str, lines of different length are padded with NaN to the longest line ('pad') or cut to the
+    shortest line ('truncate')
+    :param reader: PrefetchReader or None, reader of the csv files (default: PrefetchReader())
+    :param preprocessor: Preprocessor or None, despike and gas blank subtraction applied to every line (None: counts
+    are not changed)
+    :param dtype: str, type of the counts held in memory (one of DTYPES)
+    :param csv_files: list or None, csv files of the folder in numerical order, if the folder was already listed (see
+    index_csv_files; None: the folder is listed here)
+    :return: MapResult
+    """
+    folder = os.path.abspath(folder)
+    profiler = profiler or Profiler(enabled=False)
+
+    # Find all csv files in folder, sort by the numerical component and store in list with their full path
+    with profiler.stage('find_csv_files') as stage:
+        textfiles = find_csv_files(folder) if csv_files is None else csv_files
+        stage.rows = len(textfiles)
+
+    # Stack all lines into one array and determine the elements measured
+    with profiler.stage('build_map_array') as stage:
+        data, line_lengths, elements, line_metadata = build_map_array(file_list=textfiles, jobs=jobs, cache=cache,
+                                                                      reader=reader, dtype=dtype)
+        data = regularize_lines(data, line_lengths, ragged=ragged)
+        x = numpy.array(step_positions(x_step, data.shape[1]))
+        y = numpy.array(step_positions(y_step, data.shape[0]))
+        stage.rows = sum(line_lengths)
+
+    # Despike and subtract the gas blank of every line of every element in one batched pass
+    preprocessing = None
+    if preprocessor is not None and preprocessor.enabled:
+        with profiler.stage('preprocess') as stage:
+            data = preprocessor.apply(data, axis=1)
+            preprocessing = preprocessor.settings()
+            stage.rows = data.shape[0] * data.shape[1]
+
+    return MapResult(folder=folder, data=data, elements=elements, x=x, y=y, line_lengths=line_lengths,
+                     files=textfiles, line_metadata=line_metadata, x_step=x_step, y_step=y_step, ragged=ragged,
+                     preprocessing=preprocessing)
+
+
+def save_map(result, fmt='csv', write_alldata=True, work_path=None, profiler=None, precision=None, pyramid=None,
+             tile_size=PYRAMID_TILE_SIZE):
+    """
+    Writes a map to the output folder: element matrices, x/y axes and alldata.csv, or one binary container, and
+    optionally a tiled pyramid of the element matrices
+    :param result: MapResult, map returned by load_map
+    :param fmt: str, output format (one of FORMATS)
+    :param write_alldata: bool, if True (and fmt is csv) output/alldata.csv is written as well
+    :param work_path: str or None, folder in which the output folder is created (default: folder of the map, or
+    where it would be extracted to if it is inside an archive)
+    :param profiler: Profiler or None, profiler recording the stages
+    :param precision: int or None, number of significant digits of the counts in csv output (None: full precision)
+    :param pyramid: str or None, pooling method of the pyramid (one of PYRAMID_METHODS; None: no pyramid)
+    :param tile_size: int, number of rows and columns of the tiles of the pyramid
+    :return: list of files written
+    """
+    work_path = os.path.abspath(work_path or extracted_path(result.folder))
+    profiler = profiler or Profiler(enabled=False)
+    os.makedirs(os.path.join(work_path, 'output'), exist_ok=True)
+    x_list = result.x.tolist()
+    y_list = result.y.tolist()
+    rows = result.data.shape[0] * result.data.shape[1]
+    written = []
+
+    # Tiled pyramid for previews and viewport queries, written next to the full resolution output
+    if pyramid:
+        with profiler.stage('write_map_pyramid') as stage:
+            written.append(write_map_pyramid(work_path, pyramid, tile_size, result.data, result.elements, x_list,
+                                             y_list, {'x_step': result.x_step, 'y_step': result.y_step,
+                                                      'ragged': result.ragged}))
+            stage.rows = rows
+
+    # Binary output: one container holding every element matrix, the axes and the SMPL.csv header information
+    if fmt != 'csv':
+        with profiler.stage('write_map_container') as stage:
+            container = write_map_container(work_path, fmt, result.data, result.elements, x_list, y_list,
+                                            result.metadata())
+            stage.rows = rows
+        return [container] + written
+
+    with profiler.stage('write_axes'):
+        write_axes(work_path, x_list, y_list)
+    written.extend([os.path.join(work_path, 'output/x_data.csv'), os.path.join(work_path, 'output/y_data.csv')])
+
+    # Write individual matrix files directly from the array
+    with profiler.stage('create_element_matrices') as stage:
+        create_element_matrices(data=result.data, element_list=result.elements, work_path=work_path,
+                                precision=precision)
+        stage.rows = rows
+    written.extend(matrix_file_path(work_path, element) for element in result.elements)
+
+    # Optionally write one file with all results
+    if write_alldata:
+        with profiler.stage('write_all_results') as stage:
+            outfile = os.path.join(work_path, 'output/alldata.csv')
+            write_all_results(output_path=outfile, data=result.data, element_list=result.elements, x_list=x_list,
+                              y_list=y_list, precision=precision)
+            stage.rows = rows
+        written.append(outfile)
+
+    return written
+
+
+class MapWriter:
+    """
+    Appends lines (one SMPL.csv file each) to the csv output one at a time: a row is appended to every element matrix
+    and the samples of the line to alldata.csv, with all output files held open at the same time. Only the current
+    line and the x/y positions are kept in memory. As later lines are not known when a line is written, every line
+    is padded with NaN or truncated to the length of the first line. Used for --streaming and --watch:
+
+        with MapWriter(work_path, x_step, y_step) as writer:
+            for csv_file, smpl in zip(file_list, read_all_files(file_list)):
+                writer.append(smpl, source=csv_file)
+    """
+
+    def __init__(self, work_path, x_step, y_step, write_alldata=True, flush=False, precision=None,
+                 preprocessor=None, dtype='float64'):
+        """
+        :param work_path: str, path to working directory (the output folder must exist)
+        :param x_step: float, step size in x direction
+        :param y_step: float, step size in y direction
+        :param write_alldata: bool, if True output/alldata.csv is written as well
+        :param flush: bool, if True the output files (including x_data.csv and y_data.csv) are updated after every
+        line, so that a partial map can be read while lines are still being appended
+        :param precision: int or None, number of significant digits of the counts (None: full precision)
+        :param preprocessor: Preprocessor or None, despike and gas blank subtraction applied to every line
+        :param dtype: str, type of the counts (one of DTYPES; float32 counts are written with float32 precision)
+        """
+        self.work_path = work_path
+        self.x_step = x_step
+        self.y_step = y_step
+        self.write_alldata = write_alldata
+        self.flush = flush
+        self.precision = precision
+        self.preprocessor = preprocessor
+        self.dtype = dtype
+        self.element_list = None
+        self.width = None
+        self.x_list = []
+        self.y_list = []
+        self.line_lengths = []
+        self.sources = []
+        self.rows = 0
+        self._stack = ExitStack()
+        self._matrix_files = []
+        self._alldata = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def _open(self, element_list):
+        # Output files are opened once the elements are known
+        self.element_list = element_list
+        self._matrix_files = [self._stack.enter_context(open_output(matrix_file_path(self.work_path, element)))
+                              for element in element_list]
+        if self.write_alldata:
+            self._alldata = self._stack.enter_context(open_output(os.path.join(self.work_path, 'output/alldata.csv')))
+            self._alldata.write("x,y,{}\n".format(','.join(element_list)))
+
+    def append(self, smpl, source=None):
+        """
+        Appends one line to the output
+        :param smpl: SmplData, parsed SMPL.csv file of the line
+        :param source: str or None, csv file of the line (for the ragged line report)
+        """
+        if self.element_list is None:
+            self._open(smpl.elements)
+            self.width = len(smpl.data)
+            self.x_list = step_positions(self.x_step, self.width)
+
+        y = step_position(self.y_step, len(self.y_list) + 1)
+        self.y_list.append(y)
+        self.line_lengths.append(len(smpl.data))
+        self.sources.append(source or 'line {}'.format(len(self.y_list)))
+
+        # Pad with NaN or truncate to the length of the first line
+        line = numpy.full((self.width, len(self.element_list)), numpy.nan, dtype=self.dtype)
+        samples = min(len(smpl.data), self.width)
+        line[:samples] = smpl.data[:samples]
+        if self.preprocessor is not None:
+            line = self.preprocessor.apply(line, axis=0)
+
+        for matrix_file, values in zip(self._matrix_files, line.T):
+            matrix_file.write(format_rows(values, precision=self.precision))
+        if self._alldata is not None:
+            write_rows(self._alldata, line, precision=self.precision, leading=(self.x_list, [y] * self.width))
+        self.rows += self.width
+
+        if self.flush:
+            for output_file in self._matrix_files + ([self._alldata] if self._alldata is not None else []):
+                output_file.flush()
+            write_axes(self.work_path, self.x_list, self.y_list)
+
+    def close(self):
+        """
+        Writes x_data.csv and y_data.csv and closes all output files
+        """
+        self._stack.close()
+        write_axes(self.work_path, self.x_list, self.y_list)
+
+    def ragged_report(self):
+        """
+        :return: list of str, report of lines whose length differs from the first line (see ragged_report)
+        """
+        return ragged_report(self.sources, self.line_lengths, self.width, 'padded with NaN or truncated')
+
+    def files(self):
+        """
+        :return: list of files written
+        """
+        written = [os.path.join(self.work_path, 'output/x_data.csv'), os.path.join(self.work_path, 'output/y_data.csv')]
+        written.extend(matrix_file_path(self.work_path, element) for element in self.element_list or [])
+        if self._alldata is not None:
+            written.append(os.path.join(self.work_path, 'output/alldata.csv'))
+        return written
+
+
+def stream_map(folder, x_step, y_step, jobs=1, cache=None, write_alldata=True, profiler=None, precision=None,
+               reader=None, preprocessor=None, dtype='float64', csv_files=None):
+    """
+    Formats a map with bounded memory: csv files are parsed and appended to the csv output one line at a time, so
+    peak memory depends on the size of one line rather than on the size of the map. The output is the same as that
+    of load_map followed by save_map (csv output only), except that lines of different length are padded or truncated
+    to the length of the first line (see MapWriter).
+    :param folder: str, path to folder containing the SMPL.csv files
     :param x_step: float, step size in x direction
     :param y_step: float, step size in y direction
+    :param jobs: int, number of worker processes used to parse the csv files (0 = all cores)
+    :param cache: ParseCache or None, cache of previously parsed files
+    :param write_alldata: bool, if True output/alldata.csv is written as well
+    :param profiler: Profiler or None, profiler recording the stages
+    :param precision: int or None, number of significant digits of the counts (None: full precision)
+    :param reader: PrefetchReader or None, reader of the csv files (default: PrefetchReader())
+    :param preprocessor: Preprocessor or None, despike and gas blank subtraction applied to every line
+    :param dtype: str, type of the counts (one of DTYPES)
+    :param csv_files: list or None, csv files of the folder in numerical order, if the folder was already listed (see
+    index_csv_files; None: the folder is listed here)
+    :return: (list, list), files written and report of ragged lines (see ragged_report)
+    """
+    folder = os.path.abspath(folder)
+    work_path = extracted_path(folder)
+    profiler = profiler or Profiler(enabled=False)
+    os.makedirs(os.path.join(work_path, 'output'), exist_ok=True)
+
+    with profiler.stage('find_csv_files') as stage:
+        textfiles = find_csv_files(folder) if csv_files is None else csv_files
+        stage.rows = len(textfiles)
+
+    with profiler.stage('stream_map') as stage:
+        with MapWriter(work_path, x_step, y_step, write_alldata=write_alldata, precision=precision,
+                       preprocessor=preprocessor, dtype=dtype) as writer:
+            for csv_file, smpl in zip(textfiles, read_all_files(textfiles, jobs=jobs, cache=cache,
+                                                                              reader=reader)):
+                writer.append(smpl, source=csv_file)
+        stage.rows = writer.rows
+
+    return writer.files(), writer.ragged_report()
+
+
+def read_completed_file(csv_file):
+    """
+    Parses a csv file if the instrument has finished writing it (i.e. the "Printed:" footer is present)
+    :param csv_file: str, path to csv file
+    :return: SmplData, or None if the file is still being written
+    """
+    try:
+        smpl = read_smpl(csv_file)
+    except ValueError:
+        # Header not written yet
+        return None
+    return smpl if smpl.complete else None
+
+
+def watch_folder(work_path, x_step, y_step, poll_interval=2.0, idle_timeout=None, write_alldata=True,
+                 precision=None, preprocessor=None, dtype='float64'):
+    """
+    Watches a folder while the instrument is still acquiring. Each newly completed csv file is parsed once and its
+    row is appended to the element matrices (and alldata.csv), so a partial map is available after every line.
+    Files are appended in numerical order; a file is only appended once all files before it are complete.
     :param work_path: str, path to working directory
-    :return: results csv file, x and y csv file
+    :param x_step: float, step size in x direction
+    :param y_step: float, step size in y direction
+    :param poll_interval: float, seconds between checks of the folder
+    :param idle_timeout: float or None, stop after this many seconds without a new completed file (None = never)
+    :param write_alldata: bool, if True output/alldata.csv is written as well
+    :param precision: int or None, number of significant digits of the counts (None: full precision)
+    :param preprocessor: Preprocessor or None, despike and gas blank subtraction applied to every line
+    :param dtype: str, type of the counts (one of DTYPES)
+    :return: int, number of lines appended
     """
-    x_file_path = os.path.join(work_path, 'output/x_data.csv')
-    y_file_path = os.path.join(work_path, 'output/y_data.csv')
+    processed = set()
+    last_processed = None
+    last_activity = time.monotonic()
 
-    x_list = []
-    y_list = []
-    with open(output_path, 'w') as g:
-        g.write("x,y,{}\n".format(','.join(element_list)))
-        y = 0
-
-        for csv_file in file_list:
-            # Establish Y step per file and reset X step. Create a list of unique Y-values to write to file later
-            x = 0
-            y = y + y_step
-            if y not in y_list:
-                y_list.append(y)
-
-            # Read data from file and store in a list. Line counter is required to skip header and footer info.
-            line_counter = 0
-            footer = file_len(csv_file) - 3
-            with open(csv_file, 'r') as R:
-                for line in R:
-                    line_counter += 1
-                    if 5 <= line_counter <= footer:
-                        # Establish X step per row in file. Create a list of unique values to write to file later
-                        x = x + x_step
-                        if x not in x_list:
-                            x_list.append(x)
-
-                        # Extract required data and write to results file
-                        line = line.strip().split(',')
-                        g.write("{},{},{}\n".format(x, y, ','.join(line[1:])))
-
-    # Write out X and Y steps
-    with open(x_file_path, 'w') as gx, open(y_file_path, 'w') as gy:
-        x_list = [str(x) for x in x_list]
-        y_list = [str(y) for y in y_list]
-        gx.write('\n'.join(x_list))
-        gy.write('\n'.join(y_list))
+    with MapWriter(work_path, x_step, y_step, write_alldata=write_alldata, flush=True, precision=precision,
+                   preprocessor=preprocessor, dtype=dtype) as writer:
+        while True:
+            appended = False
+            for csv_file in find_csv_files(work_path):
+                if csv_file in processed:
+                    continue
+                if last_processed is not None and \
+                        file_sort_key(os.path.basename(csv_file)) < file_sort_key(os.path.basename(last_processed)):
+                    print('Skipping {}: it appeared after later lines were already written'.format(csv_file))
+                    processed.add(csv_file)
+                    continue
+
+                smpl = read_completed_file(csv_file)
+                if smpl is None:
+                    # Lines must be appended in order, so wait for this file to be completed
+                    break
 
+                # Append row to element matrices and alldata.csv
+                writer.append(smpl, source=csv_file)
 
-def create_element_matrices(df, work_path):
+                processed.add(csv_file)
+                last_processed = csv_file
+                appended = True
+                print('Appended line {}: {}{}'.format(
+                    len(writer.y_list), os.path.basename(csv_file),
+                    '' if len(smpl.data) == writer.width else ' ({} samples, fitted to {})'.format(len(smpl.data),
+                                                                                                  writer.width)))
+
+            if appended:
+                last_activity = time.monotonic()
+            elif idle_timeout is not None and time.monotonic() - last_activity >= idle_timeout:
+                break
+            time.sleep(poll_interval)
+
+    return len(writer.y_list)
+
+
+def is_glob(path):
     """
-    Reads dataframe consisting of x & y positions and element counts. Reformats data into matrix format.
-    :param df: dataframe
-    :return: element matrix csv file
+    :param path: str, folder or glob pattern
+    :return: bool, True if path contains glob wildcards
     """
-    # Create element file to write to
-    header = list(df.columns.values)
-    header.remove('x')
-    header.remove('y')
-    if len(header) != 1:
-        return
+    return any(char in path for char in '*?[')
+
+
+def discover_map_folders(path):
+    """
+    Determines the map folders (folders containing SMPL.csv files) to process. path is either a map folder, a root
+    folder containing map folders (e.g. one .b batch folder per tissue section, searched recursively) or a glob
+    pattern matching map folders. Output folders are skipped, as are csv files in the root folder itself (e.g. a step
+    size manifest) unless it holds SMPL.csv files, in which case the root folder is a map folder as well. zip and tar
+    archives (given as path, matched by the glob pattern or found in the root folder) are
+    searched for map folders as well, which are then read without extracting them.
+    :param path: str, map folder, root folder, archive or glob pattern
+    :return: (list, bool), sorted list of map folders (full path; folders inside archives as e.g.
+    /data/batch.tar.gz/section_01.b) and True if path is a single map folder
+    """
+    if is_glob(path):
+        folders = []
+        for match in glob.glob(path):
+            if os.path.isdir(match):
+                folders.append(os.path.abspath(match))
+            elif is_archive(match):
+                folders.extend(archive_folders(match))
+        return sorted(folders), False
+
+    path = os.path.abspath(path)
+    if is_archive(path):
+        folders = archive_folders(path)
+        return folders, len(folders) == 1
+
+    folders = []
+    root_is_map = False
+    for folder, subfolders, filenames in os.walk(path):
+        subfolders[:] = [subfolder for subfolder in subfolders if subfolder != 'output']
+        if folder == path:
+            root_is_map = any(filename.endswith('SMPL.csv') for filename in filenames)
+        elif any(filename.endswith('.csv') for filename in filenames):
+            folders.append(folder)
+        for filename in filenames:
+            if is_archive(os.path.join(folder, filename)):
+                folders.extend(archive_folders(os.path.join(folder, filename)))
+    if not folders:
+        return [path], True
+    if root_is_map:
+        print('Warning: {} holds SMPL.csv files as well as map folders, it is processed as a map folder too'.format(
+            path))
+        folders.append(path)
+    return sorted(folders), False
+
+
+def read_step_manifest(manifest_path):
+    """
+    Reads the step sizes of each map folder from a csv file with the columns folder, x_step and y_step. Folders are
+    given by name (e.g. section_01.b) or by path relative to the manifest.
+    :param manifest_path: str, path to manifest
+    :return: dict, folder (name or full path) -> (x_step, y_step)
+    """
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    steps = {}
+    with open(manifest_path, newline='') as F:
+        for row_number, row in enumerate(csv.DictReader(F), start=2):
+            try:
+                folder = row['folder'].strip()
+                x_step, y_step = float(row['x_step']), float(row['y_step'])
+            except (KeyError, AttributeError, TypeError, ValueError):
+                raise ValueError('{}, line {}: expected the columns folder, x_step and y_step'.format(
+                    manifest_path, row_number))
+            steps[os.path.normpath(os.path.join(manifest_dir, folder))] = (x_step, y_step)
+            steps[os.path.basename(os.path.normpath(folder))] = (x_step, y_step)
+    return steps
+
+
+def folder_steps(folder, manifest, default_steps):
+    """
+    Determines the step sizes of a map folder
+    :param folder: str, map folder (full path)
+    :param manifest: dict, step sizes returned by read_step_manifest
+    :param default_steps: (float, float) or None, step sizes of folders not in the manifest
+    :return: (float, float), x and y step size
+    """
+    steps = manifest.get(folder, manifest.get(os.path.basename(folder), default_steps))
+    if steps is None:
+        raise ValueError('no step sizes for {} in the manifest'.format(folder))
+    return steps
+
+
+def index_map_folders(folders):
+    """
+    Lists the csv files of each map folder once, in numerical order. The output folder of each map is created first,
+    as creating it changes the modification time of the map folder, which would invalidate the cached listing.
+    :param folders: list, map folders (full path)
+    :return: dict, folder -> FileIndex
+    """
+    indexes = {}
+    for folder in folders:
+        os.makedirs(os.path.join(extracted_path(folder), 'output'), exist_ok=True)
+        indexes[folder] = index_csv_files(folder)
+    return indexes
+
+
+def check_file_sequence(indexes):
+    """
+    Checks the csv files of each map folder for missing and duplicate line numbers (before any file is parsed) and
+    prints a warning for every problem found
+    :param indexes: dict, map folder -> FileIndex (see index_map_folders)
+    :return: dict, folder -> list of problems (folders without problems are left out)
+    """
+    problems = {}
+    for folder, index in indexes.items():
+        folder_problems = sequence_problems(index)
+        for problem in folder_problems:
+            print('Warning: {}: {}'.format(folder, problem))
+        if folder_problems:
+            problems[folder] = folder_problems
+    return problems
+
+
+# Outcome of process_map_folder: folder, number of lines (csv files), MB of csv files read, processing time in seconds,
+# files loaded from cache and parsed, files written, warnings (e.g. ragged lines) and profiled stages
+FolderSummary = namedtuple('FolderSummary', ['folder', 'lines', 'megabytes', 'elapsed', 'cache_hits',
+                                             'cache_misses', 'written', 'warnings', 'stages'])
+
+
+def process_map_folder(work_path, x_step, y_step, fmt='csv', write_alldata=True, use_cache=True, streaming=False,
+                       jobs=1, profile=False, ragged='pad', precision=None, reader=None, pyramid=None,
+                       tile_size=PYRAMID_TILE_SIZE, preprocessor=None, dtype='float64', csv_files=None):
+    """
+    Formats one map folder: reads its csv files (unchanged files are loaded from cache) and writes the output
+    :param work_path: str, path to map folder
+    :param x_step: float, step size in x direction
+    :param y_step: float, step size in y direction
+    :param fmt: str, output format (one of FORMATS)
+    :param write_alldata: bool, if True (and fmt is csv) output/alldata.csv is written as well
+    :param use_cache: bool, if False the cache is rebuilt
+    :param streaming: bool, if True lines are appended to the output one at a time (csv output only)
+    :param jobs: int, number of worker processes used to parse the csv files (0 = all cores)
+    :param profile: bool, if True the pipeline stages are profiled
+    :param ragged: str, how lines of different length are made the same length (one of RAGGED_POLICIES; ignored when
+    streaming, see MapWriter)
+    :param precision: int or None, number of significant digits of the counts in csv output (None: full precision)
+    :param reader: PrefetchReader or None, reader of the csv files (default: PrefetchReader())
+    :param pyramid: str or None, pooling method of the tiled pyramid (one of PYRAMID_METHODS; None: no pyramid)
+    :param tile_size: int, number of rows and columns of the tiles of the pyramid
+    :param preprocessor: Preprocessor or None, despike and gas blank subtraction applied to every line
+    :param dtype: str, type of the counts held in memory (one of DTYPES)
+    :param csv_files: list or None, csv files of the folder in numerical order, if the folder was already listed (see
+    index_map_folders; None: the folder is listed here)
+    :return: FolderSummary
+    """
+    start = time.perf_counter()
+    profiler = Profiler(enabled=profile)
+    work_path = os.path.abspath(work_path)
+    os.makedirs(os.path.join(extracted_path(work_path), 'output'), exist_ok=True)
+    if csv_files is None:
+        csv_files = find_csv_files(work_path)
+
+    # Files inside an archive are not cached, as the archive is read in one pass (without extracting it) regardless
+    if split_archive_path(work_path)[0] is None:
+        cache = ParseCache(os.path.join(work_path, 'output', '.cache'), use_existing=use_cache)
+    else:
+        cache = None
+    if streaming:
+        written, warnings = stream_map(work_path, x_step, y_step, jobs=jobs, cache=cache, write_alldata=write_alldata,
+                                       profiler=profiler, precision=precision, reader=reader,
+                                       preprocessor=preprocessor, dtype=dtype, csv_files=csv_files)
     else:
-        e = ''.join([i for i in header[0] if not i.isdigit()])
-        e_file_name = "output/" + e + "_matrix.csv"
-        e_path = os.path.join(work_path, e_file_name)
+        result = load_map(work_path, x_step, y_step, jobs=jobs, cache=cache, profiler=profiler, ragged=ragged,
+                          reader=reader, preprocessor=preprocessor, dtype=dtype, csv_files=csv_files)
+        written = save_map(result, fmt=fmt, write_alldata=write_alldata, profiler=profiler, precision=precision,
+                           pyramid=pyramid, tile_size=tile_size)
+        warnings = result.ragged_report()
 
-    with open(e_path, 'w') as W:
-        unique_y = df.y.unique().tolist()
-        for y in unique_y:
-            df_selected = df[df['y'] == y]
-            values_list = df_selected[header[0]].tolist()
-            values_list = [str(value) for value in values_list]
-            W.write("{}\n".format(','.join(values_list)))
+    return FolderSummary(folder=work_path, lines=len(csv_files),
+                         megabytes=sum(member_size(csv_file) for csv_file in csv_files) / 1e6,
+                         elapsed=time.perf_counter() - start, cache_hits=cache.hits if cache else 0,
+                         cache_misses=cache.misses if cache else len(csv_files),
+                         written=written, warnings=warnings, stages=profiler.records())
+
+
+def process_map_batch(folders, manifest, default_steps, fmt='csv', write_alldata=True, use_cache=True,
+                      streaming=False, jobs=1, profiler=None, ragged='pad', precision=None, reader=None, pyramid=None,
+                      tile_size=PYRAMID_TILE_SIZE, preprocessor=None, dtype='float64', indexes=None):
+    """
+    Formats many map folders, concurrently in one shared pool of worker processes (each folder is handled by one
+    worker). A failure in one folder is reported and does not stop the other folders from being processed.
+    :param folders: list, map folders (full path)
+    :param manifest: dict, step sizes returned by read_step_manifest
+    :param default_steps: (float, float) or None, step sizes of folders not in the manifest
+    :param fmt: str, output format (one of FORMATS)
+    :param write_alldata: bool, if True (and fmt is csv) output/alldata.csv is written as well
+    :param use_cache: bool, if False the cache is rebuilt
+    :param streaming: bool, if True lines are appended to the output one at a time (csv output only)
+    :param jobs: int, number of worker processes (0 = all cores, 1 = process in the current process)
+    :param profiler: Profiler or None, if given the stages of all folders are profiled and added to it
+    :param ragged: str, how lines of different length are made the same length (one of RAGGED_POLICIES)
+    :param precision: int or None, number of significant digits of the counts in csv output (None: full precision)
+    :param reader: PrefetchReader or None, reader of the csv files (default: PrefetchReader())
+    :param pyramid: str or None, pooling method of the tiled pyramid (one of PYRAMID_METHODS; None: no pyramid)
+    :param tile_size: int, number of rows and columns of the tiles of the pyramid
+    :param preprocessor: Preprocessor or None, despike and gas blank subtraction applied to every line
+    :param dtype: str, type of the counts held in memory (one of DTYPES)
+    :param indexes: dict or None, folder -> FileIndex of the folders already listed (see index_map_folders)
+    :return: (list, list), FolderSummary of each successful folder and (folder, error message) of each failure
+    """
+    succeeded = []
+    failed = []
+    total = len(folders)
+    profile = profiler is not None and profiler.enabled
+    options = {'fmt': fmt, 'write_alldata': write_alldata, 'use_cache': use_cache, 'streaming': streaming,
+               'profile': profile, 'ragged': ragged, 'precision': precision, 'reader': reader, 'pyramid': pyramid,
+               'tile_size': tile_size, 'preprocessor': preprocessor, 'dtype': dtype}
+
+    def report(folder, future_result):
+        done = len(succeeded) + len(failed) + 1
+        try:
+            summary = future_result()
+        except Exception as error:
+            failed.append((folder, '{}: {}'.format(type(error).__name__, error)))
+            print('[{}/{}] Failed to process {}: {}'.format(done, total, folder, failed[-1][1]))
+            return
+        succeeded.append(summary)
+        for record in summary.stages:
+            profiler.add(record)
+        print('[{}/{}] Finished {}: {} lines in {:.2f} s'.format(done, total, folder, summary.lines, summary.elapsed))
+        for warning in summary.warnings:
+            print('Warning: {}: {}'.format(folder, warning))
+
+    # Folders without step sizes are reported as failures before any folder is processed
+    tasks = []
+    for folder in folders:
+        try:
+            tasks.append((folder,) + tuple(folder_steps(folder, manifest, default_steps)))
+        except ValueError as error:
+            failed.append((folder, str(error)))
+            print('[{}/{}] Failed to process {}: {}'.format(len(failed), total, folder, error))
+
+    indexes = indexes or {}
+    csv_files = {folder: index.files for folder, index in indexes.items()}
+    if jobs == 1 or len(tasks) < 2:
+        for task in tasks:
+            report(task[0], lambda: process_map_folder(*task, csv_files=csv_files.get(task[0]), **options))
+        return succeeded, failed
+
+    # Imported here as it is only needed with --jobs and adds noticeably to the startup time
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    workers = jobs if jobs > 0 else os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_map_folder, *task, csv_files=csv_files.get(task[0]), **options): task[0]
+                   for task in tasks}
+        for future in as_completed(futures):
+            report(futures[future], future.result)
+
+    return succeeded, failed
+
+
+def write_batch_summary(path, succeeded, failed, elapsed, warnings=None):
+    """
+    Writes the consolidated summary of a batch run to a JSON file
+    :param path: str, path of summary
+    :param succeeded: list, FolderSummary of each successful folder
+    :param failed: list, (folder, error message) of each failed folder
+    :param elapsed: float, wall time of the batch run in seconds
+    :param warnings: dict or None, folder -> problems found in its file sequence (see check_file_sequence)
+    """
+    summary = {'elapsed': elapsed, 'succeeded': len(succeeded), 'failed': len(failed),
+               'lines': sum(folder.lines for folder in succeeded),
+               'megabytes': sum(folder.megabytes for folder in succeeded),
+               'folders': [{'folder': folder.folder, 'lines': folder.lines, 'megabytes': folder.megabytes,
+                            'elapsed': folder.elapsed, 'cache_hits': folder.cache_hits,
+                            'cache_misses': folder.cache_misses, 'written': folder.written,
+                            'warnings': folder.warnings}
+                           for folder in succeeded],
+               'failures': [{'folder': folder, 'error': error} for folder, error in failed],
+               'warnings': warnings or {}}
+    with open(path, 'w') as F:
+        json.dump(summary, F, indent=2)
 
 
 def main():
-    valid_input = input_validation(input_args=sys.argv)
+    args = parse_arguments(sys.argv[1:])
+    valid_input = input_validation(input_args=args)
 
     if not valid_input:
         sys.exit()
-    else:
-        # Store input arguments into variables
-        x_step_size = float(sys.argv[2])
-        y_step_size = float(sys.argv[3])
-        work_path = os.path.abspath(sys.argv[1])
-        if not os.path.isdir(os.path.join(work_path, 'output')):
-            os.mkdir(os.path.join(work_path, 'output'))
+
+    # Determine the map folders and their step sizes
+    folders, single_folder = discover_map_folders(args.path_to_data_folder)
+    default_steps = None if args.x_step_size is None else (float(args.x_step_size), float(args.y_step_size))
+    try:
+        manifest = read_step_manifest(args.manifest) if args.manifest else {}
+    except ValueError as error:
+        print(error)
+        sys.exit()
+    if not folders:
+        print('No folders with csv files found in "{}"'.format(args.path_to_data_folder))
+        sys.exit()
+    if args.watch and not single_folder:
+        print('Watch mode only supports a single map folder')
+        sys.exit()
+
+    profiler = Profiler(enabled=args.profile or bool(args.profile_report) or bool(args.cprofile),
+                        cprofile_path=args.cprofile)
+    reader = PrefetchReader(depth=args.prefetch, max_bytes=int(args.prefetch_memory * 2 ** 20))
+    preprocessor = Preprocessor(despike_window=args.despike, despike_threshold=args.despike_threshold,
+                                blank_samples=args.blank)
+
+    if single_folder:
+        work_path = folders[0]
+        try:
+            x_step_size, y_step_size = folder_steps(work_path, manifest, default_steps)
+        except ValueError as error:
+            print(error)
+            sys.exit()
+        os.makedirs(os.path.join(extracted_path(work_path), 'output'), exist_ok=True)
         print('Processing data in: {}'.format(work_path))
         print('Step size in x direction: {}'.format(str(x_step_size)))
         print('Step size in y direction: {}'.format(str(y_step_size)))
+        if args.jobs != 1:
+            print('Parsing csv files with {} worker processes'.format(args.jobs if args.jobs > 0 else os.cpu_count()))
+
+        # Watch mode: append lines as the instrument completes them
+        if args.watch:
+            print('Watching for completed csv files (Ctrl+C to stop)')
+            try:
+                lines = watch_folder(work_path, x_step_size, y_step_size, poll_interval=args.poll_interval,
+                                     idle_timeout=args.idle_timeout, write_alldata=not args.no_alldata,
+                                     precision=args.precision, preprocessor=preprocessor, dtype=args.dtype)
+                print('Watch stopped after {} seconds without new lines: {} lines written'.format(
+                    args.idle_timeout, lines))
+            except KeyboardInterrupt:
+                print('Watch stopped')
+            return
+
+        # List the folder once and flag missing or duplicate lines before anything is parsed
+        indexes = index_map_folders(folders)
+        warnings = check_file_sequence(indexes)
+
+        # Read all lines (unchanged files are loaded from cache) and write the output
+        profiler.start()
+        summary = process_map_folder(work_path, x_step_size, y_step_size, fmt=args.format,
+                                     write_alldata=not args.no_alldata, use_cache=not args.no_cache,
+                                     streaming=args.streaming, jobs=args.jobs, profile=profiler.enabled,
+                                     ragged=args.ragged or 'pad', precision=args.precision, reader=reader,
+                                     pyramid=args.pyramid, tile_size=args.tile_size, preprocessor=preprocessor,
+                                     dtype=args.dtype, csv_files=indexes[work_path].files)
+        for warning in summary.warnings:
+            print('Warning: {}'.format(warning))
+        for record in summary.stages:
+            profiler.add(record)
+        print('Cache: {} files loaded from cache, {} files parsed'.format(summary.cache_hits, summary.cache_misses))
+        if args.format != 'csv':
+            print('Data written to: {}'.format(summary.written[0]))
+        if args.pyramid:
+            print('Pyramid written to: {}'.format(next(path for path in summary.written if path.endswith('.pyramid'))))
+        succeeded, failed, elapsed = [summary], [], summary.elapsed
+
+    else:
+        # Batch mode: every map folder is processed by one worker of a shared pool
+        print('Processing {} map folders in: {}'.format(len(folders), args.path_to_data_folder))
+        if args.jobs != 1:
+            print('Processing folders with {} worker processes'.format(args.jobs if args.jobs > 0 else os.cpu_count()))
+        indexes = index_map_folders(folders)
+        warnings = check_file_sequence(indexes)
+        profiler.start()
+        start = time.perf_counter()
+        succeeded, failed = process_map_batch(folders, manifest, default_steps, fmt=args.format,
+                                              write_alldata=not args.no_alldata, use_cache=not args.no_cache,
+                                              streaming=args.streaming, jobs=args.jobs, profiler=profiler,
+                                              ragged=args.ragged or 'pad', precision=args.precision,
+                                              reader=reader, pyramid=args.pyramid, tile_size=args.tile_size,
+                                              preprocessor=preprocessor, dtype=args.dtype, indexes=indexes)
+        elapsed = time.perf_counter() - start
+
+        # Consolidated summary of all folders
+        lines = sum(summary.lines for summary in succeeded)
+        megabytes = sum(summary.megabytes for summary in succeeded)
+        print('Processed {} of {} folders in {:.2f} s: {} lines, {:.1f} MB ({:.1f} lines/s, {:.2f} MB/s)'.format(
+            len(succeeded), len(folders), elapsed, lines, megabytes, lines / elapsed if elapsed else 0.0,
+            megabytes / elapsed if elapsed else 0.0))
+        print('Cache: {} files loaded from cache, {} files parsed'.format(
+            sum(summary.cache_hits for summary in succeeded), sum(summary.cache_misses for summary in succeeded)))
+        for folder, error in failed:
+            print('Failed: {}: {}'.format(folder, error))
+
+    if args.summary:
+        write_batch_summary(args.summary, succeeded, failed, elapsed, warnings=warnings)
+        print('Summary written to: {}'.format(args.summary))
 
-        # Find all csv files in folder, sort by the numerical component and store in list with their full path
-        # https://stackoverflow.com/questions/9234560/find-all-csv-files-in-a-directory-using-python/12280052
-        # https://stackoverflow.com/questions/37796598/how-to-sort-file-names-in-a-particular-order-using-python
-        filenames = os.listdir(work_path)
-        file_list = [filename for filename in filenames if filename.endswith(".csv")]
-        textfiles = sorted(file_list, key=numeric_filename)
-        textfiles = [os.path.join(work_path, textfile) for textfile in textfiles]
-
-        # Determine elements measured
-        elements = element_determination(textfiles[0])
-
-        # Create one file to store all results
-        outfile = os.path.join(work_path, 'output/alldata.csv')
-        write_all_results(output_path=outfile, file_list=textfiles, element_list=elements,
-                          x_step=x_step_size, y_step=y_step_size, work_path=work_path)
-
-        # Parse results file to create individual matrix files
-        df = pd.read_csv(outfile, sep=',')
-        for element in elements:
-            df_element = df[['x', 'y', element]]
-            create_element_matrices(df=df_element, work_path=work_path)
+    profiler.finish()
+    if profiler.enabled:
+        print('\n'.join(profiler.summary_table()))
+        if args.profile_report:
+            profiler.write_report(args.profile_report, tool='format_icpms_map_data', arguments=vars(args),
+                                  folders=[summary.folder for summary in succeeded],
+                                  lines=sum(summary.lines for summary in succeeded),
+                                  files_written=[path for summary in succeeded for path in summary.written])
+            print('Profile report written to: {}'.format(args.profile_report))
+        if args.cprofile:
+            print('cProfile statistics written to: {}'.format(args.cprofile))
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
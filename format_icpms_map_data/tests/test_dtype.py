@@ -0,0 +1,41 @@
+import glob
+import os
+
+import numpy
+import pytest
+
+from format_icpms_map_data import build_map_array
+from icpms_common import FLOAT32_TOLERANCE, file_sort_key
+
+EXAMPLE_MAP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'example_data', 'femur_head')
+
+
+@pytest.fixture(scope='module')
+def example_files():
+    return sorted(glob.glob(os.path.join(EXAMPLE_MAP, '*SMPL.csv')), key=lambda path: file_sort_key(
+        os.path.basename(path)))
+
+
+@pytest.fixture(scope='module')
+def maps(example_files):
+    return {dtype: build_map_array(example_files, dtype=dtype) for dtype in ('float64', 'float32')}
+
+
+def test_build_map_array_returns_requested_dtype(maps):
+    assert maps['float64'][0].dtype == numpy.float64
+    assert maps['float32'][0].dtype == numpy.float32
+
+
+def test_float32_map_matches_float64_map(maps):
+    reference, reference_lengths, reference_elements, _ = maps['float64']
+    compact, compact_lengths, compact_elements, _ = maps['float32']
+    assert compact.shape == reference.shape
+    assert compact_lengths == reference_lengths
+    assert compact_elements == reference_elements
+
+    # Element matrices agree value by value, and so do the statistics accumulated in float64
+    for index, element in enumerate(reference_elements):
+        numpy.testing.assert_allclose(compact[:, :, index], reference[:, :, index], rtol=FLOAT32_TOLERANCE, atol=0,
+                                      err_msg=element)
+    numpy.testing.assert_allclose(numpy.nanmean(compact, axis=(0, 1), dtype=numpy.float64),
+                                  numpy.nanmean(reference, axis=(0, 1)), rtol=FLOAT32_TOLERANCE, atol=0)
@@ -0,0 +1,21 @@
+import setuptools
+
+setuptools.setup(
+    name="icpms_common",
+    version="1.0.0",
+    author="David Kuter",
+    author_email="david.kuter@gmail.com",
+    description="Shared helpers for the LA-ICP-MS formatting tools",
+    long_description="Single-pass reader for Agilent SMPL.csv files used by format_icpms_linescans and "
+                     "format_icpms_map_data",
+    url="https://github.com/davidkuter/ICP-MS/tree/master/",
+    packages=setuptools.find_packages('src'),
+    package_dir={'': 'src'},
+    include_package_data=True,
+    extras_require={'parquet': ['pyarrow'], 'hdf5': ['h5py']},
+    classifiers=[
+        "Programming Language :: Python :: 3",
+        "License :: Free for non-commercial use  ",
+        "Operating System :: Unix  ",
+    ],
+)
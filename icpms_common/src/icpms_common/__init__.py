@@ -0,0 +1,58 @@
+import importlib
+
+# Public names and the submodule defining them. Submodules are imported on first access (PEP 562), so that importing
+# icpms_common (e.g. for FORMATS while parsing command line arguments) does not import numpy.
+_EXPORTS = {
+    'DESPIKE_THRESHOLD': 'preprocess',
+    'DTYPES': 'csv_writer',
+    'RepeatedColumn': 'csv_writer',
+    'FLOAT32_TOLERANCE': 'csv_writer',
+    'PREFETCH_BYTES': 'prefetch',
+    'PREFETCH_DEPTH': 'prefetch',
+    'archive_folders': 'archives',
+    'extracted_path': 'archives',
+    'is_archive': 'archives',
+    'member_size': 'archives',
+    'split_archive_path': 'archives',
+    'ParseCache': 'cache',
+    'FORMATS': 'containers',
+    'format_available': 'containers',
+    'read_container': 'containers',
+    'write_container': 'containers',
+    'format_rows': 'csv_writer',
+    'open_output': 'csv_writer',
+    'write_rows': 'csv_writer',
+    'FileIndex': 'discovery',
+    'file_sort_key': 'discovery',
+    'numeric_prefix': 'discovery',
+    'scan_folder': 'discovery',
+    'sequence_problems': 'discovery',
+    'LazyObject': 'lazy',
+    'lazy_import': 'lazy',
+    'PrefetchReader': 'prefetch',
+    'Preprocessor': 'preprocess',
+    'Profiler': 'profiling',
+    'PYRAMID_METHODS': 'pyramid',
+    'PYRAMID_TILE_SIZE': 'pyramid',
+    'PyramidReader': 'pyramid',
+    'write_pyramid': 'pyramid',
+    'SmplData': 'smpl_parser',
+    'parse_smpl_bytes': 'smpl_parser',
+    'parse_smpl_lines': 'smpl_parser',
+    'read_smpl': 'smpl_parser',
+    'read_smpl_files': 'smpl_parser',
+}
+
+__all__ = sorted(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module('icpms_common.' + _EXPORTS[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,187 @@
+import os
+import posixpath
+
+from icpms_common.lazy import lazy_import
+
+tarfile = lazy_import('tarfile')
+zipfile = lazy_import('zipfile')
+
+# Extensions of the archives that can be read instead of a folder (tar archives may be gzip, bzip2 or xz compressed)
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+# Members of each archive read so far: archive -> ((size, modification time), {member name: size})
+_LISTINGS = {}
+
+
+def is_archive(path):
+    """
+    Determines if a path is a zip or tar archive (by its extension)
+    :param path: str, path to file
+    :return: bool
+    """
+    return path.lower().endswith(ARCHIVE_EXTENSIONS) and os.path.isfile(path)
+
+
+def archive_stem(archive):
+    """
+    Determines the name of an archive without its extension (e.g. section_01.b.tar.gz => section_01.b)
+    :param archive: str, path to archive
+    :return: str
+    """
+    name = os.path.basename(archive)
+    for extension in ARCHIVE_EXTENSIONS:
+        if name.lower().endswith(extension):
+            return name[:-len(extension)]
+    return name
+
+
+def split_archive_path(path):
+    """
+    Splits a path inside an archive (e.g. /data/batch.tar.gz/section_01.b/001SMPL.csv) into the archive and the path of
+    the member within the archive
+    :param path: str, path
+    :return: (str, str), archive and member path ('' for the archive itself), or (None, path) if path is not inside an
+    archive
+    """
+    head = os.path.abspath(path)
+    inner = []
+    while True:
+        if is_archive(head):
+            return head, '/'.join(reversed(inner))
+        head, tail = os.path.split(head)
+        if not tail:
+            return None, path
+        inner.append(tail)
+
+
+def extracted_path(path):
+    """
+    Determines where a path inside an archive would be if the archive was extracted into its own folder, e.g.
+    /data/batch.tar.gz/section_01.b => /data/section_01.b. Output of folders read from an archive is written there.
+    Members at the top level of an archive are placed in a folder named after the archive (/data/batch.zip =>
+    /data/batch). Paths outside archives are returned unchanged.
+    :param path: str, path
+    :return: str
+    """
+    archive, inner = split_archive_path(path)
+    if archive is None:
+        return path
+    return os.path.join(os.path.dirname(archive), inner or archive_stem(archive))
+
+
+def _normalize(name):
+    # Member names without leading "./" or "/" and with "/" as separator
+    return posixpath.normpath(name.replace('\\', '/')).lstrip('/')
+
+
+def archive_members(archive):
+    """
+    Lists the files in an archive. tar archives are listed in one pass over the (decompressed) stream. The listing is
+    kept until the archive changes, so an archive is only listed once per run.
+    :param archive: str, path to archive
+    :return: dict, member name -> size in bytes (uncompressed)
+    """
+    archive = os.path.abspath(archive)
+    stat = os.stat(archive)
+    key = (stat.st_size, stat.st_mtime_ns)
+    if archive in _LISTINGS and _LISTINGS[archive][0] == key:
+        return _LISTINGS[archive][1]
+
+    if archive.lower().endswith('.zip'):
+        with zipfile.ZipFile(archive) as zf:
+            members = {_normalize(info.filename): info.file_size for info in zf.infolist() if not info.is_dir()}
+    else:
+        with tarfile.open(archive, 'r|*') as tf:
+            members = {_normalize(member.name): member.size for member in tf if member.isfile()}
+    _LISTINGS[archive] = (key, members)
+    return members
+
+
+def archive_folders(archive, extension='.csv'):
+    """
+    Determines the folders within an archive that contain files with an extension (e.g. the map folders of a batch)
+    :param archive: str, path to archive
+    :param extension: str, extension of the files
+    :return: list of str, sorted paths of the folders inside the archive (e.g. /data/batch.tar.gz/section_01.b)
+    """
+    archive = os.path.abspath(archive)
+    folders = {posixpath.dirname(name) for name in archive_members(archive) if name.endswith(extension)}
+    return sorted(os.path.join(archive, *folder.split('/')) if folder else archive
+                  for folder in folders if 'output' not in folder.split('/'))
+
+
+def list_archive_folder(folder, extension='.csv'):
+    """
+    Lists the names of the files in a folder inside an archive (not including files in its sub-folders)
+    :param folder: str, path to folder inside an archive (or to the archive for its top-level files)
+    :param extension: str, only files with this extension are listed
+    :return: list of str, file names (unsorted)
+    """
+    archive, inner = split_archive_path(folder)
+    return [posixpath.basename(name) for name in archive_members(archive)
+            if name.endswith(extension) and posixpath.dirname(name) == inner]
+
+
+def member_size(path):
+    """
+    Determines the (uncompressed) size of a file inside an archive or on disk
+    :param path: str, path to file
+    :return: int, size in bytes
+    """
+    archive, inner = split_archive_path(path)
+    if archive is None:
+        return os.path.getsize(path)
+    return archive_members(archive)[inner]
+
+
+def read_member(path):
+    """
+    Reads one file inside an archive. Use read_members to read many files of the same archive.
+    :param path: str, path to file inside an archive
+    :return: str, contents of the file
+    """
+    for _, text in read_members([path]):
+        return text
+
+
+def read_members(paths):
+    """
+    Reads files inside one archive in the order given, without extracting them. A zip archive is opened once and its
+    members are read directly. A (compressed) tar archive is decompressed in a single streaming pass; members that
+    occur in the archive before they are needed are kept in memory until their turn (in archives created from a
+    folder, the members are usually already in the order of their numeric prefix).
+    :param paths: list of str, paths to files inside the same archive
+    :return: iterator of (str, str), path and contents of each file
+    """
+    if not paths:
+        return
+    archive, _ = split_archive_path(paths[0])
+    inner = [split_archive_path(path)[1] for path in paths]
+
+    if archive.lower().endswith('.zip'):
+        with zipfile.ZipFile(archive) as zf:
+            names = {_normalize(info.filename): info for info in zf.infolist()}
+            for path, name in zip(paths, inner):
+                if name not in names:
+                    raise FileNotFoundError(f'"{path}" not found in archive "{archive}"')
+                yield path, zf.read(names[name]).decode()
+        return
+
+    wanted = {}
+    for position, name in enumerate(inner):
+        wanted.setdefault(name, []).append(position)
+    pending = {}
+    next_position = 0
+    with tarfile.open(archive, 'r|*') as tf:
+        for member in tf:
+            name = _normalize(member.name)
+            if not member.isfile() or name not in wanted:
+                continue
+            text = tf.extractfile(member).read().decode()
+            for position in wanted[name]:
+                pending[position] = text
+            while next_position in pending:
+                yield paths[next_position], pending.pop(next_position)
+                next_position += 1
+    if next_position < len(paths):
+        raise FileNotFoundError(f'"{paths[next_position]}" not found in archive "{archive}"')
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+
+from icpms_common.lazy import lazy_import
+from icpms_common.smpl_parser import SmplData
+
+numpy = lazy_import('numpy')
+
+# Increment when the parser output changes so that old cache entries are ignored
+CACHE_VERSION = 1
+MANIFEST = 'manifest.json'
+
+
+def file_hash(path):
+    """
+    Determines the SHA-1 hash of the contents of a file
+    :param path: str, path to file
+    :return: str, hex digest
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as F:
+        for block in iter(lambda: F.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class ParseCache:
+    """
+    On-disk cache of parsed SMPL.csv files. A manifest maps each file name to its size, modification time and content
+    hash, and to a binary (npz) copy of the parsed arrays. Files whose size and modification time are unchanged are
+    loaded from the cache without being read; files that were only touched (same hash) are not parsed again either.
+    """
+
+    def __init__(self, cache_dir, use_existing=True):
+        """
+        :param cache_dir: str, folder to store the cache in (created if needed)
+        :param use_existing: bool, if False existing entries are ignored (full rebuild) and replaced
+        """
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self.entries = {}
+        self._previous = {}
+
+        manifest_path = os.path.join(cache_dir, MANIFEST)
+        if use_existing and os.path.isfile(manifest_path):
+            try:
+                with open(manifest_path) as F:
+                    manifest = json.load(F)
+            except ValueError:
+                manifest = {}
+            if manifest.get('version') == CACHE_VERSION:
+                self._previous = manifest.get('files', {})
+
+    def is_valid(self, path):
+        """
+        Determines if a file can be loaded from the cache (and counts the cache hit or miss)
+        :param path: str, path to SMPL.csv file
+        :return: bool
+        """
+        name = os.path.basename(path)
+        entry = self._previous.get(name)
+        valid = False
+        if entry is not None and os.path.isfile(os.path.join(self.cache_dir, entry['entry'])):
+            stat = os.stat(path)
+            if entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+                valid = True
+            elif entry['size'] == stat.st_size and entry['sha1'] == file_hash(path):
+                entry = dict(entry, mtime_ns=stat.st_mtime_ns)
+                valid = True
+
+        if valid:
+            self.entries[name] = entry
+            self.hits += 1
+        else:
+            self.misses += 1
+        return valid
+
+    def load(self, path):
+        """
+        Loads a parsed file from the cache (is_valid must have returned True for this file)
+        :param path: str, path to SMPL.csv file
+        :return: SmplData
+        """
+        entry = self.entries[os.path.basename(path)]
+        with numpy.load(os.path.join(self.cache_dir, entry['entry'])) as npz:
+            header = json.loads(str(npz['header']))
+            return SmplData(time=npz['time'], elements=header['elements'], data=npz['data'],
+                            time_label=header['time_label'], complete=header['complete'],
+                            metadata=header['metadata'], sha1=entry['sha1'])
+
+    def store(self, path, smpl):
+        """
+        Stores a parsed file in the cache. The hash of the file is taken from the parsed data (determined from the
+        contents the parser read), so the file is only read again if the hash is not known.
+        :param path: str, path to SMPL.csv file
+        :param smpl: SmplData, parsed contents of the file
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        stat = os.stat(path)
+        sha1 = smpl.sha1 or file_hash(path)
+        entry_name = sha1 + '.npz'
+        header = {'elements': smpl.elements, 'time_label': smpl.time_label, 'complete': smpl.complete,
+                  'metadata': smpl.metadata}
+        numpy.savez(os.path.join(self.cache_dir, entry_name), time=smpl.time, data=smpl.data,
+                    header=numpy.array(json.dumps(header)))
+        self.entries[os.path.basename(path)] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': sha1,
+                                                'entry': entry_name}
+
+    def save(self):
+        """
+        Writes the manifest of the files used in this run and removes cache entries that are no longer referenced
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        with open(os.path.join(self.cache_dir, MANIFEST), 'w') as F:
+            json.dump({'version': CACHE_VERSION, 'files': self.entries}, F, indent=1, sort_keys=True)
+
+        referenced = {entry['entry'] for entry in self.entries.values()}
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith('.npz') and filename not in referenced:
+                os.remove(os.path.join(self.cache_dir, filename))
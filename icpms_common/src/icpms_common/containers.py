@@ -0,0 +1,139 @@
+import importlib.util
+import json
+import os
+
+from icpms_common.lazy import lazy_import
+
+numpy = lazy_import('numpy')
+
+FORMATS = ('csv', 'npz', 'parquet', 'hdf5')
+EXTENSIONS = {'npz': '.npz', 'parquet': '.parquet', 'hdf5': '.h5'}
+
+# Formats that need an optional dependency (module name and pip package)
+OPTIONAL_DEPENDENCIES = {'parquet': ('pyarrow', 'pyarrow'), 'hdf5': ('h5py', 'h5py')}
+
+# Key under which metadata is stored in the parquet schema
+PARQUET_METADATA_KEY = b'icpms'
+
+
+def format_available(fmt):
+    """
+    Determines if the optional dependency needed to write a container format is installed
+    :param fmt: str, one of FORMATS
+    :return: bool
+    """
+    if fmt not in OPTIONAL_DEPENDENCIES:
+        return True
+    return importlib.util.find_spec(OPTIONAL_DEPENDENCIES[fmt][0]) is not None
+
+
+def _require(fmt):
+    """
+    Imports the optional dependency of a container format
+    :param fmt: str, one of FORMATS
+    :return: module
+    """
+    module_name, package = OPTIONAL_DEPENDENCIES[fmt]
+    if not format_available(fmt):
+        raise ImportError(f'{fmt} output requires {package} (pip install {package})')
+    return importlib.import_module(module_name)
+
+
+def container_path(path, fmt):
+    """
+    Adds the extension of a container format to a path
+    :param path: str, path without extension
+    :param fmt: str, one of 'npz', 'parquet' or 'hdf5'
+    :return: str
+    """
+    return path + EXTENSIONS[fmt]
+
+
+def write_container(path, fmt, matrices, axes, metadata):
+    """
+    Writes every element matrix of a sample into one compressed container. Each element is stored separately so that
+    it can be read without loading the other elements (see read_container).
+    :param path: str, path of container without extension
+    :param fmt: str, one of 'npz', 'parquet' or 'hdf5'
+    :param matrices: dict, element -> 2D ndarray (all matrices have the same shape)
+    :param axes: dict, two axes (name -> 1D ndarray); the first runs along the rows and the second along the columns
+    :param metadata: dict, JSON-serializable metadata (e.g. SMPL.csv header information)
+    :return: str, path of the container written
+    """
+    output_file = container_path(path, fmt)
+    shapes = {matrix.shape for matrix in matrices.values()}
+    if len(shapes) > 1:
+        raise ValueError(f'Element matrices must all have the same shape, got {sorted(shapes)}')
+    description = {'elements': list(matrices), 'axes': list(axes), 'shape': list(shapes.pop() if shapes else (0, 0)),
+                   'metadata': metadata}
+
+    if fmt == 'npz':
+        arrays = {'element_' + element: matrix for element, matrix in matrices.items()}
+        arrays.update({'axis_' + name: numpy.asarray(axis) for name, axis in axes.items()})
+        arrays['description'] = numpy.array(json.dumps(description))
+        numpy.savez_compressed(output_file, **arrays)
+
+    elif fmt == 'parquet':
+        pa = _require(fmt)
+        pq = importlib.import_module('pyarrow.parquet')
+        # Matrices are stored flattened (row-major), one column per element. Axes are small and kept in the metadata
+        description['axis_values'] = {name: numpy.asarray(axis).tolist() for name, axis in axes.items()}
+        table = pa.table({element: numpy.ravel(matrix) for element, matrix in matrices.items()})
+        table = table.replace_schema_metadata({PARQUET_METADATA_KEY: json.dumps(description)})
+        pq.write_table(table, output_file, compression='zstd')
+
+    elif fmt == 'hdf5':
+        h5py = _require(fmt)
+        with h5py.File(output_file, 'w') as h5:
+            for element, matrix in matrices.items():
+                h5.create_dataset('elements/' + element, data=matrix, chunks=True, compression='gzip', shuffle=True)
+            for name, axis in axes.items():
+                h5.create_dataset('axes/' + name, data=numpy.asarray(axis))
+            h5.attrs['description'] = json.dumps(description)
+
+    else:
+        raise ValueError(f'Unknown container format "{fmt}"')
+
+    return output_file
+
+
+def read_container(path, elements=None):
+    """
+    Reads element matrices from a container. Only the requested elements are read from disk (npz members are
+    decompressed individually, parquet columns and hdf5 datasets are read selectively).
+    :param path: str, path to a .npz, .parquet or .h5 container
+    :param elements: list, elements to read (default: all)
+    :return: (dict, dict, dict), element matrices, axes and metadata
+    """
+    extension = os.path.splitext(path)[1]
+    formats = {value: key for key, value in EXTENSIONS.items()}
+    if extension not in formats:
+        raise ValueError(f'"{path}" is not a known container format')
+    fmt = formats[extension]
+
+    if fmt == 'npz':
+        with numpy.load(path) as npz:
+            description = json.loads(str(npz['description']))
+            selected = description['elements'] if elements is None else elements
+            matrices = {element: npz['element_' + element] for element in selected}
+            axes = {name: npz['axis_' + name] for name in description['axes']}
+
+    elif fmt == 'parquet':
+        _require(fmt)
+        pq = importlib.import_module('pyarrow.parquet')
+        description = json.loads(pq.read_schema(path).metadata[PARQUET_METADATA_KEY])
+        selected = description['elements'] if elements is None else elements
+        table = pq.read_table(path, columns=list(selected))
+        matrices = {element: table.column(element).to_numpy().reshape(description['shape'])
+                    for element in selected}
+        axes = {name: numpy.array(description['axis_values'][name]) for name in description['axes']}
+
+    else:
+        h5py = _require(fmt)
+        with h5py.File(path, 'r') as h5:
+            description = json.loads(h5.attrs['description'])
+            selected = description['elements'] if elements is None else elements
+            matrices = {element: h5['elements/' + element][()] for element in selected}
+            axes = {name: h5['axes/' + name][()] for name in description['axes']}
+
+    return matrices, axes, description['metadata']
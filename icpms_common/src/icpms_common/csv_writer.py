@@ -0,0 +1,144 @@
+import re
+
+from itertools import chain, repeat
+
+from icpms_common.lazy import lazy_import
+
+numpy = lazy_import('numpy')
+
+# Number of values formatted into one string and written with a single call
+WRITE_BLOCK_VALUES = 1 << 18
+
+# Buffer size of output files, so that headers and small blocks are written in a few large system calls (e.g. on NFS)
+WRITE_BUFFER_SIZE = 1 << 20
+
+# In-memory types of the counts. float32 halves the memory of the counts; its values are written with 9 significant
+# digits (enough to read back as the same float32 value, e.g. 4739.82031 instead of 4739.8203125)
+DTYPES = ('float64', 'float32')
+FLOAT32_DIGITS = 9
+
+# Maximum relative difference between float32 counts (and statistics accumulated from them in float64) and the
+# float64 counts they were converted from
+FLOAT32_TOLERANCE = 1e-6
+
+# A "nan" field, i.e. preceded by the start of the text, a comma or a newline and followed by a comma or a newline
+NAN_FIELD = re.compile(r'(?<![^,\n])nan(?=[,\n])')
+
+
+def open_output(path):
+    """
+    Opens a csv output file for writing with a large buffer
+    :param path: str, path to file
+    :return: file
+    """
+    return open(path, 'w', buffering=WRITE_BUFFER_SIZE)
+
+
+def value_format(precision=None, dtype=None):
+    """
+    Determines the printf-style format of a value
+    :param precision: int or None, number of significant digits (None: shortest representation that reads back as the
+    same float64, or FLOAT32_DIGITS digits for float32 values)
+    :param dtype: numpy dtype or None, type of the values
+    :return: str
+    """
+    if precision is None and dtype == numpy.float32:
+        precision = FLOAT32_DIGITS
+    return '%r' if precision is None else '%.{}g'.format(precision)
+
+
+def as_block(block):
+    """
+    Converts values to a 2D block of float32 (kept as it is) or float64 values
+    :param block: array-like, values of shape (row x column) or (column,)
+    :return: ndarray
+    """
+    block = numpy.asarray(block)
+    if block.dtype != numpy.float32:
+        block = block.astype(numpy.float64, copy=False)
+    return block[None, :] if block.ndim == 1 else block
+
+
+class RepeatedColumn:
+    """
+    Column of values repeated over the rows of a grid written row by row, e.g. the x and y position of every sample
+    of a map in alldata.csv. Values are only determined for the rows of each block as it is written (see write_rows),
+    so the column is not held in memory as one entry per row:
+
+        x_column = RepeatedColumn(x_list, tile=len(y_list))    # x0, x1, ..., x0, x1, ...
+        y_column = RepeatedColumn(y_list, repeat=len(x_list))  # y0, y0, ..., y1, y1, ...
+    """
+
+    def __init__(self, values, repeat=1, tile=1):
+        """
+        :param values: list, values of the column
+        :param repeat: int, number of consecutive rows each value is repeated on
+        :param tile: int, number of times the whole (repeated) sequence of values is written
+        """
+        self.values = list(values)
+        self.repeat = repeat
+        self.tile = tile
+
+    def __len__(self):
+        return len(self.values) * self.repeat * self.tile
+
+    def __getitem__(self, rows):
+        """
+        :param rows: slice, rows of a block
+        :return: list, values of these rows
+        """
+        start, stop, step = rows.indices(len(self))
+        indices = numpy.arange(start, stop, step) // self.repeat % len(self.values)
+        return [self.values[index] for index in indices.tolist()]
+
+
+def format_rows(block, precision=None, missing='nan', leading=(), trailing=()):
+    """
+    Formats a block of values as csv rows with one string operation for the whole block (instead of one per value)
+    :param block: ndarray, values of shape (row x column) (float32 values are written as float32)
+    :param precision: int or None, number of significant digits of the values (None: full precision)
+    :param missing: str, text written for NaN values
+    :param leading: sequence of columns (each a list of one value per row, e.g. x positions or labels) written before
+    the values as they are (str)
+    :param trailing: sequence of columns written after the values as they are (str)
+    :return: str, csv rows (each terminated by a newline)
+    """
+    block = as_block(block)
+    n_rows, n_columns = block.shape
+    if n_rows == 0:
+        return ''
+
+    value = value_format(precision, dtype=block.dtype)
+    row_format = ','.join(['%s'] * len(leading) + [value] * n_columns + ['%s'] * len(trailing))
+    if leading or trailing:
+        heads = zip(*leading) if leading else repeat(())
+        tails = zip(*trailing) if trailing else repeat(())
+        values = tuple(chain.from_iterable(head + tuple(row) + tail
+                                           for head, row, tail in zip(heads, block.tolist(), tails)))
+    else:
+        values = tuple(block.ravel().tolist())
+    text = ((row_format + '\n') * n_rows) % values
+
+    if missing != 'nan' and numpy.isnan(block).any():
+        text = NAN_FIELD.sub(missing, text)
+    return text
+
+
+def write_rows(F, block, precision=None, missing='nan', leading=(), trailing=()):
+    """
+    Writes a block of values as csv rows, formatting and writing WRITE_BLOCK_VALUES values at a time
+    :param F: file, open output file (see open_output)
+    :param block: ndarray, values of shape (row x column)
+    :param precision: int or None, number of significant digits of the values (None: full precision)
+    :param missing: str, text written for NaN values
+    :param leading: sequence of columns written before the values (see format_rows); each column is a list or a
+    RepeatedColumn and is sliced a block of rows at a time
+    :param trailing: sequence of columns written after the values (see leading)
+    """
+    block = as_block(block)
+    block_rows = max(1, WRITE_BLOCK_VALUES // max(1, block.shape[1] + len(leading) + len(trailing)))
+    for start in range(0, block.shape[0], block_rows):
+        stop = start + block_rows
+        F.write(format_rows(block[start:stop], precision=precision, missing=missing,
+                            leading=[column[start:stop] for column in leading],
+                            trailing=[column[start:stop] for column in trailing]))
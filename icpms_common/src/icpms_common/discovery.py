@@ -0,0 +1,134 @@
+import json
+import os
+import re
+import time
+
+from collections import namedtuple
+
+from icpms_common.archives import list_archive_folder, split_archive_path
+
+# Increment when the index format changes so that old index files are ignored
+INDEX_VERSION = 1
+
+# A directory modified less than this many nanoseconds before it was scanned may have changed again within the
+# resolution of its modification time, so such an index is not trusted
+RACY_NS = 2 * 10 ** 9
+
+NUMERIC_PREFIX = re.compile(r'\d+')
+
+# folder: str, folder scanned, files: list of files (full path) in numerical order, numbers: list of the numeric
+# prefix of each file (None if it has none), missing: list of (first, last) ranges of numbers missing from the
+# sequence, duplicates: dict of number -> file names sharing that number, unnumbered: list of file names without a
+# numeric prefix
+FileIndex = namedtuple('FileIndex', ['folder', 'files', 'numbers', 'missing', 'duplicates', 'unnumbered'])
+
+
+def numeric_prefix(filename):
+    """
+    Determines the full numeric prefix of a filename. E.g. 0123SMPL.csv => 123, 1000SMPL.csv => 1000
+    :param filename: str, name of a file
+    :return: int, or None if the filename does not start with a digit
+    """
+    match = NUMERIC_PREFIX.match(filename)
+    return int(match.group()) if match else None
+
+
+def file_sort_key(filename):
+    """
+    Sort key ordering files by their numeric prefix (files without one are placed last, by name)
+    :param filename: str, name of a file
+    :return: tuple
+    """
+    number = numeric_prefix(filename)
+    return number is None, number or 0, filename
+
+
+def _read_index(index_path, mtime_ns):
+    # Returns the cached file names if the index is still valid, else None
+    try:
+        with open(index_path) as F:
+            index = json.load(F)
+    except (OSError, ValueError):
+        return None
+    if index.get('version') != INDEX_VERSION or index.get('mtime_ns') != mtime_ns or \
+            index.get('scanned_ns', 0) - mtime_ns < RACY_NS:
+        return None
+    return index.get('names')
+
+
+def _write_index(index_path, mtime_ns, scanned_ns, names):
+    try:
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        with open(index_path, 'w') as F:
+            json.dump({'version': INDEX_VERSION, 'mtime_ns': mtime_ns, 'scanned_ns': scanned_ns, 'names': names}, F)
+    except OSError:
+        # The index is only an optimisation, e.g. the folder may be read-only
+        pass
+
+
+def scan_folder(folder, extension='.csv', index_path=None):
+    """
+    Lists the files of a folder (os.scandir, one pass) in numerical order of their full numeric prefix and checks the
+    sequence for missing and duplicate numbers. If index_path is given the ordered listing is cached there and reused
+    as long as the modification time of the folder is unchanged (i.e. no file was added, removed or renamed). The
+    folder may also be a folder inside a zip or tar archive (e.g. /data/batch.tar.gz/section_01.b).
+    :param folder: str, path to folder
+    :param extension: str, only files with this extension are listed
+    :param index_path: str or None, path of cached index (e.g. <folder>/output/.cache/index.json)
+    :return: FileIndex
+    """
+    folder = os.path.abspath(folder)
+    if not os.path.isdir(folder) and split_archive_path(folder)[0] is not None:
+        # Folder inside a zip or tar archive (listed once per run, so no index is kept)
+        names = sorted(list_archive_folder(folder, extension=extension), key=file_sort_key)
+    else:
+        names = _index_names(folder, extension, index_path)
+    return _file_index(folder, names)
+
+
+def _index_names(folder, extension, index_path):
+    # Lists the files of a folder in numerical order, using the cached index if it is still valid
+    mtime_ns = os.stat(folder).st_mtime_ns
+    names = _read_index(index_path, mtime_ns) if index_path else None
+    if names is None:
+        scanned_ns = time.time_ns()
+        with os.scandir(folder) as entries:
+            names = sorted((entry.name for entry in entries if entry.name.endswith(extension) and entry.is_file()),
+                           key=file_sort_key)
+        if index_path:
+            _write_index(index_path, mtime_ns, scanned_ns, names)
+    return names
+
+
+def _file_index(folder, names):
+    # Checks the sequence of numerically ordered file names
+    numbers = [numeric_prefix(name) for name in names]
+    numbered = sorted({number for number in numbers if number is not None})
+    missing = [(previous + 1, number - 1) for previous, number in zip(numbered, numbered[1:]) if number > previous + 1]
+    duplicates = {}
+    for name, number in zip(names, numbers):
+        if number is not None:
+            duplicates.setdefault(number, []).append(name)
+    duplicates = {number: group for number, group in duplicates.items() if len(group) > 1}
+
+    return FileIndex(folder=folder, files=[os.path.join(folder, name) for name in names], numbers=numbers,
+                     missing=missing, duplicates=duplicates,
+                     unnumbered=[name for name, number in zip(names, numbers) if number is None])
+
+
+def sequence_problems(index):
+    """
+    Describes missing and duplicate numbers and files without a number in a folder, e.g. to warn before parsing
+    :param index: FileIndex, index returned by scan_folder
+    :return: list of str, one message per problem (empty if the sequence is complete)
+    """
+    problems = []
+    if index.missing:
+        problems.append('{} missing file number(s): {}'.format(
+            sum(last - first + 1 for first, last in index.missing),
+            ', '.join(str(first) if first == last else '{}-{}'.format(first, last) for first, last in index.missing)))
+    for number, names in sorted(index.duplicates.items()):
+        problems.append('duplicate file number {}: {}'.format(number, ', '.join(names)))
+    if index.unnumbered:
+        problems.append('file(s) without a number (placed last): {}'.format(', '.join(index.unnumbered)))
+    return problems
@@ -0,0 +1,53 @@
+import importlib
+import importlib.util
+import sys
+
+
+def lazy_import(name):
+    """
+    Imports a module lazily: the module is only executed when one of its attributes is first accessed, so that heavy
+    dependencies (numpy, pyarrow, ...) cost nothing when a command line tool only prints its usage or an error.
+    Usage (at module level, instead of "import numpy"):
+
+        numpy = lazy_import('numpy')
+
+    :param name: str, name of module
+    :return: module (already imported or lazily loaded)
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f'No module named {name!r}', name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+class LazyObject:
+    """
+    Placeholder for an object defined in another module (e.g. loguru's logger), which is imported on first use:
+
+        logger = LazyObject('loguru', 'logger')
+        logger.info('...')
+    """
+
+    def __init__(self, module_name, name):
+        """
+        :param module_name: str, name of module defining the object
+        :param name: str, name of the object in that module
+        """
+        self._module_name = module_name
+        self._name = name
+        self._object = None
+
+    def _resolve(self):
+        if self._object is None:
+            self._object = getattr(importlib.import_module(self._module_name), self._name)
+        return self._object
+
+    def __getattr__(self, attr):
+        return getattr(self._resolve(), attr)
@@ -0,0 +1,95 @@
+import os
+
+from collections import deque
+
+# Default number of files read ahead and maximum size of the files held in memory before they are parsed
+PREFETCH_DEPTH = 8
+PREFETCH_BYTES = 64 * 2 ** 20
+
+
+def read_bytes(path):
+    """
+    Reads a file in one call
+    :param path: str, path to file
+    :return: bytes, contents of the file
+    """
+    with open(path, 'rb') as F:
+        return F.read()
+
+
+def file_size(path):
+    """
+    :param path: str, path to file
+    :return: int, size of the file in bytes (0 if it cannot be determined; the error is raised when it is read)
+    """
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class PrefetchReader:
+    """
+    Reads files in a pool of threads, up to depth files ahead of the file being consumed, so that the latency of
+    opening and reading files on network storage (SMB/NFS) overlaps with parsing. Files are always returned in the
+    order given. A file is only read ahead if, together with the files being read or read but not yet consumed, it
+    fits into max_bytes (sizes are taken from the file system before a read is started), so memory stays bounded when
+    the files are large. depth=0 reads the files one after the other:
+
+        reader = PrefetchReader(depth=8)
+        for path, text in reader.read(file_list):
+            ...
+    """
+
+    def __init__(self, depth=PREFETCH_DEPTH, max_bytes=PREFETCH_BYTES):
+        """
+        :param depth: int, maximum number of files read ahead (0 = no read ahead)
+        :param max_bytes: int, maximum size of the files read ahead and not yet consumed (a file larger than this is
+        still read, but not ahead of other files)
+        """
+        self.depth = depth
+        self.max_bytes = max_bytes
+
+    def _buffered(self, pending):
+        # Size of the files being read or read ahead and not yet consumed
+        return sum(size for _, _, size in pending)
+
+    def read(self, paths):
+        """
+        Reads files in the order given
+        :param paths: list of str, paths to files
+        :return: iterator of (str, bytes), path and contents of each file
+        """
+        if self.depth < 1 or len(paths) < 2:
+            for path in paths:
+                yield path, read_bytes(path)
+            return
+
+        # Imported here as it is only needed when files are read and adds to the startup time
+        from concurrent.futures import ThreadPoolExecutor
+
+        remaining = iter(paths)
+        # Next file to read and its size, kept until it fits into max_bytes
+        upcoming = []
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.depth) as executor:
+            def fill():
+                while len(pending) < self.depth:
+                    if not upcoming:
+                        path = next(remaining, None)
+                        if path is None:
+                            return
+                        upcoming.append((path, file_size(path)))
+                    path, size = upcoming[0]
+                    if pending and self._buffered(pending) + size > self.max_bytes:
+                        return
+                    upcoming.pop()
+                    pending.append((path, executor.submit(read_bytes, path), size))
+
+            fill()
+            while pending:
+                path, future, _ = pending.popleft()
+                contents = future.result()
+                # Start the next reads before the file is handed over, so that they overlap with parsing it
+                fill()
+                yield path, contents
@@ -0,0 +1,179 @@
+import warnings
+
+from icpms_common.lazy import lazy_import
+
+numpy = lazy_import('numpy')
+
+# Values whose modified Z-score (relative to the rolling median) is above this threshold are spikes
+DESPIKE_THRESHOLD = 3.5
+
+# Number of values cleaned at once (2 MB of float64), so that the temporary arrays of the rolling windows stay small
+# enough to be cached and the counts are never copied as a whole
+PREPROCESS_BLOCK_VALUES = 1 << 18
+
+
+def row_median(rows):
+    """
+    Calculates the median of every row, ignoring NaN values (numpy.nanmedian works row by row, so it is only used for
+    rows that contain NaN)
+    :param rows: ndarray, values of shape (row x sample)
+    :return: ndarray, median of shape (row x 1)
+    """
+    median = numpy.empty((rows.shape[0], 1))
+    complete = ~numpy.isnan(rows).any(axis=1)
+    median[complete] = numpy.median(rows[complete], axis=1, keepdims=True)
+    if not complete.all():
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            median[~complete] = numpy.nanmedian(rows[~complete], axis=1, keepdims=True)
+    return median
+
+
+def rolling_median(rows, window):
+    """
+    Calculates the rolling median of every row at once. Windows are centred on each value and shrink at the ends of
+    a row; NaN values (e.g. padding of a short line) are ignored. The values of each window are sorted by a sorting
+    network of element-wise minimum/maximum operations over whole arrays (NaN sorted last), so no Python loop runs
+    per row or per value.
+    :param rows: ndarray, values of shape (row x sample)
+    :param window: int, number of samples in a window (odd)
+    :return: ndarray, rolling median (same shape as rows)
+    """
+    half = window // 2
+    n_samples = rows.shape[1]
+    padded = numpy.pad(rows, ((0, 0), (half, half)), constant_values=numpy.nan)
+    missing = numpy.isnan(padded)
+    counts = sum((~missing[:, offset:offset + n_samples]).astype(numpy.int64) for offset in range(window))
+
+    # Odd-even transposition sort of the window values (window passes sort any window)
+    filled = numpy.where(missing, numpy.inf, padded)
+    columns = [filled[:, offset:offset + n_samples].copy() for offset in range(window)]
+    for sweep in range(window):
+        for index in range(sweep % 2, window - 1, 2):
+            low = numpy.minimum(columns[index], columns[index + 1])
+            numpy.maximum(columns[index], columns[index + 1], out=columns[index + 1])
+            columns[index] = low
+
+    # Windows without NaN have their median in the middle. Shrunken windows (at the ends of a row or with NaN) take
+    # the median of the values present (the mean of the two middle values if their number is even).
+    median = columns[half]
+    partial = counts < window
+    if partial.any():
+        ordered = numpy.stack([column[partial] for column in columns])
+        partial_counts = counts[partial][None]
+        low = numpy.take_along_axis(ordered, numpy.maximum(partial_counts - 1, 0) // 2, axis=0)[0]
+        high = numpy.take_along_axis(ordered, partial_counts // 2, axis=0)[0]
+        with numpy.errstate(invalid='ignore'):
+            median[partial] = numpy.where(partial_counts[0] > 0, (low + high) / 2, numpy.nan)
+    return median
+
+
+def despike(rows, window, threshold=DESPIKE_THRESHOLD):
+    """
+    Replaces spikes by the rolling median of their window. A value is a spike if its modified Z-score relative to the
+    rolling median, 0.6745 * |value - median| / MAD, is above the threshold, with MAD the median absolute deviation
+    of the row from its rolling median. If the MAD of a row is 0 (e.g. low counts that are mostly 0), the mean
+    absolute deviation (scaled by 1.2533) is used instead.
+    :param rows: ndarray, values of shape (row x sample)
+    :param window: int, number of samples in a rolling window (odd)
+    :param threshold: float, modified Z-score above which a value is a spike
+    :return: (ndarray, ndarray), despiked values and boolean mask of the spikes (same shape as rows)
+    """
+    median = rolling_median(rows, window)
+    deviation = numpy.abs(rows - median)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        scale = row_median(deviation) / 0.6745
+        mean_scale = 1.253314 * numpy.nanmean(deviation, axis=1, keepdims=True)
+    scale = numpy.where(scale > 0, scale, mean_scale)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        spikes = (scale > 0) & (deviation > threshold * scale)
+    return numpy.where(spikes, median, rows), spikes
+
+
+def gas_blank(rows, samples):
+    """
+    Estimates the gas blank (background while the laser is off) of every row from its leading samples
+    :param rows: ndarray, values of shape (row x sample)
+    :param samples: int, number of leading samples measured before the ablation starts
+    :return: ndarray, gas blank of shape (row x 1); NaN values are ignored
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return numpy.nanmean(rows[:, :samples], axis=1, keepdims=True)
+
+
+class Preprocessor:
+    """
+    Cleans counts before they are written: a rolling-median despike followed by subtraction of the gas blank
+    estimated from the leading samples of each line (both optional). Every line of every element is cleaned in one
+    batched calculation (in blocks of PREPROCESS_BLOCK_VALUES values, written back in place), and each line is cleaned
+    independently, so cleaning lines one at a time (e.g. when streaming) gives the same result as cleaning the whole
+    array at once:
+
+        preprocessor = Preprocessor(despike_window=5, blank_samples=20)
+        data = preprocessor.apply(data, axis=1)  # (line x sample x element)
+    """
+
+    def __init__(self, despike_window=0, despike_threshold=DESPIKE_THRESHOLD, blank_samples=0):
+        """
+        :param despike_window: int, number of samples in the rolling median window of the despike (odd; 0 = no
+        despike)
+        :param despike_threshold: float, modified Z-score above which a value is a spike
+        :param blank_samples: int, number of leading samples of each line averaged into its gas blank (0 = no gas
+        blank subtraction)
+        """
+        self.despike_window = despike_window
+        self.despike_threshold = despike_threshold
+        self.blank_samples = blank_samples
+
+    @property
+    def enabled(self):
+        return self.despike_window > 1 or self.blank_samples > 0
+
+    def settings(self):
+        """
+        :return: dict, preprocessing settings (stored with the output metadata)
+        """
+        return {'despike_window': self.despike_window, 'despike_threshold': self.despike_threshold,
+                'blank_samples': self.blank_samples}
+
+    def clean(self, rows):
+        """
+        Cleans lines stored as rows
+        :param rows: ndarray, values of shape (row x sample)
+        :return: ndarray, cleaned values (same shape)
+        """
+        if self.despike_window > 1:
+            rows, _ = despike(rows, self.despike_window, threshold=self.despike_threshold)
+        if self.blank_samples > 0:
+            rows = rows - gas_blank(rows, self.blank_samples)
+        return rows
+
+    def apply(self, values, axis=-1):
+        """
+        Cleans every line of every element in place. The array is cleaned in blocks taken along its longest axis other
+        than the samples (e.g. lines of a map), so only one block at a time is copied (in float64) while it is cleaned.
+        :param values: ndarray, counts with the samples of each line along one axis, e.g. (element x line x sample)
+        or (line x sample x element)
+        :param axis: int, axis of the samples
+        :return: ndarray, cleaned counts: values itself (float32 counts stay float32), or a float64 copy if values is
+        not a writable float array
+        """
+        if not self.enabled or not numpy.size(values):
+            return values
+        values = numpy.asarray(values)
+        if values.dtype not in (numpy.float32, numpy.float64) or not values.flags.writeable:
+            values = values.astype(numpy.float64)
+
+        # View with the samples along the last axis; blocks are slices of its longest other axis
+        lines = numpy.moveaxis(values, axis, -1)
+        if lines.ndim == 1:
+            lines = lines[None]
+        outer = int(numpy.argmax(lines.shape[:-1]))
+        block_size = max(1, PREPROCESS_BLOCK_VALUES * lines.shape[outer] // lines.size)
+        for start in range(0, lines.shape[outer], block_size):
+            block = lines[(slice(None),) * outer + (slice(start, start + block_size),)]
+            rows = block.reshape(-1, block.shape[-1]).astype(numpy.float64, copy=False)
+            block[...] = self.clean(rows).reshape(block.shape)
+        return values
@@ -0,0 +1,246 @@
+import cProfile
+import functools
+import json
+import resource
+import sys
+import time
+
+
+def io_counters():
+    """
+    Determines the number of bytes read and written by the current process (Linux only; /proc/self/io rchar and
+    wchar count all bytes passed to read/write calls, including those served from the page cache)
+    :return: (int, int) or (None, None) if not available
+    """
+    try:
+        with open('/proc/self/io') as F:
+            counters = dict(line.split(':', 1) for line in F)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def reset_peak_rss():
+    """
+    Resets the peak resident set size of the current process so that the peak of a single stage can be measured
+    (Linux only; elsewhere the peak since the start of the process is reported)
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as F:
+            F.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    """
+    Determines the peak resident set size of the current process (since the last reset_peak_rss on Linux)
+    :return: float, peak RSS in MB
+    """
+    try:
+        with open('/proc/self/status') as F:
+            for line in F:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+class StageRecord:
+    """
+    Measurements of one pipeline stage. The code being profiled sets rows (number of data rows processed).
+    """
+    __slots__ = ('name', 'calls', 'wall_time', 'bytes_read', 'bytes_written', 'rows', 'peak_rss_mb')
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall_time = 0.0
+        self.bytes_read = None
+        self.bytes_written = None
+        self.rows = 0
+        self.peak_rss_mb = None
+
+    def as_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+
+class _NullStage:
+    """
+    Stage used when profiling is disabled: entering and leaving it does nothing
+    """
+
+    def __enter__(self):
+        return StageRecord('disabled')
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _Stage:
+    """
+    Context manager measuring one execution of a stage and adding it to the profiler
+    """
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.record = StageRecord(name)
+
+    def __enter__(self):
+        reset_peak_rss()
+        self.io_start = io_counters()
+        self.start = time.perf_counter()
+        return self.record
+
+    def __exit__(self, *exc_info):
+        record = self.record
+        record.calls = 1
+        record.wall_time = time.perf_counter() - self.start
+        io_end = io_counters()
+        if None not in self.io_start and None not in io_end:
+            record.bytes_read = io_end[0] - self.io_start[0]
+            record.bytes_written = io_end[1] - self.io_start[1]
+        record.peak_rss_mb = peak_rss_mb()
+        self.profiler.add(record.as_dict())
+        return False
+
+
+def _add(total, value):
+    if value is None:
+        return total
+    return value if total is None else total + value
+
+
+class Profiler:
+    """
+    Records wall time, bytes read and written, rows processed and peak memory per pipeline stage:
+
+        profiler = Profiler(enabled=args.profile)
+        with profiler.stage('parse') as stage:
+            data = parse(files)
+            stage.rows = len(data)
+
+    Stages should not be nested. When disabled, stage() returns a context manager that does nothing, so the
+    instrumentation can stay in place at (near) zero cost. Stages executed more than once are accumulated.
+    """
+
+    def __init__(self, enabled=True, cprofile_path=None):
+        """
+        :param enabled: bool, if False nothing is recorded
+        :param cprofile_path: str or None, if given (and enabled) cProfile runs between start() and finish() and its
+        statistics are dumped to this path
+        """
+        self.enabled = enabled
+        self.cprofile_path = cprofile_path if enabled else None
+        self.stages = {}
+        self._cprofile = None
+        self._start = None
+        self.total_time = None
+
+    def stage(self, name):
+        """
+        Measures a pipeline stage
+        :param name: str, name of the stage
+        :return: context manager yielding a StageRecord (set its rows attribute to the number of rows processed)
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def profiled(self, name=None):
+        """
+        Decorator measuring every call of a function as a stage
+        :param name: str, name of the stage (default: name of the function)
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(name or function.__name__):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def add(self, record):
+        """
+        Adds the measurements of a stage (e.g. received from a worker process)
+        :param record: dict, as returned by StageRecord.as_dict
+        """
+        if not self.enabled:
+            return
+        total = self.stages.get(record['name'])
+        if total is None:
+            self.stages[record['name']] = dict(record)
+            return
+        total['calls'] += record['calls']
+        total['wall_time'] += record['wall_time']
+        total['rows'] += record['rows']
+        total['bytes_read'] = _add(total['bytes_read'], record['bytes_read'])
+        total['bytes_written'] = _add(total['bytes_written'], record['bytes_written'])
+        if record['peak_rss_mb'] is not None:
+            total['peak_rss_mb'] = max(total['peak_rss_mb'] or 0.0, record['peak_rss_mb'])
+
+    def records(self):
+        """
+        :return: list of dicts, measurements of each stage in the order they were first executed
+        """
+        return list(self.stages.values())
+
+    def start(self):
+        """
+        Starts timing the whole run (and cProfile if requested)
+        """
+        if not self.enabled:
+            return
+        self._start = time.perf_counter()
+        if self.cprofile_path:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def finish(self):
+        """
+        Stops timing the whole run and dumps the cProfile statistics if requested
+        """
+        if not self.enabled:
+            return
+        if self._start is not None:
+            self.total_time = time.perf_counter() - self._start
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(self.cprofile_path)
+            self._cprofile = None
+
+    def summary_table(self):
+        """
+        :return: list of str, table of all stages (one line per row)
+        """
+        def number(value, fmt):
+            return '-' if value is None else fmt.format(value)
+
+        header = '{:<28} {:>6} {:>10} {:>12} {:>12} {:>12} {:>10}'.format(
+            'Stage', 'Calls', 'Wall [s]', 'Read [MB]', 'Written [MB]', 'Rows', 'Peak [MB]')
+        lines = [header, '-' * len(header)]
+        for record in self.records():
+            lines.append('{:<28} {:>6} {:>10} {:>12} {:>12} {:>12} {:>10}'.format(
+                record['name'][:28], record['calls'], number(record['wall_time'], '{:.3f}'),
+                number(record['bytes_read'] and record['bytes_read'] / 1e6, '{:.2f}'),
+                number(record['bytes_written'] and record['bytes_written'] / 1e6, '{:.2f}'),
+                record['rows'], number(record['peak_rss_mb'], '{:.1f}')))
+        if self.total_time is not None:
+            lines.append('{:<28} {:>6} {:>10.3f}'.format('Total', '', self.total_time))
+        return lines
+
+    def write_report(self, path, **extra):
+        """
+        Writes all measurements to a JSON file
+        :param path: str, path of report
+        :param extra: additional (JSON-serializable) information to include, e.g. the command line arguments
+        """
+        report = dict(extra, total_time=self.total_time, stages=self.records())
+        with open(path, 'w') as F:
+            json.dump(report, F, indent=2)
+
+
+_NULL_STAGE = _NullStage()
@@ -0,0 +1,267 @@
+import json
+import struct
+import zlib
+
+from icpms_common.lazy import lazy_import
+
+numpy = lazy_import('numpy')
+
+# How blocks of 2 x 2 values are combined into one value of the next (coarser) level
+PYRAMID_METHODS = ('mean', 'max')
+
+# Default number of rows and columns of a tile
+PYRAMID_TILE_SIZE = 256
+
+PYRAMID_EXTENSION = '.pyramid'
+
+# File header: magic, version, offset and length of the description (JSON, written after the tiles)
+MAGIC = b'ICPMSPYR'
+VERSION = 1
+HEADER = struct.Struct('<8sIQQ')
+
+# Values are stored as little-endian float64, so that the full resolution level holds the exact counts
+TILE_DTYPE = '<f8'
+
+
+def pool_level(values, counts, method='mean'):
+    """
+    Combines blocks of 2 x 2 values into one value. A matrix with an odd number of rows or columns is padded with
+    missing values. Missing values (NaN) are ignored; a block of missing values only gives a missing value.
+    :param values: ndarray, matrix of one level (for 'mean', the sums of the counts pooled into each value)
+    :param counts: ndarray or None, number of values pooled into each value (only used for 'mean')
+    :param method: str, one of PYRAMID_METHODS
+    :return: (ndarray, ndarray or None), matrix of the next level (sums for 'mean') and counts
+    """
+    rows, columns = values.shape
+    padded_shape = (rows + rows % 2, columns + columns % 2)
+    if padded_shape != values.shape:
+        padded = numpy.full(padded_shape, 0.0 if method == 'mean' else numpy.nan)
+        padded[:rows, :columns] = values
+        values = padded
+        if counts is not None:
+            padded = numpy.zeros(padded_shape, dtype=counts.dtype)
+            padded[:rows, :columns] = counts
+            counts = padded
+    shape = (padded_shape[0] // 2, 2, padded_shape[1] // 2, 2)
+
+    if method == 'mean':
+        return values.reshape(shape).sum(axis=(1, 3)), counts.reshape(shape).sum(axis=(1, 3))
+    # fmax ignores NaN unless both values are NaN
+    return numpy.fmax.reduce(numpy.fmax.reduce(values.reshape(shape), axis=3), axis=1), None
+
+
+def pyramid_levels(matrix, method='mean', tile_size=PYRAMID_TILE_SIZE):
+    """
+    Builds the levels of a pyramid: the matrix itself followed by matrices downsampled 2x, 4x, 8x, ... until a level
+    fits into one tile. Each level is computed from the previous one; means are computed from the sums and numbers of
+    the values pooled, so they equal the mean of all (non-missing) values of the block at full resolution.
+    :param matrix: 2D ndarray, element matrix (lines as rows, samples as columns)
+    :param method: str, one of PYRAMID_METHODS
+    :param tile_size: int, number of rows and columns of a tile
+    :return: list of 2D ndarray, levels from full resolution to coarsest
+    """
+    if method not in PYRAMID_METHODS:
+        raise ValueError(f'Unknown pyramid method "{method}", expected one of {", ".join(PYRAMID_METHODS)}')
+    matrix = numpy.asarray(matrix, dtype=numpy.float64)
+    levels = [matrix]
+    if method == 'mean':
+        counts = (~numpy.isnan(matrix)).astype(numpy.int64)
+        values = numpy.where(counts > 0, matrix, 0.0)
+    else:
+        counts, values = None, matrix
+
+    while max(levels[-1].shape) > tile_size:
+        values, counts = pool_level(values, counts, method=method)
+        if method == 'mean':
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                levels.append(numpy.where(counts > 0, values / counts, numpy.nan))
+        else:
+            levels.append(values)
+    return levels
+
+
+def tile_grid(shape, tile_size):
+    """
+    :param shape: (int, int), shape of a level
+    :param tile_size: int, number of rows and columns of a tile
+    :return: (int, int), number of tile rows and tile columns covering the level
+    """
+    return -(-shape[0] // tile_size), -(-shape[1] // tile_size)
+
+
+def write_pyramid(path, matrices, axes, method='mean', tile_size=PYRAMID_TILE_SIZE, metadata=None):
+    """
+    Writes a multi-resolution pyramid of every element matrix into one file. Every level is cut into tiles of
+    tile_size x tile_size values (smaller at the bottom and right edges), which are compressed individually and
+    located through an index, so that a preview or a viewport only reads the few tiles it shows (see PyramidReader).
+    :param path: str, path of pyramid file without extension
+    :param matrices: dict, element -> 2D ndarray (all matrices have the same shape)
+    :param axes: dict, two axes (name -> 1D ndarray); the first runs along the rows and the second along the columns
+    :param method: str, one of PYRAMID_METHODS
+    :param tile_size: int, number of rows and columns of a tile
+    :param metadata: dict or None, JSON-serializable metadata (e.g. step sizes)
+    :return: str, path of the pyramid written
+    """
+    output_file = path + PYRAMID_EXTENSION
+    shapes = {matrix.shape for matrix in matrices.values()}
+    if len(shapes) > 1:
+        raise ValueError(f'Element matrices must all have the same shape, got {sorted(shapes)}')
+    if tile_size < 1:
+        raise ValueError(f'Tile size must be a positive number, got {tile_size}')
+
+    index = []
+    level_shapes = None
+    with open(output_file, 'wb') as F:
+        F.write(HEADER.pack(MAGIC, VERSION, 0, 0))
+
+        # Tiles of every level of every element, each level in row-major tile order
+        for matrix in matrices.values():
+            levels = pyramid_levels(matrix, method=method, tile_size=tile_size)
+            level_shapes = [level.shape for level in levels]
+            for level in levels:
+                tile_rows, tile_columns = tile_grid(level.shape, tile_size)
+                for row in range(tile_rows):
+                    for column in range(tile_columns):
+                        tile = level[row * tile_size:(row + 1) * tile_size,
+                                     column * tile_size:(column + 1) * tile_size]
+                        blob = zlib.compress(numpy.ascontiguousarray(tile, dtype=TILE_DTYPE).tobytes())
+                        index.append((F.tell(), len(blob)))
+                        F.write(blob)
+
+        # Offset and length of every tile, followed by the axes
+        index_offset = F.tell()
+        F.write(numpy.array(index, dtype='<u8').reshape(-1, 2).tobytes())
+        axis_offsets = {}
+        for name, axis in axes.items():
+            axis = numpy.ascontiguousarray(axis, dtype=TILE_DTYPE)
+            axis_offsets[name] = [F.tell(), len(axis)]
+            F.write(axis.tobytes())
+
+        shape = shapes.pop() if shapes else (0, 0)
+        description = {'elements': list(matrices), 'shape': list(shape), 'method': method, 'tile_size': tile_size,
+                       'levels': [list(level_shape) for level_shape in level_shapes or [shape]],
+                       'index_offset': index_offset, 'axes': axis_offsets, 'metadata': metadata or {}}
+        description_offset = F.tell()
+        encoded = json.dumps(description).encode()
+        F.write(encoded)
+        F.seek(0)
+        F.write(HEADER.pack(MAGIC, VERSION, description_offset, len(encoded)))
+
+    return output_file
+
+
+class PyramidReader:
+    """
+    Reads tiles and regions of a pyramid written by write_pyramid. Only the header, the description and the tiles
+    requested are read from the file. Level 0 is the full resolution matrix; value (i, j) of level k pools the values
+    of rows i * 2**k to (i + 1) * 2**k - 1 and columns j * 2**k to (j + 1) * 2**k - 1 of the full resolution matrix:
+
+        with PyramidReader('output/femur_head.pyramid') as pyramid:
+            preview = pyramid.region('Fe56', level=pyramid.levels - 1)
+            viewport = pyramid.region('Fe56', level=0, rows=(1000, 1500), columns=(2000, 2600))
+    """
+
+    def __init__(self, path):
+        """
+        :param path: str, path to .pyramid file
+        """
+        self.path = path
+        self._file = open(path, 'rb')
+        magic, version, offset, length = HEADER.unpack(self._file.read(HEADER.size))
+        if magic != MAGIC:
+            self._file.close()
+            raise ValueError(f'"{path}" is not a pyramid file')
+        if version != VERSION:
+            self._file.close()
+            raise ValueError(f'"{path}" has unsupported pyramid version {version}')
+        self._file.seek(offset)
+        self.description = json.loads(self._file.read(length).decode())
+        self.elements = self.description['elements']
+        self.tile_size = self.description['tile_size']
+        self.levels = len(self.description['levels'])
+
+        # Position of the first tile of every level of every element in the index
+        self._first_tile = {}
+        position = 0
+        for element in self.elements:
+            for level, shape in enumerate(self.description['levels']):
+                self._first_tile[element, level] = position
+                tile_rows, tile_columns = tile_grid(shape, self.tile_size)
+                position += tile_rows * tile_columns
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def shape(self, level=0):
+        """
+        :param level: int, level (0 = full resolution)
+        :return: (int, int), number of rows and columns of the level
+        """
+        return tuple(self.description['levels'][level])
+
+    def axis(self, name):
+        """
+        :param name: str, name of axis (e.g. 'x' or 'y')
+        :return: ndarray, positions of the full resolution rows or columns
+        """
+        offset, length = self.description['axes'][name]
+        self._file.seek(offset)
+        return numpy.frombuffer(self._file.read(length * 8), dtype=TILE_DTYPE).astype(numpy.float64)
+
+    def tile(self, element, level, row, column):
+        """
+        Reads one tile
+        :param element: str, element header (e.g. 'Fe56')
+        :param level: int, level (0 = full resolution)
+        :param row: int, tile row
+        :param column: int, tile column
+        :return: 2D ndarray, values of the tile
+        """
+        if element not in self.elements:
+            raise KeyError(f'Element "{element}" not in pyramid "{self.path}"')
+        shape = self.shape(level)
+        tile_rows, tile_columns = tile_grid(shape, self.tile_size)
+        if not (0 <= row < tile_rows and 0 <= column < tile_columns):
+            raise IndexError(f'Tile ({row}, {column}) outside level {level} of {tile_rows} x {tile_columns} tiles')
+
+        entry = self._first_tile[element, level] + row * tile_columns + column
+        self._file.seek(self.description['index_offset'] + entry * 16)
+        offset, length = struct.unpack('<QQ', self._file.read(16))
+        self._file.seek(offset)
+        values = numpy.frombuffer(zlib.decompress(self._file.read(length)), dtype=TILE_DTYPE)
+        rows = min(self.tile_size, shape[0] - row * self.tile_size)
+        return values.reshape(rows, -1).astype(numpy.float64)
+
+    def region(self, element, level=0, rows=None, columns=None):
+        """
+        Reads a region of a level, from the tiles overlapping it only
+        :param element: str, element header (e.g. 'Fe56')
+        :param level: int, level (0 = full resolution)
+        :param rows: (int, int) or None, first and last (exclusive) row of the level (default: all rows)
+        :param columns: (int, int) or None, first and last (exclusive) column of the level (default: all columns)
+        :return: 2D ndarray, values of the region
+        """
+        shape = self.shape(level)
+        row_start, row_stop = (0, shape[0]) if rows is None else (max(0, rows[0]), min(shape[0], rows[1]))
+        column_start, column_stop = (0, shape[1]) if columns is None else (max(0, columns[0]),
+                                                                             min(shape[1], columns[1]))
+        region = numpy.full((max(0, row_stop - row_start), max(0, column_stop - column_start)), numpy.nan)
+        if not region.size:
+            return region
+
+        size = self.tile_size
+        for row in range(row_start // size, (row_stop - 1) // size + 1):
+            for column in range(column_start // size, (column_stop - 1) // size + 1):
+                tile = self.tile(element, level, row, column)
+                top, left = row * size, column * size
+                r0, r1 = max(row_start, top), min(row_stop, top + tile.shape[0])
+                c0, c1 = max(column_start, left), min(column_stop, left + tile.shape[1])
+                region[r0 - row_start:r1 - row_start, c0 - column_start:c1 - column_start] = \
+                    tile[r0 - top:r1 - top, c0 - left:c1 - left]
+        return region
@@ -0,0 +1,121 @@
+import hashlib
+
+from collections import namedtuple
+
+from icpms_common.archives import read_member, read_members, split_archive_path
+from icpms_common.lazy import lazy_import
+from icpms_common.prefetch import PrefetchReader
+
+numpy = lazy_import('numpy')
+
+HEADER_MARKER = 'Intensity Vs Time'
+FOOTER_MARKER = 'Printed:'
+
+# time: 1D array of acquisition times, elements: list of element headers (e.g. 'S34'),
+# data: 2D float64 array (rows x elements), time_label: header of the time column,
+# complete: True if the "Printed:" footer was found (i.e. the instrument finished writing the file),
+# metadata: dict of header/footer information (data_file, units, acquired, printed),
+# sha1: SHA-1 hex digest of the file contents as read (None if not known, e.g. files inside an archive)
+SmplData = namedtuple('SmplData', ['time', 'elements', 'data', 'time_label', 'complete', 'metadata', 'sha1'],
+                      defaults=[None])
+
+
+def parse_smpl_lines(lines, source='<stream>'):
+    """
+    Parses the contents of an Agilent SMPL.csv file in a single pass. The "Intensity Vs Time" header and the
+    "Printed:" footer are detected while streaming, so the length of the file does not need to be known in advance.
+    :param lines: iterable of str, lines of a SMPL.csv file
+    :param source: str, name of the data source (only used in error messages)
+    :return: SmplData
+    """
+    header_found = False
+    columns = None
+    rows = []
+    data_finished = False
+    complete = False
+    metadata = {}
+
+    for line in lines:
+        line = line.strip()
+
+        # Header: "Intensity Vs Time" is followed by the acquisition info and then the column header
+        if columns is None:
+            if line.startswith(HEADER_MARKER):
+                header_found = True
+                if ',' in line:
+                    metadata['units'] = line.split(',', 1)[1]
+            elif header_found and line.startswith('Time'):
+                columns = line.split(',')
+            elif header_found and ':' in line:
+                key, value = line.split(':', 1)
+                metadata[key.strip().lower()] = value.strip()
+            elif line:
+                metadata['data_file'] = line
+            continue
+
+        # Footer: blank lines separate the data from the "Printed:" line
+        if line.startswith(FOOTER_MARKER):
+            metadata['printed'] = line[len(FOOTER_MARKER):].strip()
+            complete = True
+            break
+        if not line:
+            data_finished = True
+        elif not data_finished:
+            rows.append(line)
+
+    if columns is None:
+        raise ValueError(f'"{source}" is not a SMPL.csv file: "{HEADER_MARKER}" header not found')
+
+    if rows:
+        block = numpy.loadtxt(rows, delimiter=',', dtype=numpy.float64, ndmin=2)
+    else:
+        block = numpy.empty((0, len(columns)), dtype=numpy.float64)
+
+    return SmplData(time=block[:, 0].copy(), elements=columns[1:], data=numpy.ascontiguousarray(block[:, 1:]),
+                    time_label=columns[0], complete=complete, metadata=metadata)
+
+
+def parse_smpl_bytes(contents, source='<stream>'):
+    """
+    Parses the contents of a SMPL.csv file read in one call and determines their SHA-1 hash from the same bytes, so
+    that the parse cache does not need to read the file again
+    :param contents: bytes, contents of a SMPL.csv file
+    :param source: str, name of the data source (only used in error messages)
+    :return: SmplData
+    """
+    smpl = parse_smpl_lines(contents.decode().splitlines(), source=source)
+    return smpl._replace(sha1=hashlib.sha1(contents).hexdigest())
+
+
+def read_smpl(sample_file):
+    """
+    Reads a SMPL.csv file (opening it only once). The file may also be inside a zip or tar archive (e.g.
+    /data/batch.tar.gz/section_01.b/001SMPL.csv), in which case it is read without extracting it.
+    :param sample_file: str, path to SMPL.csv file
+    :return: SmplData
+    """
+    try:
+        with open(sample_file, 'rb') as F:
+            contents = F.read()
+        return parse_smpl_bytes(contents, source=sample_file)
+    except (FileNotFoundError, NotADirectoryError):
+        if split_archive_path(sample_file)[0] is None:
+            raise
+    return parse_smpl_lines(read_member(sample_file).splitlines(), source=sample_file)
+
+
+def read_smpl_files(sample_files, reader=None):
+    """
+    Reads SMPL.csv files in the order given. Files on disk are read ahead in a pool of threads while the current file
+    is parsed (see PrefetchReader). Files inside an archive (all in the same archive) are read in a single pass over
+    the archive (see read_members).
+    :param sample_files: list, paths to SMPL.csv files
+    :param reader: PrefetchReader or None, reader of files on disk (default: PrefetchReader())
+    :return: iterator of SmplData
+    """
+    if sample_files and split_archive_path(sample_files[0])[0] is not None:
+        for sample_file, text in read_members(sample_files):
+            yield parse_smpl_lines(text.splitlines(), source=sample_file)
+        return
+    for sample_file, contents in (reader or PrefetchReader()).read(sample_files):
+        yield parse_smpl_bytes(contents, source=sample_file)